@@ -50,7 +50,10 @@ Query API Endpoints - 查询服务API端点
     ...     headers={"Authorization": f"Bearer {token}"}
     ... )
 """
+from datetime import datetime
+
 from fastapi import APIRouter, Depends, HTTPException, status, Query as QueryParam
+from sqlalchemy import tuple_
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from pydantic import BaseModel, Field
@@ -215,7 +218,8 @@ def get_cached_query_service(model_path: str, db: Session) -> QueryService:
         logger.info(f"Loading new model into cache: {model_path}")
         # Create and load new service
         service = QueryService(db=db)
-        service.load_model(model_path)
+        # 查询直接基于检索结果作答，模型权重延迟到首次需要生成时再加载
+        service.load_model(model_path, lazy=True)
         
         # Cache the service
         _model_cache[cache_key] = service
@@ -334,20 +338,16 @@ async def query_bank_code(
             logger.info(f"Using specified model: Job {request.model_id} - {job.model_name}")
         else:
             # Use latest model
-            from app.models.training_job import TrainingJob
-            latest_job = db.query(TrainingJob).filter(
-                TrainingJob.status == "completed",
-                TrainingJob.model_path.isnot(None)
-            ).order_by(TrainingJob.completed_at.desc()).first()
+            latest_model = QueryService.get_latest_model(db)
             
-            if not latest_job:
+            if not latest_model:
                 raise HTTPException(
                     status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                     detail="No trained model available. Please train a model first."
                 )
             
-            model_path = latest_job.model_path
-            logger.info(f"Using latest model: Job {latest_job.id} - {latest_job.model_name}")
+            job_id, model_name, model_path = latest_model
+            logger.info(f"Using latest model: Job {job_id} - {model_name}")
         
         # Get cached query service (this is the key optimization!)
         query_service = get_cached_query_service(model_path, db)
@@ -453,20 +453,16 @@ async def batch_query_bank_codes(
         )
         
         # Get latest model for batch processing
-        from app.models.training_job import TrainingJob
-        latest_job = db.query(TrainingJob).filter(
-            TrainingJob.status == "completed",
-            TrainingJob.model_path.isnot(None)
-        ).order_by(TrainingJob.completed_at.desc()).first()
+        latest_model = QueryService.get_latest_model(db)
         
-        if not latest_job:
+        if not latest_model:
             raise HTTPException(
                 status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
                 detail="No trained model available. Please train a model first."
             )
         
         # Get cached query service
-        query_service = get_cached_query_service(latest_job.model_path, db)
+        query_service = get_cached_query_service(latest_model[2], db)
         
         # Process batch query
         responses = query_service.batch_query(
@@ -555,14 +551,13 @@ async def clear_model_cache(
         global _model_cache
         
         cache_size = len(_model_cache)
+        QueryService.clear_latest_model_cache()
         
         # Clear all cached models properly
         for model_path, service in _model_cache.items():
             try:
                 # Clear the service's query cache as well
-                service.query_cache.clear()
-                service._cache_hits = 0
-                service._total_queries = 0
+                service.clear_cache()
                 
                 # Clear model and tokenizer from memory
                 if hasattr(service, 'model') and service.model is not None:
@@ -608,10 +603,7 @@ async def clear_query_cache(
         # 清空全局查询服务的缓存
         global _query_service
         if _query_service:
-            cache_size = len(_query_service.query_cache)
-            _query_service.query_cache.clear()
-            _query_service._cache_hits = 0
-            _query_service._total_queries = 0
+            cache_size = _query_service.clear_cache()
             
             logger.info(f"Admin {current_user.username} cleared query cache ({cache_size} entries)")
             
@@ -637,6 +629,12 @@ async def clear_query_cache(
 async def get_query_history(
     limit: int = QueryParam(100, ge=1, le=1000, description="Maximum number of records to return"),
     offset: int = QueryParam(0, ge=0, description="Number of records to skip"),
+    before: Optional[datetime] = QueryParam(
+        None, description="Keyset cursor: only return records created before this time (overrides offset)"
+    ),
+    before_id: Optional[int] = QueryParam(
+        None, description="Keyset cursor tie-breaker: id of the last record of the previous page (used with before)"
+    ),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -646,7 +644,7 @@ async def get_query_history(
     
     This endpoint:
     1. Returns query history for the current user
-    2. Supports pagination with limit and offset
+    2. Supports pagination with limit and offset, or keyset pagination with before
     3. Orders results by creation time (newest first)
     
     Available to all authenticated users. Users can only see their own history.
@@ -655,6 +653,9 @@ async def get_query_history(
     Args:
         limit: Maximum number of records to return (1-1000)
         offset: Number of records to skip
+        before: 键集分页游标（上一页最后一条的created_at），提供时忽略offset，深分页不再线性变慢
+        before_id: 上一页最后一条的id，与before组成(created_at, id)复合游标；
+            批量写入的日志可能有相同的created_at，只按时间定位会跳过页边界上同一时间的记录
         current_user: Current authenticated user
         db: Database session
     
@@ -700,11 +701,16 @@ async def get_query_history(
         total = db.query(QueryLog).filter(QueryLog.user_id == current_user.id).count()
         
         # Get query history for current user with pagination
-        query_logs = db.query(QueryLog).filter(
-            QueryLog.user_id == current_user.id
-        ).order_by(
-            QueryLog.created_at.desc()
-        ).limit(limit).offset(offset).all()
+        # (user_id, created_at, id)复合索引见migrate_add_query_log_indexes.py
+        history_query = db.query(QueryLog).filter(QueryLog.user_id == current_user.id)
+        if before is not None and before_id is not None:
+            history_query = history_query.filter(tuple_(QueryLog.created_at, QueryLog.id) < (before, before_id))
+        elif before is not None:
+            history_query = history_query.filter(QueryLog.created_at < before)
+        history_query = history_query.order_by(QueryLog.created_at.desc(), QueryLog.id.desc()).limit(limit)
+        if before is None:
+            history_query = history_query.offset(offset)
+        query_logs = history_query.all()
         
         # Convert to response format
         history_items = []
@@ -9,21 +9,51 @@
 
 使用SQLite作为数据库，支持调试模式下的SQL查询日志。
 """
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, Session, declarative_base
-from typing import Generator
+from typing import Any, Dict, Generator
 
 from app.core.config import settings
 
+# 连接池参数：批量查询的工作线程、查询日志写入线程和API请求各自占用连接，
+# 默认的5个常驻+10个溢出连接在并发时会排队等待；内存数据库使用单连接池，不适用
+_pool_options: Dict[str, Any] = {}
+if ":memory:" not in settings.DATABASE_URL:
+    _pool_options = {
+        "pool_size": 20,        # 常驻连接数
+        "max_overflow": 10,     # 高峰时额外允许的连接数
+        "pool_recycle": 1800,   # 连接使用30分钟后重建
+    }
+
 # 创建SQLite数据库引擎
 # check_same_thread=False: 允许多线程访问（SQLite默认限制）
 # echo: 在调试模式下打印SQL查询语句
 engine = create_engine(
     settings.DATABASE_URL,
     connect_args={"check_same_thread": False},  # SQLite多线程支持
-    echo=settings.DEBUG  # 调试模式下记录SQL查询
+    echo=settings.DEBUG,  # 调试模式下记录SQL查询
+    **_pool_options
 )
 
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite_connection(dbapi_connection: Any, connection_record: Any) -> None:
+    """
+    为每个新的SQLite连接设置PRAGMA
+    
+    - journal_mode=WAL: 读写互不阻塞，查询与日志写入可以并发
+    - synchronous=NORMAL: WAL模式下提交时不再每次fsync，仍保证数据库一致性
+    - busy_timeout: 遇到写锁时等待5秒，而不是立即报database is locked
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+
 # 创建会话工厂
 # autocommit=False: 需要显式提交事务
 # autoflush=False: 需要显式刷新会话
@@ -43,21 +43,35 @@ Query Service - 查询推理服务
     7. 记录查询日志
     8. 返回结构化响应
 """
+import asyncio
+import atexit
+import contextlib
 import os
 import re
+import sys
 import time
-import hashlib
-from functools import lru_cache
+import queue
+import threading
+import unicodedata
+import zlib
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, lru_cache
 from typing import Dict, Any, Optional, List, Tuple
 from pathlib import Path
 
+import numpy as np
 import torch
 from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
-    GenerationConfig
+    GenerationConfig,
+    StoppingCriteria,
+    StoppingCriteriaList
 )
 from peft import PeftModel
+from sqlalchemy import or_, text, tuple_
 from sqlalchemy.orm import Session
 from loguru import logger
 
@@ -65,6 +79,445 @@ from app.models.bank_code import BankCode
 from app.models.training_job import TrainingJob
 from app.models.query_log import QueryLog
 
+try:
+    import ahocorasick  # 可选依赖：pyahocorasick，多模式匹配
+except ImportError:
+    logger.info("pyahocorasick not available, bank alias matching uses substring scans")
+    ahocorasick = None
+
+# 12位联行号（模块加载时编译一次；\b按Unicode判断词边界，紧贴中文字符的数字串不算联行号）
+_BANK_CODE_RE = re.compile(r'\b\d{12}\b')
+
+# 问题中的数字串（语义缓存命中时必须一致）
+_DIGITS_RE = re.compile(r'\d+')
+
+# 答案置信度关键词
+_CONFIDENCE_POSITIVE_KEYWORDS = ("联行号", "银行", "清算", "分行")
+_CONFIDENCE_NEGATIVE_KEYWORDS = ("不确定", "可能", "也许", "未找到", "不知道")
+
+
+def _answer_confidence(answer: str, has_records: bool) -> float:
+    """
+    基于规则计算答案置信度
+    
+    Args:
+        answer: 答案文本
+        has_records: 是否从答案中提取到银行记录
+    
+    Returns:
+        置信度分数（0.0-1.0）
+    """
+    # Simple heuristic-based confidence calculation
+    confidence = 0.0
+    
+    # If we found bank codes, increase confidence
+    if has_records:
+        confidence += 0.5
+    
+    # If answer contains specific keywords, increase confidence
+    for keyword in _CONFIDENCE_POSITIVE_KEYWORDS:
+        if keyword in answer:
+            confidence += 0.1
+    
+    # If answer contains negative keywords, decrease confidence
+    for keyword in _CONFIDENCE_NEGATIVE_KEYWORDS:
+        if keyword in answer:
+            confidence -= 0.2
+    
+    # Clamp to [0.0, 1.0]
+    return max(0.0, min(1.0, confidence))
+
+
+_answer_confidence_cached = lru_cache(maxsize=2048)(_answer_confidence)
+
+# 检索结果只需要这三列：按列查询，避免构造完整的ORM实体
+_BANK_RESULT_COLUMNS = (BankCode.bank_name, BankCode.bank_code, BankCode.clearing_code)
+
+
+def _bank_record(row: Any) -> Dict[str, str]:
+    """将检索行（列查询Row或BankCode实体）转换为结果字典"""
+    return {
+        "bank_name": row.bank_name,
+        "bank_code": row.bank_code,
+        "clearing_code": row.clearing_code
+    }
+
+
+@lru_cache(maxsize=8192)
+def _bigram_signature(text: str) -> int:
+    """
+    计算文本的64位二元组（bigram）签名
+    
+    每个相邻字符对哈希到64位中的一位，两个签名的按位与/或即可近似
+    bigram集合的交集/并集。签名按文本缓存，同一银行名称只计算一次。
+    
+    使用CRC32而不是内置hash()（按进程加盐），签名及由此得到的置信度在各进程和重启之间一致。
+    
+    Args:
+        text: 输入文本（调用方负责大小写归一化）
+    
+    Returns:
+        64位整数签名
+    """
+    signature = 0
+    for i in range(len(text) - 1):
+        signature |= 1 << (zlib.crc32(text[i:i + 2].encode("utf-8")) & 63)
+    return signature
+
+
+def _popcount(value: int) -> int:
+    """统计整数二进制中1的个数（兼容Python 3.9，无int.bit_count）"""
+    return bin(value).count("1")
+
+
+@lru_cache(maxsize=1024)
+def _entity_alternation(entities: Tuple[str, ...]) -> Optional["re.Pattern[str]"]:
+    """
+    将一次查询的全部实体编译为单个正则选择式（按实体组合缓存）
+    
+    仅用于判断候选名称是否包含任一实体；实体之间可能重叠（如“北京”与“北京西单支行”），
+    各实体是否命中仍需逐个判断。
+    
+    Args:
+        entities: 实体元组
+    
+    Returns:
+        编译后的正则；无非空实体时返回None（调用方不做预筛）
+    """
+    tokens = sorted({entity for entity in entities if entity}, key=len, reverse=True)
+    if not tokens:
+        return None
+    return re.compile("|".join(map(re.escape, tokens)))
+
+
+@lru_cache(maxsize=256)
+def _keyword_automaton(keywords: Tuple[str, ...]) -> Optional[Any]:
+    """
+    为一次查询的关键词构建Aho-Corasick自动机（按小写匹配）
+    
+    同一组关键词只构建一次，评分时每个候选银行名称只需扫描一遍。
+    未安装pyahocorasick或没有关键词时返回None。
+    """
+    if ahocorasick is None or not keywords:
+        return None
+    automaton = ahocorasick.Automaton()
+    for keyword in keywords:
+        lowered = keyword.lower()
+        automaton.add_word(lowered, lowered)
+    automaton.make_automaton()
+    return automaton
+
+
+@lru_cache(maxsize=4096)
+def _score_candidate(
+    bank_name: str,
+    question: str,
+    is_full_name: bool,
+    keywords: Tuple[str, ...],
+    bank_names: Tuple[str, ...],
+    locations: Tuple[str, ...],
+    branch_types: Tuple[str, ...]
+) -> Tuple[int, int, int, int, int, Tuple[Tuple[str, str], ...]]:
+    """
+    候选银行的规则评分核心（纯函数，不依赖实例状态）
+    
+    只做字符串包含判断和整数累加，结果按参数缓存；同一问题重复查询或
+    多个查询命中同一网点时直接复用。
+    
+    Args:
+        bank_name: 候选银行名称
+        question: 原始问题
+        is_full_name: 问题是否为完整银行名称
+        keywords: 关键词（长度不小于2）
+        bank_names: 银行名称实体
+        locations: 地理位置实体
+        branch_types: 支行类型实体
+    
+    Returns:
+        (精确匹配分, 语义分, 地理位置分, 支行类型分, 惩罚分, 命中特征)，
+        命中特征为(实体类别, 实体)元组，类别为空字符串表示完全匹配
+    """
+    exact_score = semantic_score = location_score = branch_score = penalty_score = 0
+    matched = []
+    
+    # 1. 精确匹配分数（最高权重）
+    if is_full_name and question.strip() == bank_name:
+        exact_score = 10000
+        matched.append(('', bank_name))
+    else:
+        # 关键词精确匹配（调用方已去掉长度不足2的关键词）
+        bank_name_lower = bank_name.lower()
+        automaton = _keyword_automaton(keywords)
+        if automaton is not None:
+            # 一次扫描银行名称得到全部命中的关键词，不再逐个关键词做子串查找
+            hits = {hit for _, hit in automaton.iter(bank_name_lower)}
+        else:
+            hits = {keyword.lower() for keyword in keywords if keyword.lower() in bank_name_lower}
+        for keyword in keywords:
+            if keyword.lower() in hits:
+                exact_score += len(keyword) * 100
+                matched.append(('keywords', keyword))
+    
+    # 2-4. 实体匹配：先用合并的正则做一次扫描，一个实体都不含的候选直接跳过逐类判断
+    entity_pattern = _entity_alternation(bank_names + locations + branch_types)
+    if entity_pattern is None or entity_pattern.search(bank_name):
+        # 2. 语义匹配分数
+        for entity in bank_names:
+            if entity in bank_name:
+                semantic_score += 1000
+                matched.append(('bank_names', entity))
+        
+        # 3. 地理位置匹配分数
+        for entity in locations:
+            if entity in bank_name:
+                location_score += 500
+                matched.append(('locations', entity))
+        
+        # 4. 支行类型匹配分数
+        for entity in branch_types:
+            if entity in bank_name:
+                branch_score += 300
+                matched.append(('branch_types', entity))
+    
+    # 5. 惩罚分数（长度差异过大、无关匹配等）
+    length_diff = abs(len(question) - len(bank_name))
+    if length_diff > 30:
+        penalty_score -= length_diff * 2
+    
+    return exact_score, semantic_score, location_score, branch_score, penalty_score, tuple(matched)
+
+
+@lru_cache(maxsize=500)
+def _format_match_answer_cached(
+    records_key: Tuple[Tuple[str, str, str], ...],
+    confidence: float
+) -> str:
+    """
+    按（匹配记录, 置信度）缓存的结构化答案格式化
+    
+    模块级缓存，不持有QueryService实例，不同实例可共享已格式化的答案。
+    
+    Args:
+        records_key: (bank_name, bank_code, clearing_code)元组序列
+        confidence: 置信度分数
+    
+    Returns:
+        结构化的答案字符串
+    """
+    records = [
+        {"bank_name": name, "bank_code": code, "clearing_code": clearing}
+        for name, code, clearing in records_key
+    ]
+    
+    # 单个匹配记录
+    if len(records) == 1:
+        return QueryService._format_single_match_answer(records[0], confidence)
+    
+    # 多个匹配记录
+    return QueryService._format_multiple_match_answer(records, confidence)
+
+
+# 小模型实体提取（extract_bank_entities_with_small_model）使用的规则：模块加载时构建一次
+# 银行名称 -> 别名，按优先级排列
+_BANK_ENTITY_ALIASES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("华夏银行", ("华夏银行",)),
+    ("中国农业银行", ("中国农业银行", "农业银行", "农行")),
+    ("中国工商银行", ("中国工商银行", "工商银行", "工行")),
+    ("中国建设银行", ("中国建设银行", "建设银行", "建行")),
+    ("中国银行", ("中国银行", "中行")),
+    ("交通银行", ("交通银行", "交行")),
+    ("招商银行", ("招商银行", "招行")),
+    ("中信银行", ("中信银行",)),
+    ("光大银行", ("光大银行",)),
+    ("民生银行", ("民生银行",)),
+    ("兴业银行", ("兴业银行",)),
+    ("浦发银行", ("浦发银行", "上海浦东发展银行")),
+    ("平安银行", ("平安银行",)),
+    ("邮储银行", ("邮储银行", "邮政储蓄银行")),
+    ("广发银行", ("广发银行",)),
+    ("渤海银行", ("渤海银行",)),
+    ("恒丰银行", ("恒丰银行",)),
+    ("浙商银行", ("浙商银行",)),
+)
+
+_ALL_BANK_ALIASES = tuple(dict.fromkeys(
+    alias for _, aliases in _BANK_ENTITY_ALIASES for alias in aliases
+))
+
+if ahocorasick is not None:
+    _BANK_ALIAS_AUTOMATON = ahocorasick.Automaton()
+    for _alias in _ALL_BANK_ALIASES:
+        _BANK_ALIAS_AUTOMATON.add_word(_alias, _alias)
+    _BANK_ALIAS_AUTOMATON.make_automaton()
+else:
+    _BANK_ALIAS_AUTOMATON = None
+
+
+def _find_bank_aliases(question: str) -> set:
+    """
+    返回问题中出现的全部银行别名
+    
+    安装了pyahocorasick时一次扫描匹配所有别名（含重叠），否则逐个别名做子串判断。
+    """
+    if _BANK_ALIAS_AUTOMATON is not None:
+        return {alias for _, alias in _BANK_ALIAS_AUTOMATON.iter(question)}
+    return {alias for alias in _ALL_BANK_ALIASES if alias in question}
+
+
+# 地理位置规则：城市名按优先级分组，合并为一个带命名分组的选择式，一次扫描即可；
+# 多个城市同时出现时取优先级最高的分组（与逐个模式依次匹配的结果一致）
+_ENTITY_LOCATION_TIERS = (
+    # 直辖市
+    '北京|上海|天津|重庆',
+    # 省会城市和重要城市
+    '厦门|深圳|青岛|大连|宁波|苏州|无锡|常州|南京|杭州|温州|嘉兴|湖州|绍兴|金华|衢州|舟山|台州|丽水',
+    '合肥|芜湖|蚌埠|淮南|马鞍山|淮北|铜陵|安庆|黄山|滁州|阜阳|宿州|六安|亳州|池州|宣城',
+    '福州|莆田|三明|泉州|漳州|南平|龙岩|宁德',
+    '南昌|景德镇|萍乡|九江|新余|鹰潭|赣州|吉安|宜春|抚州|上饶',
+    '济南|淄博|枣庄|东营|烟台|潍坊|济宁|泰安|威海|日照|莱芜|临沂|德州|聊城|滨州|菏泽',
+    '郑州|开封|洛阳|平顶山|安阳|鹤壁|新乡|焦作|濮阳|许昌|漯河|三门峡|南阳|商丘|信阳|周口|驻马店',
+    '武汉|黄石|十堰|宜昌|襄阳|鄂州|荆门|孝感|荆州|黄冈|咸宁|随州|恩施',
+    '长沙|株洲|湘潭|衡阳|邵阳|岳阳|常德|张家界|益阳|郴州|永州|怀化|娄底',
+    '广州|韶关|珠海|汕头|佛山|江门|湛江|茂名|肇庆|惠州|梅州|汕尾|河源|阳江|清远|东莞|中山|潮州|揭阳|云浮',
+    '南宁|柳州|桂林|梧州|北海|防城港|钦州|贵港|玉林|百色|贺州|河池|来宾|崇左',
+    '海口|三亚|三沙|儋州',
+    '成都|自贡|攀枝花|泸州|德阳|绵阳|广元|遂宁|内江|乐山|南充|眉山|宜宾|广安|达州|雅安|巴中|资阳|江油',
+    '贵阳|六盘水|遵义|安顺|毕节|铜仁',
+    '昆明|曲靖|玉溪|保山|昭通|丽江|普洱|临沧',
+    '拉萨|昌都|山南|日喀则|那曲|阿里|林芝',
+    '西安|铜川|宝鸡|咸阳|渭南|延安|汉中|榆林|安康|商洛',
+    '兰州|嘉峪关|金昌|白银|天水|武威|张掖|平凉|酒泉|庆阳|定西|陇南',
+    '西宁|海东',
+    '银川|石嘴山|吴忠|固原|中卫',
+    '乌鲁木齐|克拉玛依|吐鲁番|哈密',
+)
+
+_ENTITY_LOCATION_RE = re.compile("|".join(
+    f"(?P<tier{i}>{cities})" for i, cities in enumerate(_ENTITY_LOCATION_TIERS)
+))
+
+# 县级市和特殊地名（未命中任何城市名时使用）
+_ENTITY_GENERIC_LOCATION_RE = re.compile(r'([^市县区镇]{2,8}[市县区镇])')
+
+
+def _match_location(question: str) -> Optional[str]:
+    """
+    识别问题中的地理位置
+    
+    Args:
+        question: 用户问题
+    
+    Returns:
+        优先级最高的城市名（同优先级取最靠前的）；没有城市名时返回通用地名匹配结果或None
+    """
+    best_tier, best_location = None, None
+    for match in _ENTITY_LOCATION_RE.finditer(question):
+        tier = int(match.lastgroup[len("tier"):])
+        if best_tier is None or tier < best_tier:
+            best_tier, best_location = tier, match.group()
+            if tier == 0:
+                break
+    
+    if best_location is not None:
+        return best_location
+    
+    match = _ENTITY_GENERIC_LOCATION_RE.search(question)
+    return match.group(1) if match else None
+
+# 增强实体提取的地理位置（直辖市和省会、重要城市、商业区和地标），合并为一个选择式
+_ENHANCED_LOCATION_RE = re.compile(
+    '北京|上海|天津|重庆|广州|深圳|成都|武汉|西安|南京|杭州'
+    '|苏州|青岛|大连|宁波|厦门|无锡|常州|温州|佛山|东莞|中山'
+    '|西单|王府井|中关村|国贸|金融街|陆家嘴|外滩|珠江新城|福田|南山'
+)
+
+# 增强实体提取的银行名称 -> 别名（按顺序匹配）
+_ENHANCED_BANK_ALIASES: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ('中国工商银行', ('工商银行', '工行', 'ICBC', '中国工商')),
+    ('中国农业银行', ('农业银行', '农行', 'ABC', '中国农业')),
+    ('中国银行', ('中行', 'BOC', '中银')),
+    ('中国建设银行', ('建设银行', '建行', 'CCB', '中国建设')),
+    ('交通银行', ('交行', 'BOCOM', '交通')),
+    ('招商银行', ('招行', 'CMB', '招商')),
+    ('浦发银行', ('上海浦东发展银行', 'SPDB', '浦东发展')),
+    ('中信银行', ('中信', 'CITIC')),
+    ('光大银行', ('中国光大银行', 'CEB', '光大')),
+    ('华夏银行', ('华夏', 'HXB')),
+    ('民生银行', ('中国民生银行', 'CMBC', '民生')),
+    ('广发银行', ('广发', 'CGB', '广东发展银行')),
+    ('平安银行', ('平安', 'PAB')),
+    ('兴业银行', ('兴业', 'CIB')),
+    ('邮储银行', ('邮政储蓄银行', 'PSBC', '邮储', '邮政银行')),
+)
+
+# 增强实体提取的支行类型
+_ENHANCED_BRANCH_PATTERNS = (
+    re.compile(r'([^银行]{1,15}支行)'),
+    re.compile(r'([^银行]{1,15}分行)'),
+    re.compile(r'(营业部|营业厅|分理处|储蓄所)'),
+)
+
+# 支行名称规则
+_ENTITY_BRANCH_PATTERNS = (
+    re.compile(r'([^银行]{1,10}支行)'),
+    re.compile(r'([^银行]{1,10}分行)'),
+)
+
+
+class BankCodeStoppingCriteria(StoppingCriteria):
+    """
+    生成出足够数量的联行号后提前结束生成
+    
+    每步只解码尚未满足条件的序列的新生成部分；联行号后面必须已经生成了其他字符，
+    以确认数字串不会继续延长。批内所有序列都满足时停止。
+    """
+    
+    def __init__(self, tokenizer: Any, prompt_length: int, codes_needed: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.codes_needed = codes_needed
+        self._done: Optional[List[bool]] = None
+    
+    def _has_enough_codes(self, text: str) -> bool:
+        complete = sum(1 for match in _BANK_CODE_RE.finditer(text) if match.end() < len(text))
+        return complete >= self.codes_needed
+    
+    def __call__(self, input_ids: Any, scores: Any, **kwargs) -> bool:
+        if self._done is None:
+            self._done = [False] * len(input_ids)
+        
+        pending = [i for i, done in enumerate(self._done) if not done]
+        texts = self.tokenizer.batch_decode(
+            input_ids[pending, self.prompt_length:], skip_special_tokens=True
+        )
+        for i, text in zip(pending, texts):
+            self._done[i] = self._has_enough_codes(text)
+        
+        return all(self._done)
+
+
+class QueryParse:
+    """
+    一次查询的问题解析结果
+    
+    query()中每个问题只解析一次，在关键词检索和答案生成之间共享，避免对同一问题重复做
+    中文文本扫描。各部分在首次使用时才提取，用不到的部分（如向量检索成功时的检索实体）不计算。
+    """
+    
+    def __init__(self, service: "QueryService", question: str):
+        self._service = service
+        self.question = question
+    
+    @cached_property
+    def entities(self) -> Dict[str, Any]:
+        """检索实体（银行、地区、支行、检索关键词），见extract_bank_entities_with_small_model"""
+        return self._service.extract_bank_entities_with_small_model(self.question)
+    
+    @cached_property
+    def enhanced_entities(self) -> Dict[str, Any]:
+        """评分实体，见_extract_enhanced_entities"""
+        return self._service._extract_enhanced_entities(self.question)
+
 
 class QueryServiceError(Exception):
     """
@@ -78,6 +531,92 @@ class QueryServiceError(Exception):
     pass
 
 
+class _QueryLogWriter:
+    """
+    查询日志后台批量写入（进程内所有QueryService实例共享一个写入线程和队列）
+    
+    请求线程只入队（日志字段字典及写入用的engine），写入线程每批最多取batch_size条，
+    或等待flush_interval秒后按engine分组提交。写入线程不持有任何QueryService实例，
+    服务实例（及其模型、缓存）重建后可以正常释放。
+    """
+    
+    def __init__(self, batch_size: int = 128, flush_interval: float = 0.1, max_queue_size: int = 10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval  # 秒
+        self._queue: "queue.Queue[Tuple[Any, Dict[str, Any]]]" = queue.Queue(maxsize=max_queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    def submit(self, bind: Any, entry: Dict[str, Any]) -> bool:
+        """
+        日志入队
+        
+        Args:
+            bind: 写入用的engine（写入线程为每批创建独立会话）
+            entry: 查询日志字段字典
+        
+        Returns:
+            是否已入队；队列已满时返回False，由调用方同步写入
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((bind, entry))
+            return True
+        except queue.Full:
+            return False
+    
+    def flush(self) -> None:
+        """阻塞直到队列中的查询日志全部写入"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+    
+    def _ensure_started(self) -> None:
+        """按需启动后台写入线程"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+                self._thread.start()
+    
+    def _run(self) -> None:
+        """后台写入线程主循环"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            try:
+                entries_by_bind: Dict[Any, List[Dict[str, Any]]] = {}
+                for bind, entry in batch:
+                    entries_by_bind.setdefault(bind, []).append(entry)
+                for bind, entries in entries_by_bind.items():
+                    session = Session(bind=bind)
+                    try:
+                        QueryService._write_query_logs(entries, session)
+                    finally:
+                        session.close()  # 归还连接
+            except Exception as e:
+                logger.error(f"Query log worker failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+
+_query_log_writer = _QueryLogWriter()
+# 写入线程是守护线程，进程退出前先写完队列中的日志（模块级注册一次，不引用任何服务实例）
+atexit.register(_query_log_writer.flush)
+
+
 class QueryService:
     """
     查询推理服务 - 用于模型推理和查询处理
@@ -147,6 +686,8 @@ class QueryService:
             model_path: Path to trained model weights (LoRA adapters)
             base_model_name: Base model name
         """
+        # 线程本地会话：批量查询的工作线程各自持有独立会话，其余情况回落到self._db
+        self._thread_local = threading.local()
         self.db = db
         self.base_model_name = base_model_name
         self.model_path = model_path
@@ -162,13 +703,66 @@ class QueryService:
             self.device = "cpu"
         
         self.model_version = None
+        self.quantized = False
+        
+        # 延迟加载的模型（路径, 量化方式），见load_model(lazy=True)
+        self._deferred_model: Optional[Tuple[str, Optional[str]]] = None
+        self._model_load_lock = threading.Lock()
+        
+        # 银行名称全文索引是否可用（首次检索时检查）
+        self._bank_name_fts_available: Optional[bool] = None
         
         # 性能优化：缓存系统
-        self.query_cache = {}
+        # 查询分布高度集中在少数热门银行，满时按LFU淘汰（命中次数相同时淘汰最久未使用的）
+        self.query_cache: Dict[str, Tuple[Dict, float]] = {}
+        self._cache_use_counts: Dict[str, int] = {}
+        self._cache_count_buckets: "Dict[int, OrderedDict[str, None]]" = {}  # 命中次数 -> 键（LRU顺序）
+        self._cache_min_count = 0
         self.cache_ttl = 3600  # 1小时缓存
-        self.max_cache_size = 1000
+        self.max_cache_size = 4096
         self._cache_hits = 0
+        self._cache_misses = 0
         self._total_queries = 0
+        self._cache_lock = threading.Lock()
+        
+        # 联行号提取缓存：答案文本 -> (提取的记录, 时间戳)，LRU顺序
+        self._code_cache: "OrderedDict[str, Tuple[List[Dict[str, str]], float]]" = OrderedDict()
+        self.max_code_cache_size = 2048
+        self._code_cache_lock = threading.Lock()
+        
+        # 语义缓存：精确缓存未命中时，按问题向量（复用RAG嵌入模型）查找近似问题的结果；
+        # 只有银行、地区、支行实体和数字完全一致时才认为命中，避免不同网点因字面相似被混淆
+        self.semantic_cache_enabled = True
+        self.semantic_cache_threshold = 0.92
+        self.semantic_cache_size = 1024
+        self._semantic_cache_embeddings: Optional[np.ndarray] = None  # 按容量预分配，前N行有效
+        self._semantic_cache_entries: List[Tuple[Tuple, Dict, float]] = []  # (实体签名, 结果, 时间戳)
+        self._semantic_cache_uses: List[int] = []  # 命中次数，满时淘汰最少使用的条目
+        self._semantic_cache_lock = threading.Lock()
+        
+        # 批量查询并发度（受数据库连接池大小约束）
+        self.batch_max_workers = 8
+        self._batch_executor: Optional[ThreadPoolExecutor] = None
+        self._batch_executor_lock = threading.Lock()
+        
+        # 批量生成时每批的最大提示词数（超出时按长度分桶）
+        self.generation_batch_size = 16
+        self.max_prompt_tokens = 512
+        
+        # 提示词模板固定部分的token缓存（按分词器缓存）
+        self._prompt_template_ids: Optional[Dict[str, List[int]]] = None
+        self._prompt_template_tokenizer = None
+        
+        # RAG上下文的token缓存：检索结果相同（同一组银行）时上下文文本相同，不再重复分词
+        self._context_ids_cache: "OrderedDict[str, List[int]]" = OrderedDict()
+        self.max_context_cache_size = 512
+        self._context_ids_lock = threading.Lock()
+        
+        # CUDA上预分配的输入缓冲区（见_allocate_input_buffers），按扁平存储以便切出连续视图
+        self._input_ids_buffer: Optional[torch.Tensor] = None
+        self._attention_mask_buffer: Optional[torch.Tensor] = None
+        self._input_staging_buffer: Optional[torch.Tensor] = None
+        self._input_buffer_lock = threading.Lock()
         
         # 初始化RAG服务
         from app.services.rag_service import RAGService
@@ -180,28 +774,63 @@ class QueryService:
         if model_path:
             self.load_model(model_path)
     
+    @property
+    def db(self) -> Session:
+        """当前线程使用的数据库会话"""
+        return getattr(self._thread_local, "db", None) or self._db
+    
+    @db.setter
+    def db(self, value: Session) -> None:
+        self._db = value
+    
+    # 归一化时去除的句末标点（NFKC后全角？！已转为半角）
+    _QUESTION_TRAILING_PUNCTUATION = "?!.。 "
+    
+    @classmethod
+    def _normalize_question(cls, question: str) -> str:
+        """
+        归一化问题文本：NFKC、去首尾空白、小写、去句末标点
+        
+        仅在空白、全半角、大小写或句末标点上不同的问题归一化后相同，共享同一缓存条目。
+        """
+        normalized = unicodedata.normalize("NFKC", question).strip().lower()
+        return normalized.rstrip(cls._QUESTION_TRAILING_PUNCTUATION)
+    
     def _get_cache_key(self, question: str) -> str:
-        """生成缓存键"""
-        normalized = question.lower().strip()
-        return hashlib.md5(normalized.encode()).hexdigest()
+        """生成缓存键（归一化后的问题文本）"""
+        return self._normalize_question(question)
     
     def _get_cached_result(self, question: str) -> Optional[Dict]:
         """获取缓存的查询结果"""
         cache_key = self._get_cache_key(question)
         
-        if cache_key in self.query_cache:
-            result, timestamp = self.query_cache[cache_key]
+        with self._cache_lock:
+            entry = self.query_cache.get(cache_key)
+            if entry is None:
+                self._cache_misses += 1
+                return None
+            
+            result, timestamp = entry
             
             # 检查缓存是否过期
-            if time.time() - timestamp < self.cache_ttl:
-                self._cache_hits += 1
-                logger.info(f"Cache hit for question: {question[:30]}...")
-                return result
-            else:
+            if time.time() - timestamp >= self.cache_ttl:
                 # 删除过期缓存
-                del self.query_cache[cache_key]
+                self._remove_cache_entry(cache_key)
+                self._cache_misses += 1
+                return None
+            
+            self._touch_cache_entry(cache_key)
+            self._cache_hits += 1
         
-        return None
+        logger.info("Cache hit for question: {:.30}...", question)
+        return result
+    
+    def _has_cached_result(self, question: str) -> bool:
+        """精确缓存中是否有该问题未过期的结果（只查看，不计入命中统计、不更新使用次数）"""
+        cache_key = self._get_cache_key(question)
+        with self._cache_lock:
+            entry = self.query_cache.get(cache_key)
+            return entry is not None and time.time() - entry[1] < self.cache_ttl
     
     def _check_memory_usage(self) -> Dict[str, Any]:
         """检查当前内存使用情况"""
@@ -232,66 +861,262 @@ class QueryService:
     
     def _cache_result(self, question: str, result: Dict):
         """缓存查询结果"""
-        # 如果缓存已满，删除最旧的条目
-        if len(self.query_cache) >= self.max_cache_size:
-            oldest_key = min(self.query_cache.keys(), 
-                           key=lambda k: self.query_cache[k][1])
-            del self.query_cache[oldest_key]
-            logger.info("Cache full, removed oldest entry")
-        
         cache_key = self._get_cache_key(question)
-        self.query_cache[cache_key] = (result, time.time())
-        logger.info(f"Cached result for question: {question[:30]}...")
+        
+        with self._cache_lock:
+            if cache_key in self.query_cache:
+                # 更新已有条目，保留其命中次数
+                self.query_cache[cache_key] = (result, time.time())
+                self._touch_cache_entry(cache_key)
+            else:
+                # 如果缓存已满，淘汰命中次数最少的条目
+                while self.query_cache and len(self.query_cache) >= self.max_cache_size:
+                    self._evict_least_frequent()
+                    logger.info("Cache full, removed least frequently used entry")
+                
+                self.query_cache[cache_key] = (result, time.time())
+                self._cache_use_counts[cache_key] = 0
+                self._cache_count_buckets.setdefault(0, OrderedDict())[cache_key] = None
+                self._cache_min_count = 0
+        logger.info("Cached result for question: {:.30}...", question)
+    
+    def _touch_cache_entry(self, cache_key: str) -> None:
+        """条目命中：命中次数加一，移到下一个计数桶的末尾（调用方持有_cache_lock）"""
+        count = self._cache_use_counts[cache_key]
+        bucket = self._cache_count_buckets[count]
+        del bucket[cache_key]
+        if not bucket:
+            del self._cache_count_buckets[count]
+            if self._cache_min_count == count:
+                self._cache_min_count = count + 1
+        
+        self._cache_use_counts[cache_key] = count + 1
+        self._cache_count_buckets.setdefault(count + 1, OrderedDict())[cache_key] = None
+    
+    def _remove_cache_entry(self, cache_key: str) -> None:
+        """删除缓存条目（调用方持有_cache_lock）"""
+        self.query_cache.pop(cache_key, None)
+        count = self._cache_use_counts.pop(cache_key, None)
+        if count is None:
+            return
+        bucket = self._cache_count_buckets[count]
+        del bucket[cache_key]
+        if not bucket:
+            del self._cache_count_buckets[count]
+    
+    def _evict_least_frequent(self) -> None:
+        """淘汰命中次数最少的条目中最久未使用的一个（调用方持有_cache_lock）"""
+        if not self._cache_count_buckets:
+            # 计数结构与query_cache不一致（例如外部直接clear），整体重置
+            self.query_cache.clear()
+            return
+        if self._cache_min_count not in self._cache_count_buckets:
+            self._cache_min_count = min(self._cache_count_buckets)
+        bucket = self._cache_count_buckets[self._cache_min_count]
+        self._remove_cache_entry(next(iter(bucket)))
+    
+    def clear_cache(self) -> int:
+        """
+        清空查询结果缓存（精确缓存和语义缓存）并重置统计
+        
+        Returns:
+            清除的精确缓存条目数
+        """
+        with self._cache_lock:
+            cleared = len(self.query_cache)
+            self.query_cache.clear()
+            self._cache_use_counts.clear()
+            self._cache_count_buckets.clear()
+            self._cache_min_count = 0
+            self._cache_hits = 0
+            self._cache_misses = 0
+            self._total_queries = 0
+        with self._semantic_cache_lock:
+            self._semantic_cache_entries.clear()
+            self._semantic_cache_uses.clear()
+        return cleared
+    
+    @staticmethod
+    def _semantic_signature(parse: "QueryParse") -> Tuple:
+        """语义缓存命中必须一致的部分：银行、地区、支行实体和问题中的数字"""
+        entities = parse.enhanced_entities
+        return (
+            tuple(entities['bank_names']),
+            tuple(entities['locations']),
+            tuple(entities['branch_types']),
+            tuple(_DIGITS_RE.findall(parse.question))
+        )
+    
+    def _encode_questions(self, questions: List[str]) -> Optional[np.ndarray]:
+        """
+        计算多个问题的单位向量
+        
+        通过RAG服务的查询向量缓存和批量计算器获取（见RAGService._embed_queries），
+        之后向量检索同一问题时直接命中缓存，不再重复编码。
+        
+        Returns:
+            形状为(问题数, 维度)的向量矩阵；嵌入模型不可用时返回None
+        """
+        try:
+            embeddings = np.vstack(self.rag_service._embed_queries(questions)).astype(np.float32)
+        except Exception as e:
+            logger.debug(f"Semantic cache disabled, encoding failed: {e}")
+            return None
+        if embeddings.ndim != 2 or embeddings.shape[0] != len(questions) or embeddings.shape[1] == 0:
+            return None
+        
+        # 缓存中是模型原始输出，归一化后点积即余弦相似度
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return embeddings / norms
+    
+    def _encode_question(self, question: str) -> Optional[np.ndarray]:
+        """
+        计算问题的单位向量
+        
+        批量查询已为当前工作线程预先计算时直接使用（见batch_query）；不可用时返回None。
+        """
+        prefetched = getattr(self._thread_local, "question_embedding", None)
+        if prefetched is not None:
+            return prefetched
+        
+        embeddings = self._encode_questions([question])
+        return embeddings[0] if embeddings is not None else None
+    
+    def _get_semantic_cached_result(
+        self,
+        parse: "QueryParse"
+    ) -> Tuple[Optional[Dict], Optional[np.ndarray]]:
+        """
+        在语义缓存中查找近似问题的结果
+        
+        Args:
+            parse: 问题解析结果
+        
+        Returns:
+            (缓存结果或None, 问题向量)；问题向量可用于之后写入语义缓存，编码失败时为None
+        """
+        if not self.semantic_cache_enabled:
+            return None, None
+        
+        embedding = self._encode_question(parse.question)
+        if embedding is None:
+            return None, None
+        
+        with self._semantic_cache_lock:
+            count = len(self._semantic_cache_entries)
+            if count == 0:
+                return None, embedding
+            
+            # 向量已归一化，点积即余弦相似度
+            similarities = self._semantic_cache_embeddings[:count] @ embedding
+            index = int(np.argmax(similarities))
+            if similarities[index] < self.semantic_cache_threshold:
+                return None, embedding
+            
+            signature, result, timestamp = self._semantic_cache_entries[index]
+            if signature != self._semantic_signature(parse) or time.time() - timestamp >= self.cache_ttl:
+                return None, embedding
+            
+            self._semantic_cache_uses[index] += 1
+            self._cache_hits += 1
+        
+        logger.info("Semantic cache hit for question: {:.30}... (similarity: {:.3f})",
+                    parse.question, similarities[index])
+        return result, embedding
+    
+    def _cache_semantic_result(self, parse: "QueryParse", embedding: np.ndarray, result: Dict) -> None:
+        """将查询结果写入语义缓存（满时替换命中次数最少的条目）"""
+        entry = (self._semantic_signature(parse), result, time.time())
+        
+        with self._semantic_cache_lock:
+            if self._semantic_cache_embeddings is None:
+                self._semantic_cache_embeddings = np.zeros(
+                    (self.semantic_cache_size, embedding.shape[0]), dtype=np.float32
+                )
+            
+            count = len(self._semantic_cache_entries)
+            if count < self.semantic_cache_size:
+                index = count
+                self._semantic_cache_entries.append(entry)
+                self._semantic_cache_uses.append(0)
+            else:
+                index = int(np.argmin(self._semantic_cache_uses))
+                self._semantic_cache_entries[index] = entry
+                self._semantic_cache_uses[index] = 0
+            self._semantic_cache_embeddings[index] = embedding
     
     def get_cache_stats(self) -> Dict:
         """获取缓存统计信息"""
         hit_rate = self._cache_hits / max(self._total_queries, 1)
         return {
             "cache_size": len(self.query_cache),
+            "semantic_cache_size": len(self._semantic_cache_entries),
             "max_cache_size": self.max_cache_size,
             "cache_ttl": self.cache_ttl,
             "hit_rate": f"{hit_rate:.2%}",
             "total_queries": self._total_queries,
-            "cache_hits": self._cache_hits
+            "cache_hits": self._cache_hits,
+            "cache_misses": self._cache_misses
         }
     
-    def load_model(self, model_path: str) -> None:
+    def load_model(
+        self,
+        model_path: str,
+        quantize: Optional[str] = None,
+        lazy: bool = False
+    ) -> None:
         """
         Load trained model and tokenizer
         
         Args:
             model_path: Path to trained model weights
+            quantize: 基础模型量化方式："4bit"、"8bit"或"none"（默认CUDA上4bit，其他设备不量化）
+            lazy: 为True时只记录模型路径，首次需要模型生成时才加载权重
+                  （query()直接基于检索结果作答，多数请求不需要模型）
         
         Raises:
             QueryServiceError: If model loading fails
         """
+        self.clear_latest_model_cache()
+        
+        if lazy:
+            self._deferred_model = (model_path, quantize)
+            self.model_path = model_path
+            self.model_version = Path(model_path).name
+            logger.info(f"Model loading deferred until first generation: {model_path}")
+            return
+        
         try:
             logger.info(f"Loading model from: {model_path}")
             
             # 清理内存，为新模型腾出空间
+            # 只在替换已加载的模型时回收并清空GPU缓存：empty_cache会与GPU同步并整理缓存分配器，
+            # 首次加载或正常推理路径上调用只会拖慢速度
             if self.model is not None:
                 logger.info("Unloading previous model to free memory")
                 del self.model
                 del self.tokenizer
                 self.model = None
                 self.tokenizer = None
-            
-            # 强制垃圾回收和清理GPU缓存
-            import gc
-            gc.collect()
-            if torch.backends.mps.is_available():
-                torch.mps.empty_cache()
-                logger.info("MPS cache cleared")
-            elif torch.cuda.is_available():
-                torch.cuda.empty_cache()
-                logger.info("CUDA cache cleared")
+                self._input_ids_buffer = None
+                self._attention_mask_buffer = None
+                self._input_staging_buffer = None
+                
+                import gc
+                gc.collect()
+                if torch.backends.mps.is_available():
+                    torch.mps.empty_cache()
+                    logger.info("MPS cache cleared")
+                elif torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                    logger.info("CUDA cache cleared")
             
             # Determine the base model name from the training job
             # Extract job_id from model_path (e.g., "models/job_20/final_model" -> 20)
             base_model_name = self.base_model_name  # Default
             
             try:
-                import re
                 match = re.search(r'job_(\d+)', model_path)
                 if match:
                     job_id = int(match.group(1))
@@ -305,86 +1130,266 @@ class QueryService:
                 logger.warning(f"Could not determine base model from training job, using default: {e}")
             
             # Load tokenizer
+            # 因果语言模型批量生成需要左侧填充，保证各条提示词末尾对齐
+            # 使用Rust实现的快速分词器
             self.tokenizer = AutoTokenizer.from_pretrained(
                 base_model_name,
+                use_fast=True,
                 trust_remote_code=True,
-                padding_side="right"
+                padding_side="left"
             )
             
             # Set pad token if not exists
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
             
+            # 预先分词提示词模板的固定部分
+            self._get_prompt_template_ids()
+            
             # Load base model
-            # 根据设备选择合适的数据类型和配置
+            # 根据设备选择合适的数据类型和配置：GPU上使用半精度，权重带宽减半
             if self.device == "cuda":
-                torch_dtype = torch.float16
-                device_map = "auto"
+                torch_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
             elif self.device == "mps":
-                torch_dtype = torch.float32  # MPS对float16支持有限
-                device_map = None
+                torch_dtype = torch.float16
             else:
                 torch_dtype = torch.float32
-                device_map = None
             
-            base_model = AutoModelForCausalLM.from_pretrained(
-                base_model_name,
-                trust_remote_code=True,
-                torch_dtype=torch_dtype,
-                device_map=device_map
-            )
+            # 量化（bitsandbytes，仅CUDA）
+            if quantize is None:
+                quantize = "4bit" if self.device == "cuda" else "none"
+            quantization_config = self._build_quantization_config(quantize, torch_dtype)
+            self.quantized = quantization_config is not None
             
-            # 如果是MPS，手动移动模型到MPS设备
-            if self.device == "mps":
-                base_model = base_model.to(self.device)
+            self.model = self._load_model_weights(
+                base_model_name, model_path, torch_dtype, quantization_config
+            )
             
-            # Load LoRA adapters
-            # MPS设备需要特殊处理：先加载到CPU，再移动到MPS
+            # MPS部分算子可能不支持float16：试跑一次前向，不支持时回退到float32
             if self.device == "mps":
-                # 在CPU上加载LoRA权重
-                self.model = PeftModel.from_pretrained(
-                    base_model,
-                    model_path,
-                    torch_dtype=torch.float32
-                )
-                # 手动移动到MPS设备
-                self.model = self.model.to("mps")
-                logger.info("LoRA model loaded on MPS device")
-            else:
-                # CUDA或CPU直接加载
-                lora_dtype = torch.float16 if self.device == "cuda" else torch.float32
-                self.model = PeftModel.from_pretrained(
-                    base_model,
-                    model_path,
-                    torch_dtype=lora_dtype
-                )
+                try:
+                    probe = self.tokenizer(
+                        "test", return_tensors="pt", return_token_type_ids=False
+                    ).to(self.device)
+                    with torch.no_grad():
+                        self.model(**probe)
+                except (NotImplementedError, RuntimeError) as e:
+                    logger.warning(f"MPS float16 inference not supported, reloading in float32: {e}")
+                    self.model = None
+                    self.model = self._load_model_weights(base_model_name, model_path, torch.float32)
             
             # Set to evaluation mode
             self.model.eval()
             
+            # 推理阶段LoRA权重不变：合并进基础权重，省去每层额外的两次矩阵乘
+            # 量化后的基础模型无法无损合并，保留LoRA结构
+            if not self.quantized:
+                try:
+                    self.model = self.model.merge_and_unload()
+                    logger.info("LoRA adapters merged into base model weights")
+                except Exception as e:
+                    logger.warning(f"Could not merge LoRA adapters, keeping PEFT wrapper: {e}")
+            
+            # pad/eos token只需设置一次，生成时不再逐次传入
+            self.model.generation_config.pad_token_id = self.tokenizer.pad_token_id
+            self.model.generation_config.eos_token_id = self.tokenizer.eos_token_id
+            
+            # CUDA上编译前向计算（算子融合、减少逐算子Python调度）
+            if self.device == "cuda":
+                self._compile_model()
+                self._allocate_input_buffers()
+            
             # Extract model version from path
             self.model_version = Path(model_path).name
             
+            # 权重加载成功后才清除延迟加载记录：加载期间并发调用会在锁上等待，加载失败时后续调用可重试
+            self._deferred_model = None
+            
             logger.info(f"Model loaded successfully - Base: {base_model_name}, Version: {self.model_version}")
         
         except Exception as e:
             logger.error(f"Failed to load model: {e}")
-            # 清理内存
-            if torch.backends.mps.is_available():
-                torch.mps.empty_cache()
-            elif torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            import gc
-            gc.collect()
             raise QueryServiceError(f"Model loading failed: {e}")
     
+    def _compile_model(self) -> None:
+        """
+        使用torch.compile编译模型前向计算，并预热一次触发编译
+        
+        generate()内部调用forward，因此编译forward而不是包装整个模型。
+        编译或预热失败时保留eager模式，不影响服务。
+        """
+        if not hasattr(torch, "compile"):
+            return
+        
+        eager_forward = self.model.forward
+        try:
+            self.model.forward = torch.compile(eager_forward, mode="reduce-overhead", fullgraph=False)
+            
+            # 预热：首次调用触发编译，避免第一个真实请求承担编译耗时
+            warmup_inputs = self.tokenizer(
+                self._build_prompt("预热"), return_tensors="pt", return_token_type_ids=False
+            ).to(self.device)
+            with torch.no_grad():
+                self.model.generate(**warmup_inputs, max_new_tokens=2)
+            
+            logger.info("Model forward compiled with torch.compile")
+        except Exception as e:
+            self.model.forward = eager_forward
+            logger.warning(f"torch.compile unavailable, using eager mode: {e}")
+    
+    def _allocate_input_buffers(self) -> None:
+        """
+        在GPU上预分配generation_batch_size x max_prompt_tokens的输入缓冲区
+        
+        生成时把填充后的输入复制进缓冲区的视图，不再每次请求分配新的设备张量，
+        避免不同长度的批次让缓存分配器产生碎片。另配一块锁页内存作为中转，
+        主机到设备的复制可以异步进行。分配失败时回退为按次分配。
+        """
+        capacity = self.generation_batch_size * self.max_prompt_tokens
+        try:
+            self._input_ids_buffer = torch.zeros(capacity, dtype=torch.long, device=self.device)
+            self._attention_mask_buffer = torch.zeros_like(self._input_ids_buffer)
+            self._input_staging_buffer = torch.zeros(2 * capacity, dtype=torch.long, pin_memory=True)
+            logger.info(f"Preallocated input buffers: {self.generation_batch_size}x{self.max_prompt_tokens}")
+        except Exception as e:
+            self._input_ids_buffer = None
+            self._attention_mask_buffer = None
+            self._input_staging_buffer = None
+            logger.warning(f"Could not preallocate input buffers, allocating per call: {e}")
+    
+    def _fits_input_buffers(self, inputs: Dict[str, torch.Tensor]) -> bool:
+        """批次能否使用预分配的输入缓冲区（仅CUDA上已预分配、且批次不超出容量时）"""
+        if self.device != "cuda" or self._input_ids_buffer is None:
+            return False
+        batch_size, seq_len = inputs["input_ids"].shape
+        return batch_size <= self.generation_batch_size and seq_len <= self.max_prompt_tokens
+    
+    def _copy_to_input_buffers(self, inputs: Dict[str, torch.Tensor]) -> Optional[Dict[str, torch.Tensor]]:
+        """
+        将填充后的CPU输入复制到预分配缓冲区，返回设备上的视图
+        
+        调用方需持有_input_buffer_lock。批次超出缓冲区容量或未预分配时返回None。
+        """
+        if not self._fits_input_buffers(inputs):
+            return None
+        
+        batch_size, seq_len = inputs["input_ids"].shape
+        size = batch_size * seq_len
+        
+        # 中转缓冲区前半存input_ids、后半存attention_mask；generate结束前会与GPU同步，
+        # 下一批写入中转缓冲区时上一批的异步复制必然已完成
+        capacity = self._input_ids_buffer.numel()
+        device_inputs = {}
+        for offset, (key, buffer) in enumerate((("input_ids", self._input_ids_buffer),
+                                                ("attention_mask", self._attention_mask_buffer))):
+            staging = self._input_staging_buffer[offset * capacity:offset * capacity + size]
+            staging = staging.view(batch_size, seq_len)
+            staging.copy_(inputs[key])
+            view = buffer[:size].view(batch_size, seq_len)
+            view.copy_(staging, non_blocking=True)
+            device_inputs[key] = view
+        return device_inputs
+    
+    def _ensure_model_loaded(self) -> None:
+        """如有延迟加载的模型，在首次生成前加载（并发调用只加载一次）"""
+        if self._deferred_model is None and self.model is not None:
+            return
+        
+        with self._model_load_lock:
+            # 等锁期间其他调用可能已完成加载，重新检查
+            deferred = self._deferred_model
+            if deferred is None and self.model is not None:
+                return
+            if deferred is not None:
+                model_path, quantize = deferred
+                self.load_model(model_path, quantize)
+    
+    def _build_quantization_config(self, quantize: str, compute_dtype: Any) -> Optional[Any]:
+        """
+        构建bitsandbytes量化配置
+        
+        仅在CUDA上启用；非CUDA设备或未安装bitsandbytes时返回None（不量化）。
+        
+        Args:
+            quantize: "4bit"、"8bit"或"none"
+            compute_dtype: 4bit量化时矩阵乘的计算精度
+        
+        Returns:
+            BitsAndBytesConfig或None
+        """
+        if quantize not in ("4bit", "8bit"):
+            return None
+        
+        if self.device != "cuda":
+            logger.info(f"Quantization '{quantize}' requires CUDA, loading unquantized on {self.device}")
+            return None
+        
+        try:
+            import bitsandbytes  # noqa: F401
+            from transformers import BitsAndBytesConfig
+        except ImportError:
+            logger.warning("bitsandbytes not installed, loading model without quantization")
+            return None
+        
+        if quantize == "4bit":
+            return BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_compute_dtype=compute_dtype)
+        return BitsAndBytesConfig(load_in_8bit=True)
+    
+    def _load_model_weights(
+        self,
+        base_model_name: str,
+        model_path: str,
+        torch_dtype: Any,
+        quantization_config: Optional[Any] = None
+    ):
+        """
+        按指定数据类型加载基础模型并叠加LoRA权重
+        
+        Args:
+            base_model_name: 基础模型名称
+            model_path: LoRA权重路径
+            torch_dtype: 权重数据类型
+            quantization_config: 基础模型量化配置（可选）
+        
+        Returns:
+            加载完成的模型
+        """
+        device_map = "auto" if self.device == "cuda" else None
+        
+        base_model = AutoModelForCausalLM.from_pretrained(
+            base_model_name,
+            trust_remote_code=True,
+            torch_dtype=torch_dtype,
+            device_map=device_map,
+            quantization_config=quantization_config
+        )
+        
+        # 如果是MPS，手动移动模型到MPS设备
+        if self.device == "mps":
+            base_model = base_model.to(self.device)
+        
+        # Load LoRA adapters
+        model = PeftModel.from_pretrained(
+            base_model,
+            model_path,
+            torch_dtype=torch_dtype
+        )
+        
+        # MPS设备需要手动移动LoRA权重
+        if self.device == "mps":
+            model = model.to(self.device)
+            logger.info(f"LoRA model loaded on MPS device ({torch_dtype})")
+        
+        return model
+    
     def generate_answer(
         self,
         question: str,
-        max_new_tokens: int = 256,
-        temperature: float = 0.1,  # 降低温度减少随机性和幻觉
-        top_p: float = 0.8,         # 降低top_p使生成更保守
-        context: Optional[str] = None  # RAG context
+        max_new_tokens: int = 32,    # 联行号为12位数字，32个token足够
+        temperature: float = 0.0,    # 0表示贪心解码（事实查询任务，结果确定可缓存）
+        top_p: float = 1.0,
+        context: Optional[str] = None,  # RAG context
+        stop_after_codes: Optional[int] = None
     ) -> str:
         """
         Generate answer for a question using the model
@@ -392,8 +1397,9 @@ class QueryService:
         Args:
             question: User's question
             max_new_tokens: Maximum number of tokens to generate
-            temperature: Sampling temperature
-            top_p: Top-p sampling parameter
+            temperature: Sampling temperature（<=0时使用贪心解码）
+            top_p: Top-p sampling parameter（仅采样时生效）
+            stop_after_codes: 生成出该数量的联行号后提前结束（可选）
         
         Returns:
             Generated answer
@@ -401,62 +1407,256 @@ class QueryService:
         Raises:
             QueryServiceError: If generation fails
         """
+        return self.generate_answers_batch(
+            [question],
+            contexts=[context],
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_p=top_p,
+            stop_after_codes=stop_after_codes
+        )[0]
+    
+    def _build_prompt(self, question: str, context: Optional[str] = None) -> str:
+        """构建与训练时相同格式的提示词（RAG模式下包含参考信息）"""
+        if context:
+            return f"Reference Information:\n{context}\n\nQuestion: {question}\nAnswer:"
+        return f"Question: {question}\nAnswer:"
+    
+    def generate_answers_batch(
+        self,
+        questions: List[str],
+        contexts: Optional[List[Optional[str]]] = None,
+        max_new_tokens: int = 32,
+        temperature: float = 0.0,
+        top_p: float = 1.0,
+        stop_after_codes: Optional[int] = None
+    ) -> List[str]:
+        """
+        批量生成答案：多条提示词左侧填充后一次调用model.generate
+        
+        超过generation_batch_size时按token长度排序分桶，长度相近的提示词同批生成，
+        减少填充token上的无效计算；结果按输入顺序还原。
+        
+        Args:
+            questions: 问题列表
+            contexts: 与问题一一对应的RAG上下文（可选）
+            max_new_tokens: Maximum number of tokens to generate
+            temperature: Sampling temperature（<=0时使用贪心解码）
+            top_p: Top-p sampling parameter（仅采样时生效）
+            stop_after_codes: 每个答案生成出该数量的联行号后提前结束（可选）
+        
+        Returns:
+            与questions顺序一致的答案列表
+        
+        Raises:
+            QueryServiceError: If generation fails
+        """
+        if not questions:
+            return []
+        
+        self._ensure_model_loaded()
         if self.model is None or self.tokenizer is None:
             raise QueryServiceError("Model not loaded. Call load_model() first.")
         
         try:
-            # Format prompt - 使用与训练时相同的格式
-            # If context provided (RAG mode), include it in the prompt
-            if context:
-                prompt = f"Reference Information:\n{context}\n\nQuestion: {question}\nAnswer:"
-            else:
-                prompt = f"Question: {question}\nAnswer:"
+            if contexts is None:
+                contexts = [None] * len(questions)
             
             # Log the prompt for debugging
-            logger.info(f"RAG Prompt being sent to model: {prompt[:500]}...")
-            
-            # Tokenize
-            inputs = self.tokenizer(
-                prompt,
-                return_tensors="pt",
-                padding=True,
-                truncation=True,
-                max_length=512
+            logger.opt(lazy=True).info(
+                "RAG Prompt being sent to model: {:.500}... (batch size: {})",
+                lambda: self._build_prompt(questions[0], contexts[0]),
+                lambda: len(questions)
             )
             
-            # Move to device (支持CUDA和MPS)
-            if self.device in ["cuda", "mps"]:
-                inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            # Tokenize：模板部分使用缓存的token，只对问题和上下文分词
+            encoded = self._encode_prompts(questions, contexts)
             
-            # Generate
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=max_new_tokens,
-                    temperature=temperature,
-                    top_p=top_p,
-                    do_sample=True,
-                    pad_token_id=self.tokenizer.pad_token_id,
-                    eos_token_id=self.tokenizer.eos_token_id
+            batch_size = self.generation_batch_size
+            if len(encoded) <= batch_size:
+                return self._generate_for_encoded(
+                    encoded, max_new_tokens, temperature, top_p, stop_after_codes
                 )
             
-            # Decode
-            full_text = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+            # 按token长度分桶
+            order = sorted(range(len(encoded)), key=lambda i: len(encoded[i]))
             
-            # Extract answer (remove prompt) - 使用与训练时相同的分隔符
-            if "Answer:" in full_text:
-                answer = full_text.split("Answer:")[-1].strip()
-            else:
-                # 如果没有找到Answer:，返回整个生成的文本
-                answer = full_text.strip()
+            answers: List[Optional[str]] = [None] * len(encoded)
+            for start in range(0, len(order), batch_size):
+                bucket = order[start:start + batch_size]
+                bucket_answers = self._generate_for_encoded(
+                    [encoded[i] for i in bucket], max_new_tokens, temperature, top_p, stop_after_codes
+                )
+                for i, answer in zip(bucket, bucket_answers):
+                    answers[i] = answer
             
-            return answer
+            return answers
         
         except Exception as e:
             logger.error(f"Failed to generate answer: {e}")
             raise QueryServiceError(f"Answer generation failed: {e}")
     
-    @lru_cache(maxsize=500)
+    def _get_prompt_template_ids(self) -> Dict[str, List[int]]:
+        """
+        提示词模板中固定部分的token（每个分词器只分词一次）
+        
+        模板在预分词边界处切分：冒号后的换行属于固定部分，问题/上下文末尾的换行属于可变部分，
+        使拼接结果与对完整提示词分词一致。
+        """
+        if self._prompt_template_ids is None or self._prompt_template_tokenizer is not self.tokenizer:
+            def encode(text_part: str) -> List[int]:
+                return self.tokenizer(
+                    text_part, add_special_tokens=False, return_attention_mask=False
+                )["input_ids"]
+            
+            self._prompt_template_ids = {
+                "context_prefix": encode("Reference Information:\n"),
+                "question_prefix": encode("Question:"),
+                "answer_suffix": encode("Answer:"),
+            }
+            self._prompt_template_tokenizer = self.tokenizer
+            with self._context_ids_lock:
+                self._context_ids_cache.clear()
+        return self._prompt_template_ids
+    
+    def _encode_prompts(
+        self,
+        questions: List[str],
+        contexts: List[Optional[str]]
+    ) -> List[List[int]]:
+        """
+        将问题（和RAG上下文）编码为提示词token序列，格式同_build_prompt
+        
+        超出max_prompt_tokens时截断上下文，保证问题和“Answer:”完整保留。
+        
+        Args:
+            questions: 问题列表
+            contexts: 与问题一一对应的RAG上下文
+        
+        Returns:
+            每条提示词的token id列表（含分词器的特殊token）
+        """
+        template = self._get_prompt_template_ids()
+        
+        # 分词只需要token id（不填充、不返回mask和token_type_ids），attention_mask由pad统一生成
+        encode_kwargs = {
+            "add_special_tokens": False,
+            "return_attention_mask": False,
+            "return_token_type_ids": False
+        }
+        question_ids = self.tokenizer([f" {q}\n" for q in questions], **encode_kwargs)["input_ids"]
+        
+        context_ids = self._encode_contexts(contexts, encode_kwargs)
+        
+        question_part_length = len(template["question_prefix"]) + len(template["answer_suffix"])
+        encoded = []
+        for i, q_ids in enumerate(question_ids):
+            body = template["question_prefix"] + q_ids + template["answer_suffix"]
+            if i in context_ids:
+                budget = max(
+                    0,
+                    self.max_prompt_tokens - len(template["context_prefix"]) - question_part_length - len(q_ids)
+                )
+                body = template["context_prefix"] + context_ids[i][:budget] + body
+            encoded.append(self.tokenizer.build_inputs_with_special_tokens(body))
+        
+        return encoded
+    
+    def _encode_contexts(
+        self,
+        contexts: List[Optional[str]],
+        encode_kwargs: Dict[str, Any]
+    ) -> Dict[int, List[int]]:
+        """
+        对RAG上下文分词，相同的上下文文本只分词一次（LRU缓存）
+        
+        Returns:
+            上下文非空的下标 -> 上下文token id列表
+        """
+        context_ids: Dict[int, List[int]] = {}
+        missing: Dict[str, List[int]] = {}  # 未缓存的上下文 -> 使用它的下标
+        with self._context_ids_lock:
+            for i, context in enumerate(contexts):
+                if not context:
+                    continue
+                ids = self._context_ids_cache.get(context)
+                if ids is None:
+                    missing.setdefault(context, []).append(i)
+                else:
+                    self._context_ids_cache.move_to_end(context)
+                    context_ids[i] = ids
+        
+        if missing:
+            texts = list(missing)
+            encoded = self.tokenizer([f"{text}\n\n" for text in texts], **encode_kwargs)["input_ids"]
+            with self._context_ids_lock:
+                for text, ids in zip(texts, encoded):
+                    for i in missing[text]:
+                        context_ids[i] = ids
+                    self._context_ids_cache[text] = ids
+                while len(self._context_ids_cache) > self.max_context_cache_size:
+                    self._context_ids_cache.popitem(last=False)
+        
+        return context_ids
+    
+    def _generate_for_encoded(
+        self,
+        encoded: List[List[int]],
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop_after_codes: Optional[int] = None
+    ) -> List[str]:
+        """对一批已编码的提示词执行一次填充生成，返回按输入顺序的答案"""
+        # 左侧填充（见load_model），生成attention_mask
+        inputs = self.tokenizer.pad(
+            {"input_ids": encoded},
+            padding=True,
+            return_attention_mask=True,
+            return_tensors="pt"
+        )
+        
+        # 默认贪心解码（单束、启用KV缓存）；仅在显式给出温度时采样
+        if temperature > 0:
+            decoding_kwargs = {"do_sample": True, "temperature": temperature, "top_p": top_p}
+        else:
+            decoding_kwargs = {"do_sample": False, "num_beams": 1}
+        
+        # 需要的联行号都已生成时提前结束，不再生成剩余的token
+        if stop_after_codes:
+            decoding_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                BankCodeStoppingCriteria(self.tokenizer, inputs["input_ids"].shape[1], stop_after_codes)
+            ])
+        
+        # Move to device (支持CUDA和MPS)：CUDA上优先复制进预分配缓冲区，缓冲区在生成期间独占；
+        # 不使用缓冲区（CPU/MPS、批次超出容量）时不加锁，各线程的生成互不等待
+        use_buffers = self._fits_input_buffers(inputs)
+        with self._input_buffer_lock if use_buffers else contextlib.nullcontext():
+            device_inputs = self._copy_to_input_buffers(inputs) if use_buffers else None
+            if device_inputs is None and self.device in ["cuda", "mps"]:
+                device_inputs = {k: v.to(self.device) for k, v in inputs.items()}
+            if device_inputs is not None:
+                inputs = device_inputs
+            
+            # Generate（pad/eos token已在load_model中写入generation_config）
+            with torch.no_grad():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=max_new_tokens,
+                    use_cache=True,
+                    **decoding_kwargs
+                )
+        
+        # Decode：只解码新生成的部分
+        prompt_length = inputs["input_ids"].shape[1]
+        generated_texts = self.tokenizer.batch_decode(
+            outputs[:, prompt_length:],
+            skip_special_tokens=True
+        )
+        
+        # Extract answer - 使用与训练时相同的分隔符
+        return [text.split("Answer:")[-1].strip() for text in generated_texts]
+    
     def format_structured_answer(
         self,
         question: str,
@@ -471,6 +1671,7 @@ class QueryService:
         - 根据查询类型提供不同的答案格式
         - 添加置信度和响应时间信息
         - 提供用户友好的错误提示和建议
+        - 相同的匹配记录和置信度复用已格式化的结果
         
         Args:
             question: 原始问题
@@ -486,49 +1687,74 @@ class QueryService:
             if not matched_records:
                 return self._format_no_match_answer(question)
             
-            # 单个匹配记录
-            if len(matched_records) == 1:
-                return self._format_single_match_answer(matched_records[0], confidence)
-            
-            # 多个匹配记录
-            return self._format_multiple_match_answer(matched_records, confidence)
+            # 列表不可哈希，转换为元组作为缓存键；置信度保留3位小数以保证百分比显示不变
+            records_key = tuple(
+                (record['bank_name'], record['bank_code'], record.get('clearing_code') or '')
+                for record in matched_records
+            )
+            return _format_match_answer_cached(records_key, round(confidence, 3))
             
         except Exception as e:
             logger.error(f"答案格式化失败：{e}")
             return "抱歉，答案格式化时出现错误。"
     
+    # 无匹配答案的固定部分，按建议组合预先生成
+    _NO_MATCH_BASE = "抱歉，未找到匹配的银行信息。"
+    _NO_MATCH_TAIL = "\n\n您也可以尝试：\n• 使用银行全称（如：中国工商银行股份有限公司北京西单支行）\n• 包含具体地区信息（如：北京工商银行）"
+    
     def _format_no_match_answer(self, question: str) -> str:
         """
         格式化无匹配结果的答案
         
+        建议只取决于三个布尔条件，最多8种组合，结果按组合缓存复用。
+        
         Args:
             question: 原始问题
             
+        Returns:
+            无匹配结果的友好提示
+        """
+        return self._build_no_match_answer(
+            len(question) < 3,
+            not any(bank in question for bank in ["银行", "行"]),
+            not any(char.isdigit() for char in question)
+        )
+    
+    @classmethod
+    @lru_cache(maxsize=8)
+    def _build_no_match_answer(cls, too_short: bool, no_bank_word: bool, no_digit: bool) -> str:
+        """
+        按建议组合生成无匹配答案
+        
+        Args:
+            too_short: 问题是否过短
+            no_bank_word: 问题是否不含银行字样
+            no_digit: 问题是否不含数字
+            
         Returns:
             无匹配结果的友好提示
         """
         suggestions = []
         
         # 分析问题并提供建议
-        if len(question) < 3:
+        if too_short:
             suggestions.append("• 请提供更详细的银行名称或地区信息")
         
-        if not any(bank in question for bank in ["银行", "行"]):
+        if no_bank_word:
             suggestions.append("• 请确认查询的是银行机构")
         
-        if not any(char.isdigit() for char in question):
+        if no_digit:
             suggestions.append("• 如果您知道部分联行号，可以包含在查询中")
         
-        base_answer = "抱歉，未找到匹配的银行信息。"
+        base_answer = cls._NO_MATCH_BASE
         
         if suggestions:
             base_answer += "\n\n建议：\n" + "\n".join(suggestions)
         
-        base_answer += "\n\n您也可以尝试：\n• 使用银行全称（如：中国工商银行股份有限公司北京西单支行）\n• 包含具体地区信息（如：北京工商银行）"
-        
-        return base_answer
+        return base_answer + cls._NO_MATCH_TAIL
     
-    def _format_single_match_answer(self, record: Dict[str, str], confidence: float) -> str:
+    @staticmethod
+    def _format_single_match_answer(record: Dict[str, str], confidence: float) -> str:
         """
         格式化单个匹配结果的答案
         
@@ -554,7 +1780,8 @@ class QueryService:
         
         return answer
     
-    def _format_multiple_match_answer(self, records: List[Dict[str, str]], confidence: float) -> str:
+    @staticmethod
+    def _format_multiple_match_answer(records: List[Dict[str, str]], confidence: float) -> str:
         """
         格式化多个匹配结果的答案
         
@@ -565,21 +1792,22 @@ class QueryService:
         Returns:
             格式化的多个匹配答案
         """
-        answer = f"找到 {len(records)} 个可能的匹配结果：\n\n"
+        answer_parts = [f"找到 {len(records)} 个可能的匹配结果：\n\n"]
         
         for i, record in enumerate(records[:5], 1):  # 最多显示5个结果
-            answer += f"{i}. 🏦 {record['bank_name']}\n"
-            answer += f"   📋 联行号：{record['bank_code']}\n"
+            answer_parts.append(f"{i}. 🏦 {record['bank_name']}\n   📋 联行号：{record['bank_code']}\n")
             if record.get('clearing_code'):
-                answer += f"   🔢 清算代码：{record['clearing_code']}\n"
-            answer += "\n"
+                answer_parts.append(f"   🔢 清算代码：{record['clearing_code']}\n")
+            answer_parts.append("\n")
         
         if len(records) > 5:
-            answer += f"... 还有 {len(records) - 5} 个结果未显示\n\n"
+            answer_parts.append(f"... 还有 {len(records) - 5} 个结果未显示\n\n")
         
-        answer += "💡 提示：请选择最符合您需求的银行，或提供更具体的信息以获得精确匹配。"
+        answer_parts.append("💡 提示：请选择最符合您需求的银行，或提供更具体的信息以获得精确匹配。")
         
-        return answer
+        return "".join(answer_parts)
+    
+    def extract_bank_entities_with_small_model(self, question: str) -> Dict[str, Any]:
         """
         使用小模型进行银行实体提取
         
@@ -595,7 +1823,7 @@ class QueryService:
             Dict包含提取的实体：bank_name, location, branch_name等
         """
         try:
-            logger.info(f"Using small model for entity extraction: {question}")
+            logger.info("Using small model for entity extraction: {}", question)
             
             # TODO: 未来可以集成专门的NER小模型（如BERT-NER）
             # 现阶段使用规则提取，但架构已为小模型预留接口
@@ -603,87 +1831,27 @@ class QueryService:
             # 使用规则提取，模拟小模型NER的效果
             fallback_keywords = []
             
-            # 银行名称实体识别
-            bank_entities = {
-                "华夏银行": ["华夏银行"],
-                "中国农业银行": ["中国农业银行", "农业银行", "农行"],
-                "中国工商银行": ["中国工商银行", "工商银行", "工行"],
-                "中国建设银行": ["中国建设银行", "建设银行", "建行"],
-                "中国银行": ["中国银行", "中行"],
-                "交通银行": ["交通银行", "交行"],
-                "招商银行": ["招商银行", "招行"],
-                "中信银行": ["中信银行"],
-                "光大银行": ["光大银行"],
-                "民生银行": ["民生银行"],
-                "兴业银行": ["兴业银行"],
-                "浦发银行": ["浦发银行", "上海浦东发展银行"],
-                "平安银行": ["平安银行"],
-                "邮储银行": ["邮储银行", "邮政储蓄银行"],
-                "广发银行": ["广发银行"],
-                "渤海银行": ["渤海银行"],
-                "恒丰银行": ["恒丰银行"],
-                "浙商银行": ["浙商银行"]
-            }
-            
+            # 银行名称实体识别（按_BANK_ENTITY_ALIASES的优先级取第一个命中的别名）
             found_bank = None
-            for bank_name, aliases in bank_entities.items():
-                for alias in aliases:
-                    if alias in question:
-                        fallback_keywords.append(bank_name)
-                        if alias != bank_name:  # 添加别名用于搜索
-                            fallback_keywords.append(alias)
-                        found_bank = bank_name
-                        break
-                if found_bank:
+            matched_aliases = _find_bank_aliases(question)
+            for bank_name, aliases in _BANK_ENTITY_ALIASES:
+                alias = next((a for a in aliases if a in matched_aliases), None)
+                if alias:
+                    fallback_keywords.append(bank_name)
+                    if alias != bank_name:  # 添加别名用于搜索
+                        fallback_keywords.append(alias)
+                    found_bank = bank_name
                     break
             
             # 地理位置实体识别
-            import re
-            location_patterns = [
-                # 直辖市
-                r'(北京|上海|天津|重庆)',
-                # 省会城市和重要城市
-                r'(厦门|深圳|青岛|大连|宁波|苏州|无锡|常州|南京|杭州|温州|嘉兴|湖州|绍兴|金华|衢州|舟山|台州|丽水)',
-                r'(合肥|芜湖|蚌埠|淮南|马鞍山|淮北|铜陵|安庆|黄山|滁州|阜阳|宿州|六安|亳州|池州|宣城)',
-                r'(福州|莆田|三明|泉州|漳州|南平|龙岩|宁德)',
-                r'(南昌|景德镇|萍乡|九江|新余|鹰潭|赣州|吉安|宜春|抚州|上饶)',
-                r'(济南|淄博|枣庄|东营|烟台|潍坊|济宁|泰安|威海|日照|莱芜|临沂|德州|聊城|滨州|菏泽)',
-                r'(郑州|开封|洛阳|平顶山|安阳|鹤壁|新乡|焦作|濮阳|许昌|漯河|三门峡|南阳|商丘|信阳|周口|驻马店)',
-                r'(武汉|黄石|十堰|宜昌|襄阳|鄂州|荆门|孝感|荆州|黄冈|咸宁|随州|恩施)',
-                r'(长沙|株洲|湘潭|衡阳|邵阳|岳阳|常德|张家界|益阳|郴州|永州|怀化|娄底)',
-                r'(广州|韶关|珠海|汕头|佛山|江门|湛江|茂名|肇庆|惠州|梅州|汕尾|河源|阳江|清远|东莞|中山|潮州|揭阳|云浮)',
-                r'(南宁|柳州|桂林|梧州|北海|防城港|钦州|贵港|玉林|百色|贺州|河池|来宾|崇左)',
-                r'(海口|三亚|三沙|儋州)',
-                r'(成都|自贡|攀枝花|泸州|德阳|绵阳|广元|遂宁|内江|乐山|南充|眉山|宜宾|广安|达州|雅安|巴中|资阳|江油)',
-                r'(贵阳|六盘水|遵义|安顺|毕节|铜仁)',
-                r'(昆明|曲靖|玉溪|保山|昭通|丽江|普洱|临沧)',
-                r'(拉萨|昌都|山南|日喀则|那曲|阿里|林芝)',
-                r'(西安|铜川|宝鸡|咸阳|渭南|延安|汉中|榆林|安康|商洛)',
-                r'(兰州|嘉峪关|金昌|白银|天水|武威|张掖|平凉|酒泉|庆阳|定西|陇南)',
-                r'(西宁|海东)',
-                r'(银川|石嘴山|吴忠|固原|中卫)',
-                r'(乌鲁木齐|克拉玛依|吐鲁番|哈密)',
-                # 县级市和特殊地名
-                r'([^市县区镇]{2,8}[市县区镇])'
-            ]
-            
-            found_location = None
-            for pattern in location_patterns:
-                location_match = re.search(pattern, question)
-                if location_match:
-                    found_location = location_match.group(1)
-                    fallback_keywords.append(found_location)
-                    break
+            found_location = _match_location(question)
+            if found_location:
+                fallback_keywords.append(found_location)
             
             # 支行名称实体识别
-            branch_patterns = [
-                r'([^银行]{1,10}支行)',
-                r'([^银行]{1,10}分行)',
-            ]
-            
             found_branch = None
-            for pattern in branch_patterns:
-                branch_match = re.search(pattern, question)
+            for pattern in _ENTITY_BRANCH_PATTERNS:
+                branch_match = pattern.search(question)
                 if branch_match:
                     branch_name = branch_match.group(1)
                     if '支行' in branch_name:
@@ -707,7 +1875,7 @@ class QueryService:
                 "keywords": fallback_keywords if fallback_keywords else [question]
             }
             
-            logger.info(f"Small model entity extraction result: {result}")
+            logger.info("Small model entity extraction result: {}", result)
             return result
             
         except Exception as e:
@@ -719,7 +1887,8 @@ class QueryService:
         question: str,
         rag_results: List[Dict[str, str]],
         max_new_tokens: int = 128,
-        temperature: float = 0.1
+        temperature: float = 0.1,
+        parse: Optional[QueryParse] = None
     ) -> str:
         """
         使用小模型基于RAG结果生成最终答案 - 优化版本
@@ -735,6 +1904,7 @@ class QueryService:
             rag_results: RAG检索结果
             max_new_tokens: 最大生成token数
             temperature: 生成温度
+            parse: 已有的问题解析结果（可选，未提供时从问题中提取实体）
             
         Returns:
             格式化的答案
@@ -743,6 +1913,12 @@ class QueryService:
             if not rag_results:
                 return "抱歉，未找到相关银行信息。请尝试使用更具体的银行名称或地区信息。"
             
+            # 问题中包含完整的银行名称时检索结果即答案，跳过实体提取和综合评分
+            exact_match = self._find_exact_name_match(question, rag_results)
+            if exact_match is not None:
+                logger.info("问题包含完整银行名称，直接返回：{}", exact_match['bank_name'])
+                return self._format_single_answer(exact_match, 1.0)
+            
             # 如果只有一个结果，进行质量检查后返回
             if len(rag_results) == 1:
                 bank = rag_results[0]
@@ -755,24 +1931,31 @@ class QueryService:
                     return self._format_low_confidence_answer(bank, confidence)
             
             # 多个结果时，使用优化的智能匹配算法
-            logger.info(f"优化答案生成：从{len(rag_results)}个结果中选择最佳匹配，问题：{question}")
+            logger.info("优化答案生成：从{}个结果中选择最佳匹配，问题：{}", len(rag_results), question)
             
             # 提取问题中的关键信息（增强版本）
-            question_entities = self._extract_enhanced_entities(question)
-            logger.info(f"增强实体提取结果：{question_entities}")
+            if parse is not None:
+                question_entities = parse.enhanced_entities
+            else:
+                question_entities = self._extract_enhanced_entities(question)
+            logger.info("增强实体提取结果：{}", question_entities)
             
-            # 计算每个结果的综合匹配分数
+            # 计算每个结果的综合匹配分数（特征标签和评分用的实体元组每次查询只生成一次）
+            feature_labels = self._build_feature_labels(question_entities)
+            entity_key = self._build_entity_key(question_entities)
             scored_results = []
             for bank in rag_results:
-                match_score = self._calculate_comprehensive_match_score(question, question_entities, bank)
+                match_score = self._calculate_comprehensive_match_score(
+                    question, question_entities, bank, feature_labels, entity_key
+                )
                 scored_results.append((bank, match_score))
             
             # 按分数排序并选择最佳匹配
             scored_results.sort(key=lambda x: x[1]['total_score'], reverse=True)
             
             best_match, best_score_info = scored_results[0]
-            logger.info(f"最佳匹配选择：{best_match['bank_name']} "
-                       f"(总分：{best_score_info['total_score']:.2f}，置信度：{best_score_info['confidence']:.2f})")
+            logger.info("最佳匹配选择：{} (总分：{:.2f}，置信度：{:.2f})",
+                       best_match['bank_name'], best_score_info['total_score'], best_score_info['confidence'])
             
             # 根据匹配质量决定返回策略
             return self._generate_optimized_answer(question, scored_results, best_score_info)
@@ -781,6 +1964,37 @@ class QueryService:
             logger.error(f"优化答案生成失败：{e}")
             return "抱歉，生成答案时出现错误。请稍后重试或联系技术支持。"
     
+    @staticmethod
+    def _find_exact_name_match(
+        question: str,
+        rag_results: List[Dict[str, str]]
+    ) -> Optional[Dict[str, str]]:
+        """
+        查找名称完整出现在问题中的检索结果（有多个时取名称最长的）
+        
+        去掉该名称后问题中仍有地区或支行/分行等限定时，用户要找的是更具体的网点，不算精确命中。
+        
+        Returns:
+            精确命中的银行记录，没有时返回None
+        """
+        best_match = None
+        for bank in rag_results:
+            bank_name = bank.get('bank_name')
+            if bank_name and bank_name in question and (
+                best_match is None or len(bank_name) > len(best_match['bank_name'])
+            ):
+                best_match = bank
+        
+        if best_match is None:
+            return None
+        
+        remainder = question.replace(best_match['bank_name'], " ")
+        if _match_location(remainder) or any(
+            pattern.search(remainder) for pattern in _ENHANCED_BRANCH_PATTERNS
+        ):
+            return None
+        return best_match
+    
     def _extract_enhanced_entities(self, question: str) -> Dict[str, Any]:
         """
         增强的实体提取，支持更精确的银行信息识别
@@ -791,8 +2005,6 @@ class QueryService:
         Returns:
             增强的实体信息字典
         """
-        import re
-        
         entities = {
             'bank_names': [],
             'locations': [],
@@ -809,60 +2021,27 @@ class QueryService:
             entities['keywords'].append(question.strip())
         
         # 银行名称识别（扩展版本）
-        bank_patterns = {
-            '中国工商银行': ['工商银行', '工行', 'ICBC', '中国工商'],
-            '中国农业银行': ['农业银行', '农行', 'ABC', '中国农业'],
-            '中国银行': ['中行', 'BOC', '中银'],
-            '中国建设银行': ['建设银行', '建行', 'CCB', '中国建设'],
-            '交通银行': ['交行', 'BOCOM', '交通'],
-            '招商银行': ['招行', 'CMB', '招商'],
-            '浦发银行': ['上海浦东发展银行', 'SPDB', '浦东发展'],
-            '中信银行': ['中信', 'CITIC'],
-            '光大银行': ['中国光大银行', 'CEB', '光大'],
-            '华夏银行': ['华夏', 'HXB'],
-            '民生银行': ['中国民生银行', 'CMBC', '民生'],
-            '广发银行': ['广发', 'CGB', '广东发展银行'],
-            '平安银行': ['平安', 'PAB'],
-            '兴业银行': ['兴业', 'CIB'],
-            '邮储银行': ['邮政储蓄银行', 'PSBC', '邮储', '邮政银行']
-        }
-        
-        for full_name, aliases in bank_patterns.items():
+        for full_name, aliases in _ENHANCED_BANK_ALIASES:
             if full_name in question:
                 entities['bank_names'].append(full_name)
-                entities['keywords'].extend([full_name] + aliases)
+                entities['keywords'].append(full_name)
+                entities['keywords'].extend(aliases)
                 break
             else:
                 for alias in aliases:
                     if alias in question:
                         entities['bank_names'].append(full_name)
-                        entities['keywords'].extend([full_name, alias])
+                        entities['keywords'].extend((full_name, alias))
                         break
         
         # 地理位置识别（增强版本）
-        location_patterns = [
-            # 直辖市和省会
-            r'(北京|上海|天津|重庆|广州|深圳|成都|武汉|西安|南京|杭州)',
-            # 重要城市
-            r'(苏州|青岛|大连|宁波|厦门|无锡|常州|温州|佛山|东莞|中山)',
-            # 商业区和地标
-            r'(西单|王府井|中关村|国贸|金融街|陆家嘴|外滩|珠江新城|福田|南山)'
-        ]
-        
-        for pattern in location_patterns:
-            matches = re.findall(pattern, question)
-            entities['locations'].extend(matches)
-            entities['keywords'].extend(matches)
+        matches = _ENHANCED_LOCATION_RE.findall(question)
+        entities['locations'].extend(matches)
+        entities['keywords'].extend(matches)
         
         # 支行类型识别
-        branch_patterns = [
-            r'([^银行]{1,15}支行)',
-            r'([^银行]{1,15}分行)',
-            r'(营业部|营业厅|分理处|储蓄所)'
-        ]
-        
-        for pattern in branch_patterns:
-            matches = re.findall(pattern, question)
+        for pattern in _ENHANCED_BRANCH_PATTERNS:
+            matches = pattern.findall(question)
             entities['branch_types'].extend(matches)
             entities['keywords'].extend(matches)
         
@@ -878,11 +2057,59 @@ class QueryService:
         
         return entities
     
+    # 匹配特征标签前缀（驻留字符串，所有查询共享）
+    _FEATURE_PREFIXES = {
+        'keywords': sys.intern('关键词:'),
+        'bank_names': sys.intern('银行匹配:'),
+        'locations': sys.intern('地理位置:'),
+        'branch_types': sys.intern('支行类型:'),
+    }
+    
+    def _build_feature_labels(self, entities: Dict[str, Any]) -> Dict[str, Dict[str, str]]:
+        """
+        为一次查询的实体预先生成匹配特征标签
+        
+        每个实体的标签只拼接一次，评分循环中直接复用，避免每个候选重复构造字符串。
+        
+        Args:
+            entities: 提取的实体信息
+            
+        Returns:
+            {实体类别: {实体: 特征标签}}
+        """
+        return {
+            category: {entity: prefix + entity for entity in entities[category]}
+            for category, prefix in self._FEATURE_PREFIXES.items()
+        }
+    
+    @staticmethod
+    def _build_entity_key(entities: Dict[str, Any]) -> Tuple[Any, ...]:
+        """
+        将一次查询的实体转换为_score_candidate的参数元组
+        
+        与候选银行无关，评分循环外构建一次；长度不足2的关键词不可能计分，提前去掉。
+        
+        Args:
+            entities: 提取的实体信息
+            
+        Returns:
+            (是否完整名称, 关键词, 银行名称, 地理位置, 支行类型)
+        """
+        return (
+            entities['is_full_name'],
+            tuple(keyword for keyword in entities['keywords'] if len(keyword) >= 2),
+            tuple(entities['bank_names']),
+            tuple(entities['locations']),
+            tuple(entities['branch_types'])
+        )
+    
     def _calculate_comprehensive_match_score(
         self, 
         question: str, 
         entities: Dict[str, Any], 
-        bank: Dict[str, str]
+        bank: Dict[str, str],
+        feature_labels: Optional[Dict[str, Dict[str, str]]] = None,
+        entity_key: Optional[Tuple[Any, ...]] = None
     ) -> Dict[str, Any]:
         """
         计算综合匹配分数，考虑多个维度
@@ -891,60 +2118,35 @@ class QueryService:
             question: 原始问题
             entities: 提取的实体信息
             bank: 银行记录
+            feature_labels: 预先生成的匹配特征标签（可选，未提供时按实体生成）
+            entity_key: 预先构建的实体参数元组（可选，未提供时按实体生成）
             
         Returns:
             包含详细分数信息的字典
         """
-        bank_name = bank['bank_name']
-        bank_name_lower = bank_name.lower()
-        question_lower = question.lower()
+        if feature_labels is None:
+            feature_labels = self._build_feature_labels(entities)
+        if entity_key is None:
+            entity_key = self._build_entity_key(entities)
+        
+        (exact_score, semantic_score, location_score, branch_score,
+         penalty_score, matched) = _score_candidate(bank['bank_name'], question, *entity_key)
         
         score_info = {
-            'exact_match_score': 0,
-            'semantic_score': 0,
-            'location_score': 0,
-            'branch_score': 0,
-            'penalty_score': 0,
+            'exact_match_score': exact_score,
+            'semantic_score': semantic_score,
+            'location_score': location_score,
+            'branch_score': branch_score,
+            'penalty_score': penalty_score,
             'rag_score': 0,
             'total_score': 0,
             'confidence': 0,
-            'matched_features': []
+            'matched_features': [
+                feature_labels[category][entity] if category else '完全匹配'
+                for category, entity in matched
+            ]
         }
         
-        # 1. 精确匹配分数（最高权重）
-        if entities['is_full_name'] and question.strip() == bank_name:
-            score_info['exact_match_score'] = 10000
-            score_info['matched_features'].append('完全匹配')
-        else:
-            # 关键词精确匹配
-            for keyword in entities['keywords']:
-                if len(keyword) >= 2 and keyword.lower() in bank_name_lower:
-                    score_info['exact_match_score'] += len(keyword) * 100
-                    score_info['matched_features'].append(f'关键词:{keyword}')
-        
-        # 2. 语义匹配分数
-        for bank_name_entity in entities['bank_names']:
-            if bank_name_entity in bank_name:
-                score_info['semantic_score'] += 1000
-                score_info['matched_features'].append(f'银行匹配:{bank_name_entity}')
-        
-        # 3. 地理位置匹配分数
-        for location in entities['locations']:
-            if location in bank_name:
-                score_info['location_score'] += 500
-                score_info['matched_features'].append(f'地理位置:{location}')
-        
-        # 4. 支行类型匹配分数
-        for branch_type in entities['branch_types']:
-            if branch_type in bank_name:
-                score_info['branch_score'] += 300
-                score_info['matched_features'].append(f'支行类型:{branch_type}')
-        
-        # 5. 惩罚分数（长度差异过大、无关匹配等）
-        length_diff = abs(len(question) - len(bank_name))
-        if length_diff > 30:
-            score_info['penalty_score'] -= length_diff * 2
-        
         # 6. RAG检索分数
         if 'final_score' in bank:
             score_info['rag_score'] = bank['final_score'] * 50
@@ -987,11 +2189,13 @@ class QueryService:
         # 高度相似
         elif question_lower in bank_name_lower or bank_name_lower in question_lower:
             confidence = 0.9
-        # 关键词匹配
+        # 关键词匹配：bigram签名的Jaccard相似度
         else:
-            common_chars = set(question_lower) & set(bank_name_lower)
-            if len(common_chars) > 0:
-                confidence = len(common_chars) / max(len(set(question_lower)), len(set(bank_name_lower)))
+            question_sig = _bigram_signature(question_lower)
+            bank_sig = _bigram_signature(bank_name_lower)
+            union = _popcount(question_sig | bank_sig)
+            if union:
+                confidence = _popcount(question_sig & bank_sig) / union
         
         # RAG分数加成
         if 'final_score' in bank and bank['final_score'] > 0:
@@ -1059,17 +2263,20 @@ class QueryService:
         
         # 低置信度：返回多个候选结果
         else:
-            top_results = scored_results[:min(3, len(scored_results))]
-            answer_parts = ["找到以下可能的匹配结果："]
-            
-            for i, (bank, score_info) in enumerate(top_results):
-                confidence_str = f"匹配度: {score_info['confidence']:.1%}"
-                answer_parts.append(f"{i+1}. {bank['bank_name']}: {bank['bank_code']} ({confidence_str})")
-            
-            answer_parts.append("请选择最符合您需求的银行。")
+            answer_parts = [
+                "找到以下可能的匹配结果：",
+                *(f"{i}. {bank['bank_name']}: {bank['bank_code']} (匹配度: {score_info['confidence']:.1%})"
+                  for i, (bank, score_info) in enumerate(scored_results[:3], 1)),
+                "请选择最符合您需求的银行。"
+            ]
             return "\n".join(answer_parts)
 
-    def retrieve_relevant_banks(self, question: str, top_k: int = 5) -> List[Dict[str, str]]:
+    def retrieve_relevant_banks(
+        self,
+        question: str,
+        top_k: int = 5,
+        parse: Optional[QueryParse] = None
+    ) -> List[Dict[str, str]]:
         """
         Retrieve relevant bank records from database based on question
         
@@ -1078,73 +2285,38 @@ class QueryService:
         Args:
             question: User's question
             top_k: Number of top results to return
+            parse: 已有的问题解析结果（可选，未提供时从问题中提取实体）
         
         Returns:
             List of relevant bank records with name and code
         """
         try:
-            logger.info(f"RAG: Starting retrieval for question: {question[:50]}...")
+            logger.info("RAG: Starting retrieval for question: {:.50}...", question)
             
             # 使用小模型提取银行实体
-            entities = self.extract_bank_entities_with_small_model(question)
+            if parse is not None:
+                entities = parse.entities
+            else:
+                entities = self.extract_bank_entities_with_small_model(question)
             keywords = entities.get("keywords", [])
             
-            logger.info(f"RAG: LLM extracted entities: {entities}")
-            logger.info(f"RAG: Using keywords for search: {keywords}")
+            logger.info("RAG: LLM extracted entities: {}", entities)
+            logger.info("RAG: Using keywords for search: {}", keywords)
             
             if not keywords:
                 logger.warning("RAG: No keywords extracted")
                 return []
             
-            # 构建更智能的搜索策略
-            results = []
-            seen_banks = set()
-            
-            # 优先搜索组合关键词
-            if len(keywords) >= 2:
-                for i in range(len(keywords)):
-                    for j in range(i+1, len(keywords)):
-                        combined_query = f"%{keywords[i]}%{keywords[j]}%"
-                        logger.info(f"RAG: Searching with combined pattern: {combined_query}")
-                        
-                        records = self.db.query(BankCode).filter(
-                            BankCode.bank_name.like(combined_query)
-                        ).limit(top_k).all()
-                        
-                        logger.info(f"RAG: Found {len(records)} records for combined pattern")
-                        for record in records:
-                            if record.bank_name not in seen_banks:
-                                results.append({
-                                    "bank_name": record.bank_name,
-                                    "bank_code": record.bank_code,
-                                    "clearing_code": record.clearing_code
-                                })
-                                seen_banks.add(record.bank_name)
-            
-            # 如果组合搜索结果不够，使用单个关键词搜索
-            if len(results) < top_k:
-                for keyword in keywords:
-                    if len(keyword) >= 2:  # 只使用2字以上的关键词
-                        logger.info(f"RAG: Searching for single keyword: {keyword}")
-                        records = self.db.query(BankCode).filter(
-                            BankCode.bank_name.contains(keyword)
-                        ).limit(top_k).all()
-                        
-                        logger.info(f"RAG: Found {len(records)} records for keyword '{keyword}'")
-                        for record in records:
-                            if record.bank_name not in seen_banks and len(results) < top_k:
-                                results.append({
-                                    "bank_name": record.bank_name,
-                                    "bank_code": record.bank_code,
-                                    "clearing_code": record.clearing_code
-                                })
-                                seen_banks.add(record.bank_name)
+            # 优先使用全文索引：一次查询按相关度排序
+            results = self._fts_retrieve(keywords, top_k)
+            if results is None:
+                results = self._like_retrieve(keywords, top_k)
             
             # 返回结果
             final_results = results[:top_k]
-            logger.info(f"RAG: Returning {len(final_results)} results")
+            logger.info("RAG: Returning {} results", len(final_results))
             for i, result in enumerate(final_results):
-                logger.info(f"RAG: Result {i+1}: {result['bank_name']} -> {result['bank_code']}")
+                logger.info("RAG: Result {}: {} -> {}", i + 1, result['bank_name'], result['bank_code'])
             
             return final_results
         
@@ -1152,6 +2324,115 @@ class QueryService:
             logger.error(f"Failed to retrieve relevant banks: {e}")
             return []
     
+    def _fts_retrieve(self, keywords: List[str], top_k: int) -> Optional[List[Dict[str, str]]]:
+        """
+        使用bank_name_fts全文索引检索（见migrate_add_bank_name_fts.py）
+        
+        所有关键词都必须出现在银行名称中（与LIKE检索的组合模式一致，保留地名、支行等约束）：
+        3个字符以上的关键词用trigram全文索引AND匹配，更短的关键词作为LIKE条件过滤。
+        全文索引不存在、没有可用关键词或未检索到结果时返回None，由调用方回退到LIKE检索。
+        
+        Args:
+            keywords: 提取的关键词
+            top_k: 返回结果数量
+        
+        Returns:
+            按相关度排序的银行记录；不可用时返回None
+        """
+        unique_keywords = [kw for kw in dict.fromkeys(keywords) if kw]
+        fts_terms = [kw for kw in unique_keywords if len(kw) >= 3]
+        short_terms = [kw for kw in unique_keywords if len(kw) < 3]
+        if not fts_terms or not self._has_bank_name_fts():
+            return None
+        
+        # 长关键词作为短语AND组合交给全文索引，短关键词（trigram无法索引）在关联的bank_codes行上过滤
+        match_query = " AND ".join('"' + kw.replace('"', '""') + '"' for kw in fts_terms)
+        params = {"query": match_query, "top_k": top_k}
+        like_filters = []
+        for i, kw in enumerate(short_terms):
+            params[f"kw{i}"] = "%" + kw.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            like_filters.append(f" AND b.bank_name LIKE :kw{i} ESCAPE '\\'")
+        try:
+            rows = self.db.execute(
+                text(
+                    "SELECT b.bank_name, b.bank_code, b.clearing_code "
+                    "FROM bank_name_fts f JOIN bank_codes b ON b.id = f.rowid "
+                    "WHERE bank_name_fts MATCH :query" + "".join(like_filters) +
+                    " ORDER BY f.rank LIMIT :top_k"
+                ),
+                params
+            ).all()
+        except Exception as e:
+            logger.warning(f"RAG: FTS search failed, falling back to LIKE search: {e}")
+            return None
+        
+        logger.info("RAG: FTS query '{}' (short keywords: {}) returned {} records",
+                    match_query, short_terms, len(rows))
+        if not rows:
+            # 全部关键词同时命中的记录不存在时，交给LIKE检索做组合/单关键词的逐级放宽
+            return None
+        return [_bank_record(row) for row in rows]
+    
+    def _has_bank_name_fts(self) -> bool:
+        """检查全文索引表是否存在（结果在实例上缓存）"""
+        if self._bank_name_fts_available is None:
+            try:
+                self._bank_name_fts_available = self.db.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='bank_name_fts'")
+                ).first() is not None
+            except Exception as e:
+                logger.warning(f"Could not check bank_name_fts table: {e}")
+                self._bank_name_fts_available = False
+        return self._bank_name_fts_available
+    
+    def _like_retrieve(self, keywords: List[str], top_k: int) -> List[Dict[str, str]]:
+        """
+        使用LIKE模式匹配检索（未建立全文索引时的回退路径）
+        
+        Args:
+            keywords: 提取的关键词
+            top_k: 返回结果数量
+        
+        Returns:
+            银行记录列表
+        """
+        results = []
+        seen_banks = set()
+        
+        # 优先搜索组合关键词
+        if len(keywords) >= 2:
+            for i in range(len(keywords)):
+                for j in range(i+1, len(keywords)):
+                    combined_query = f"%{keywords[i]}%{keywords[j]}%"
+                    logger.info("RAG: Searching with combined pattern: {}", combined_query)
+                    
+                    records = self.db.query(*_BANK_RESULT_COLUMNS).filter(
+                        BankCode.bank_name.like(combined_query)
+                    ).limit(top_k).all()
+                    
+                    logger.info("RAG: Found {} records for combined pattern", len(records))
+                    for record in records:
+                        if record.bank_name not in seen_banks:
+                            results.append(_bank_record(record))
+                            seen_banks.add(record.bank_name)
+        
+        # 如果组合搜索结果不够，使用单个关键词搜索
+        if len(results) < top_k:
+            for keyword in keywords:
+                if len(keyword) >= 2:  # 只使用2字以上的关键词
+                    logger.info("RAG: Searching for single keyword: {}", keyword)
+                    records = self.db.query(*_BANK_RESULT_COLUMNS).filter(
+                        BankCode.bank_name.contains(keyword)
+                    ).limit(top_k).all()
+                    
+                    logger.info("RAG: Found {} records for keyword '{}'", len(records), keyword)
+                    for record in records:
+                        if record.bank_name not in seen_banks and len(results) < top_k:
+                            results.append(_bank_record(record))
+                            seen_banks.add(record.bank_name)
+        
+        return results
+    
     def extract_bank_codes(self, answer: str) -> List[Dict[str, str]]:
         """
         Extract bank code information from answer
@@ -1162,37 +2443,53 @@ class QueryService:
         Returns:
             List of extracted bank code records
         """
-        extracted_records = []
+        # 较长的答案（包含银行信息的结构化答案）按答案文本缓存提取结果，与查询缓存同样按TTL过期
+        cacheable = len(answer) >= self.MIN_CACHED_ANSWER_LENGTH
+        if cacheable:
+            with self._code_cache_lock:
+                entry = self._code_cache.get(answer)
+                if entry is not None and time.time() - entry[1] < self.cache_ttl:
+                    self._code_cache.move_to_end(answer)
+                    return [dict(record) for record in entry[0]]
+        
+        extracted_records = self._lookup_bank_codes(answer)
+        
+        if cacheable:
+            with self._code_cache_lock:
+                self._code_cache[answer] = ([dict(record) for record in extracted_records], time.time())
+                self._code_cache.move_to_end(answer)
+                while len(self._code_cache) > self.max_code_cache_size:
+                    self._code_cache.popitem(last=False)
         
-        # Pattern to match 12-digit bank codes
-        code_pattern = r'\b\d{12}\b'
-        codes = re.findall(code_pattern, answer)
+        return extracted_records
+    
+    def _lookup_bank_codes(self, answer: str) -> List[Dict[str, str]]:
+        """从答案中提取联行号并在数据库中查找对应记录（不使用缓存）"""
+        codes = _BANK_CODE_RE.findall(answer)
+        if not codes:
+            return []
+        
+        # Look up all codes in one query (by bank_code or clearing_code)
+        unique_codes = list(dict.fromkeys(codes))
+        rows = self.db.query(*_BANK_RESULT_COLUMNS).filter(
+            or_(
+                BankCode.bank_code.in_(unique_codes),
+                BankCode.clearing_code.in_(unique_codes)
+            )
+        ).all()
+        
+        by_bank_code = {}
+        by_clearing_code = {}
+        for row in rows:
+            by_bank_code.setdefault(row.bank_code, row)
+            by_clearing_code.setdefault(row.clearing_code, row)
         
-        # Look up codes in database
+        # 按答案中出现的顺序组装结果，bank_code匹配优先于clearing_code
+        extracted_records = []
         for code in codes:
-            # Try to find by bank_code
-            record = self.db.query(BankCode).filter(
-                BankCode.bank_code == code
-            ).first()
-            
+            record = by_bank_code.get(code) or by_clearing_code.get(code)
             if record:
-                extracted_records.append({
-                    "bank_name": record.bank_name,
-                    "bank_code": record.bank_code,
-                    "clearing_code": record.clearing_code
-                })
-            else:
-                # Try to find by clearing_code
-                record = self.db.query(BankCode).filter(
-                    BankCode.clearing_code == code
-                ).first()
-                
-                if record:
-                    extracted_records.append({
-                        "bank_name": record.bank_name,
-                        "bank_code": record.bank_code,
-                        "clearing_code": record.clearing_code
-                    })
+                extracted_records.append(_bank_record(record))
         
         return extracted_records
     
@@ -1211,29 +2508,51 @@ class QueryService:
         Returns:
             Confidence score (0.0-1.0)
         """
-        # Simple heuristic-based confidence calculation
-        confidence = 0.0
-        
-        # If we found bank codes, increase confidence
-        if extracted_records:
-            confidence += 0.5
+        # 只取决于答案文本和是否提取到记录；较长的答案按这两者缓存
+        if len(answer) >= self.MIN_CACHED_ANSWER_LENGTH:
+            return _answer_confidence_cached(answer, bool(extracted_records))
+        return _answer_confidence(answer, bool(extracted_records))
+    
+    # 答案缓存的最小长度：短答案（如无结果提示）计算代价低，不占用缓存
+    MIN_CACHED_ANSWER_LENGTH = 64
+    
+    # 运行异步RAG检索用的线程池（所有实例共享）：仅当调用线程中已有运行中的事件循环
+    # （异步接口直接调用query/batch_query）时使用，其他情况在调用线程中直接运行
+    _retrieval_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="query-retrieval")
+    
+    @classmethod
+    def _run_coroutine(cls, coroutine: Any) -> Any:
+        """
+        在同步代码中运行协程并返回结果
         
-        # If answer contains specific keywords, increase confidence
-        positive_keywords = ["联行号", "银行", "清算", "分行"]
-        for keyword in positive_keywords:
-            if keyword in answer:
-                confidence += 0.1
+        调用线程中没有运行中的事件循环时直接asyncio.run；否则（不能嵌套运行事件循环）
+        交给检索线程池运行并等待结果。
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        return cls._retrieval_executor.submit(asyncio.run, coroutine).result()
+    
+    def _retrieve_banks(self, parse: QueryParse) -> List[Dict[str, Any]]:
+        """
+        执行查询的银行检索
         
-        # If answer contains negative keywords, decrease confidence
-        negative_keywords = ["不确定", "可能", "也许", "未找到", "不知道"]
-        for keyword in negative_keywords:
-            if keyword in answer:
-                confidence -= 0.2
+        优先使用向量RAG系统，失败时降级到关键词检索（使用当前线程的数据库会话）。
         
-        # Clamp to [0.0, 1.0]
-        confidence = max(0.0, min(1.0, confidence))
+        Args:
+            parse: 问题解析结果
         
-        return confidence
+        Returns:
+            检索到的银行记录
+        """
+        question = parse.question
+        try:
+            return self._run_coroutine(self.rag_service.retrieve_relevant_banks(question, top_k=5))
+        except Exception as rag_error:
+            logger.warning(f"Vector RAG failed, falling back to keyword search: {rag_error}")
+            # 降级到原有的关键词检索
+            return self.retrieve_relevant_banks(question, top_k=5, parse=parse)
     
     def query(
         self,
@@ -1256,134 +2575,31 @@ class QueryService:
         Raises:
             QueryServiceError: If query processing fails
         """
-        start_time = time.time()
+        start_ns = time.perf_counter_ns()  # 单调时钟，只用于计算响应时间
         self._total_queries += 1
         
         try:
-            # 性能优化：检查缓存
+            # 性能优化：检查缓存（精确缓存未命中时再查语义缓存）
+            parse = QueryParse(self, question)
+            question_embedding = None
             cached_result = self._get_cached_result(question)
+            if not cached_result:
+                cached_result, question_embedding = self._get_semantic_cached_result(parse)
             if cached_result:
-                # 更新响应时间（缓存命中很快）
-                cached_result['response_time'] = (time.time() - start_time) * 1000
-                
-                # 记录查询日志（如果需要）
-                if log_query and user_id:
-                    self._log_query(
-                        user_id=user_id,
-                        question=question,
-                        answer=cached_result['answer'],
-                        confidence=cached_result['confidence'],
-                        response_time=cached_result['response_time']
-                    )
-                
-                return cached_result
-            # RAG: Retrieve relevant banks using new vector-based RAG system
-            context = None
-            retrieved_banks = []
-            logger.info(f"RAG enabled: {use_rag}")
-            if use_rag:
-                # 使用新的向量RAG系统
-                import asyncio
-                try:
-                    # 在同步函数中运行异步RAG检索
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    retrieved_banks = loop.run_until_complete(
-                        self.rag_service.retrieve_relevant_banks(question, top_k=5)
-                    )
-                    loop.close()
-                except Exception as rag_error:
-                    logger.warning(f"Vector RAG failed, falling back to keyword search: {rag_error}")
-                    # 降级到原有的关键词检索
-                    retrieved_banks = self.retrieve_relevant_banks(question, top_k=5)
-                
-                if retrieved_banks:
-                    # Format context for the model
-                    context_lines = []
-                    for bank in retrieved_banks:
-                        context_lines.append(
-                            f"{bank['bank_name']}: {bank['bank_code']}"
-                        )
-                    context = "\n".join(context_lines)
-                    logger.info(f"RAG: Retrieved {len(retrieved_banks)} relevant banks")
-                    logger.info(f"RAG Context: {context[:200]}...")
-                else:
-                    logger.warning("RAG: No relevant banks found")
-            else:
-                logger.info("RAG: Disabled by request")
-            
-            # 使用优化的小模型答案生成算法
-            if retrieved_banks:
-                logger.info("使用优化的答案生成算法...")
-                answer = self.generate_answer_with_small_model(question, retrieved_banks)
+                # 归一化命中的可能是不同写法的问题：返回副本，保留本次的原始问题并更新响应时间
+                response = dict(
+                    cached_result,
+                    question=question,
+                    response_time=(time.perf_counter_ns() - start_ns) / 1e6
+                )
+                # 缓存命中只记录已登录用户的查询
+                log_query = log_query and bool(user_id)
             else:
-                # 使用优化的无匹配答案格式化
-                answer = self._format_no_match_answer(question)
-            
-            # 记录生成的答案（调试用）
-            logger.info(f"优化答案生成完成（前200字符）：{answer[:200]}")
-            
-            # Extract bank codes
-            matched_records = self.extract_bank_codes(answer)
-            
-            # 记录提取结果
-            logger.info(f"从答案中提取了{len(matched_records)}条银行记录")
-            
-            if len(matched_records) == 0:
-                logger.warning("未从答案中提取到银行代码")
-                # 如果有RAG结果但未提取到代码，使用RAG结果
-                if retrieved_banks:
-                    matched_records = retrieved_banks[:1]  # 使用最佳匹配
-                    logger.info("使用RAG检索结果作为匹配记录")
-            
-            # Calculate confidence with RAG enhancement
-            confidence = self.calculate_confidence(answer, matched_records)
-            
-            # 如果有RAG结果，调整置信度
-            if retrieved_banks and 'final_score' in retrieved_banks[0]:
-                rag_confidence = min(1.0, retrieved_banks[0]['final_score'] / 10.0)
-                confidence = max(confidence, rag_confidence)
-                logger.info(f"RAG置信度调整：{rag_confidence:.3f}")
-            
-            # 使用新的结构化答案格式化（如果有匹配记录）
-            if matched_records:
-                try:
-                    formatted_answer = self.format_structured_answer(
-                        question, matched_records, confidence, 0
-                    )
-                    # 如果格式化答案更好，使用格式化版本
-                    if len(formatted_answer) > len(answer) and "🏦" in formatted_answer:
-                        answer = formatted_answer
-                        logger.info("使用结构化格式化答案")
-                except Exception as format_error:
-                    logger.warning(f"答案格式化失败，使用原始答案：{format_error}")
-            
-            # Calculate response time
-            response_time = (time.time() - start_time) * 1000  # Convert to milliseconds
-            
-            # Prepare response
-            response = {
-                "question": question,
-                "answer": answer,
-                "confidence": confidence,
-                "response_time": response_time,
-                "matched_records": matched_records,
-                "timestamp": time.time()
-            }
-            
-            # 性能优化：缓存结果（只缓存成功的查询）
-            if matched_records:  # 只缓存有结果的查询
-                self._cache_result(question, response)
+                response = self._answer_uncached_query(question, parse, question_embedding, use_rag, start_ns)
             
             # Log query to database
             if log_query:
-                self._log_query(
-                    user_id=user_id,
-                    question=question,
-                    answer=answer,
-                    confidence=confidence,
-                    response_time=response_time
-                )
+                self._log_query(user_id, response)
             
             return response
         
@@ -1391,6 +2607,121 @@ class QueryService:
             logger.error(f"Query processing failed: {e}")
             raise QueryServiceError(f"Query processing failed: {e}")
     
+    def _answer_uncached_query(
+        self,
+        question: str,
+        parse: "QueryParse",
+        question_embedding: Optional[np.ndarray],
+        use_rag: bool,
+        start_ns: int
+    ) -> Dict[str, Any]:
+        """
+        缓存未命中时的完整查询流程：检索、生成答案、提取联行号并写入缓存
+        
+        Args:
+            question: 用户问题
+            parse: 问题解析结果
+            question_embedding: 问题向量（用于写入语义缓存，不可用时为None）
+            use_rag: 是否启用RAG检索
+            start_ns: 查询开始时间（perf_counter_ns）
+        
+        Returns:
+            查询响应字典
+        """
+        # RAG: Retrieve relevant banks using new vector-based RAG system
+        retrieved_banks = []
+        logger.info("RAG enabled: {}", use_rag)
+        if use_rag:
+            # 批量查询已为当前工作线程预先检索时直接使用（见batch_query）
+            retrieved_banks = getattr(self._thread_local, "retrieved_banks", None)
+            if retrieved_banks is None:
+                # 向量RAG检索，失败时降级到关键词检索
+                retrieved_banks = self._retrieve_banks(parse)
+        
+            if retrieved_banks:
+                logger.info("RAG: Retrieved {} relevant banks", len(retrieved_banks))
+                # 检索上下文只用于日志：延迟求值，INFO级别未输出时不拼接
+                logger.opt(lazy=True).info(
+                    "RAG Context: {}...",
+                    lambda: "\n".join(
+                        f"{bank['bank_name']}: {bank['bank_code']}" for bank in retrieved_banks
+                    )[:200]
+                )
+            else:
+                logger.warning("RAG: No relevant banks found")
+        else:
+            logger.info("RAG: Disabled by request")
+        
+        # 使用优化的小模型答案生成算法
+        if retrieved_banks:
+            logger.info("使用优化的答案生成算法...")
+            answer = self.generate_answer_with_small_model(
+                question, retrieved_banks, parse=parse
+            )
+        else:
+            # 使用优化的无匹配答案格式化
+            answer = self._format_no_match_answer(question)
+        
+        # 记录生成的答案（调试用）
+        logger.info("优化答案生成完成（前200字符）：{:.200}", answer)
+        
+        # Extract bank codes
+        matched_records = self.extract_bank_codes(answer)
+        
+        # 记录提取结果
+        logger.info("从答案中提取了{}条银行记录", len(matched_records))
+        
+        if len(matched_records) == 0:
+            logger.warning("未从答案中提取到银行代码")
+            # 如果有RAG结果但未提取到代码，使用RAG结果
+            if retrieved_banks:
+                matched_records = retrieved_banks[:1]  # 使用最佳匹配
+                logger.info("使用RAG检索结果作为匹配记录")
+        
+        # Calculate confidence with RAG enhancement
+        confidence = self.calculate_confidence(answer, matched_records)
+        
+        # 如果有RAG结果，调整置信度
+        if retrieved_banks and 'final_score' in retrieved_banks[0]:
+            rag_confidence = min(1.0, retrieved_banks[0]['final_score'] / 10.0)
+            confidence = max(confidence, rag_confidence)
+            logger.info("RAG置信度调整：{:.3f}", rag_confidence)
+        
+        # 使用新的结构化答案格式化（如果有匹配记录）
+        # 高置信度答案已是精确的"名称: 联行号"格式，无需再构建结构化答案
+        if matched_records and confidence < 0.9:
+            try:
+                formatted_answer = self.format_structured_answer(
+                    question, matched_records, confidence, 0
+                )
+                # 如果格式化答案更好，使用格式化版本
+                if len(formatted_answer) > len(answer) and "🏦" in formatted_answer:
+                    answer = formatted_answer
+                    logger.info("使用结构化格式化答案")
+            except Exception as format_error:
+                logger.warning(f"答案格式化失败，使用原始答案：{format_error}")
+        
+        # Calculate response time
+        response_time = (time.perf_counter_ns() - start_ns) / 1e6  # Convert to milliseconds
+        
+        # Prepare response
+        response = {
+            "question": question,
+            "answer": answer,
+            "confidence": confidence,
+            "response_time": response_time,
+            "matched_records": matched_records,
+            "timestamp": time.time()
+        }
+        
+        # 性能优化：缓存结果（只缓存成功的查询）
+        if matched_records:  # 只缓存有结果的查询
+            self._cache_result(question, response)
+            if question_embedding is not None:
+                self._cache_semantic_result(parse, question_embedding, response)
+        
+        return response
+    
     def batch_query(
         self,
         questions: List[str],
@@ -1400,84 +2731,243 @@ class QueryService:
         """
         Process multiple queries in batch
         
+        精确缓存命中的问题不再编码和检索；其余问题的向量一次批量计算，银行检索一次批量完成
+        （见RAGService.retrieve_relevant_banks_batch）。各问题之间没有数据依赖，之后使用线程池
+        并发完成答案生成，每个工作线程使用独立的数据库会话，避免共享self.db。
+        
         Args:
             questions: List of questions
             user_id: User ID (for logging)
             log_queries: Whether to log the queries
         
         Returns:
-            List of query responses
+            List of query responses (same order as questions)
         """
-        responses = []
+        if not questions:
+            return []
+        
+        # 精确缓存命中的问题由query()直接返回缓存结果，只为未命中的问题预先计算
+        misses = [i for i, question in enumerate(questions) if not self._has_cached_result(question)]
+        miss_questions = [questions[i] for i in misses]
+        
+        # 语义缓存需要的问题向量在一次前向计算中批量得到（同时写入RAG查询向量缓存，向量检索直接复用）
+        embeddings = None
+        if self.semantic_cache_enabled and miss_questions:
+            embeddings = self._encode_questions(miss_questions)
+        retrievals = self._retrieve_banks_batch(miss_questions)
+        
+        prefetched = [(None, None)] * len(questions)  # (问题向量, 检索结果)，缓存命中的问题均为None
+        for j, i in enumerate(misses):
+            prefetched[i] = (
+                embeddings[j] if embeddings is not None else None,
+                retrievals[j] if retrievals is not None else None
+            )
+        
+        executor = self._get_batch_executor()
+        futures = [
+            executor.submit(
+                self._query_with_worker_session, question, user_id, log_queries, *prefetched[i]
+            )
+            for i, question in enumerate(questions)
+        ]
         
-        for question in questions:
+        responses = []
+        for question, future in zip(questions, futures):
             try:
-                response = self.query(
-                    question=question,
-                    user_id=user_id,
-                    log_query=log_queries
-                )
-                responses.append(response)
+                responses.append(future.result())
             except Exception as e:
                 logger.error(f"Failed to process question '{question}': {e}")
-                responses.append({
-                    "question": question,
-                    "answer": f"查询失败：{str(e)}",
-                    "confidence": 0.0,
-                    "response_time": 0.0,
-                    "matched_records": [],
-                    "error": str(e)
-                })
+                responses.append(self._build_error_response(question, e))
         
         return responses
     
-    def _log_query(
+    def _retrieve_banks_batch(self, questions: List[str]) -> Optional[List[List[Dict[str, Any]]]]:
+        """
+        批量检索多个问题的银行记录（向量RAG批量检索）
+        
+        Args:
+            questions: 问题列表
+        
+        Returns:
+            与questions一一对应的检索结果；失败时返回None，由各查询逐个检索（含关键词检索降级）
+        """
+        if not questions:
+            return None
+        
+        try:
+            results = self._run_coroutine(self.rag_service.retrieve_relevant_banks_batch(questions, top_k=5))
+        except Exception as e:
+            logger.warning(f"Batch RAG retrieval failed, retrieving per question: {e}")
+            return None
+        
+        if not isinstance(results, list) or len(results) != len(questions):
+            return None
+        return results
+    
+    def _get_batch_executor(self) -> ThreadPoolExecutor:
+        """
+        获取批量查询线程池（首次使用时创建，之后各批次复用）
+        
+        线程按需创建、空闲后保留，后续批次不再重复创建和销毁工作线程。
+        """
+        if self._batch_executor is None:
+            with self._batch_executor_lock:
+                if self._batch_executor is None:
+                    self._batch_executor = ThreadPoolExecutor(
+                        max_workers=self.batch_max_workers,
+                        thread_name_prefix="batch-query"
+                    )
+        return self._batch_executor
+    
+    def _query_with_worker_session(
         self,
-        user_id: Optional[int],
         question: str,
-        answer: str,
-        confidence: float,
-        response_time: float
-    ) -> None:
+        user_id: Optional[int],
+        log_query: bool,
+        question_embedding: Optional[np.ndarray] = None,
+        retrieved_banks: Optional[List[Dict[str, Any]]] = None
+    ) -> Dict[str, Any]:
+        """
+        在工作线程中使用独立的数据库会话执行单个查询
+        
+        Args:
+            question: User's question
+            user_id: User ID (for logging)
+            log_query: Whether to log the query
+            question_embedding: 批量预先计算的问题向量（可选）
+            retrieved_banks: 批量预先检索的银行记录（可选）
+        
+        Returns:
+            Query response dictionary
+        """
+        session = self._create_session()
+        self._thread_local.db = session
+        self._thread_local.question_embedding = question_embedding
+        self._thread_local.retrieved_banks = retrieved_banks
+        try:
+            return self.query(question=question, user_id=user_id, log_query=log_query)
+        finally:
+            self._thread_local.db = None
+            self._thread_local.question_embedding = None
+            self._thread_local.retrieved_banks = None
+            if session is not None:
+                session.close()
+    
+    def _create_session(self) -> Optional[Session]:
+        """
+        基于当前会话绑定的engine创建独立会话
+        
+        Returns:
+            新的数据库会话；无法获取engine时返回None（调用方回落到共享会话）
+        """
+        try:
+            return Session(bind=self._db.get_bind())
+        except Exception as e:
+            logger.warning(f"Could not create dedicated session, using shared session: {e}")
+            return None
+    
+    def _build_error_response(self, question: str, error: Exception) -> Dict[str, Any]:
+        """构建查询失败时的响应"""
+        return {
+            "question": question,
+            "answer": f"查询失败：{str(error)}",
+            "confidence": 0.0,
+            "response_time": 0.0,
+            "matched_records": [],
+            "error": str(error)
+        }
+    
+    def _log_query(self, user_id: Optional[int], response: Dict[str, Any]) -> None:
         """
         Log query to database
         
+        日志放入队列由后台线程批量写入，不阻塞查询响应；
+        队列已满时退回到同步写入。
+        
         Args:
             user_id: User ID
-            question: Question
-            answer: Answer
-            confidence: Confidence score
-            response_time: Response time in milliseconds
+            response: 查询响应（取其中的问题、答案、置信度和响应时间）
+        """
+        entry = {
+            "user_id": user_id,
+            "question": response["question"],
+            "answer": response["answer"],
+            "confidence": response["confidence"],
+            "response_time": response["response_time"],
+            "model_version": self.model_version
+        }
+        
+        try:
+            bind = self._db.get_bind()
+        except Exception as e:
+            logger.warning(f"Could not get engine for query log writer, writing synchronously: {e}")
+            bind = None
+        
+        if bind is None or not _query_log_writer.submit(bind, entry):
+            if bind is not None:
+                logger.warning("Query log queue is full, writing synchronously")
+            self._write_query_logs([entry], self.db)
+    
+    @staticmethod
+    def _write_query_logs(entries: List[Dict[str, Any]], session: Session) -> None:
+        """
+        将一批查询日志写入数据库（一次提交）
+        
+        Args:
+            entries: 查询日志字段字典列表
+            session: 用于写入的数据库会话
         """
         try:
             # 确保数据库会话是活跃的
-            if not self.db.is_active:
+            if not session.is_active:
                 logger.warning("Database session is not active, attempting to refresh")
-                self.db.rollback()  # 重置会话状态
-            
-            query_log = QueryLog(
-                user_id=user_id,
-                question=question,
-                answer=answer,
-                confidence=confidence,
-                response_time=response_time,
-                model_version=self.model_version
-            )
-            self.db.add(query_log)
-            self.db.commit()
-            logger.info(f"Query logged successfully: user_id={user_id}, question='{question[:50]}...'")
+                session.rollback()  # 重置会话状态
+            
+            # 直接按字段字典批量插入，不构造ORM对象
+            session.bulk_insert_mappings(QueryLog, entries)
+            session.commit()
+            logger.info(f"Logged {len(entries)} queries successfully")
         except Exception as e:
             logger.error(f"Failed to log query: {e}")
             try:
-                self.db.rollback()
+                session.rollback()
             except Exception as rollback_error:
                 logger.error(f"Failed to rollback transaction: {rollback_error}")
+                return
+            
+            # 批量写入失败时逐条重试，避免一条异常数据导致整批日志丢失
+            if len(entries) > 1:
+                QueryService._write_query_logs_one_by_one(entries, session)
+    
+    @staticmethod
+    def _write_query_logs_one_by_one(entries: List[Dict[str, Any]], session: Session) -> None:
+        """逐条写入查询日志，跳过写入失败的条目"""
+        saved = 0
+        for entry in entries:
+            try:
+                session.bulk_insert_mappings(QueryLog, [entry])
+                session.commit()
+                saved += 1
+            except Exception as e:
+                logger.error(f"Failed to log query '{str(entry.get('question'))[:30]}': {e}")
+                try:
+                    session.rollback()
+                except Exception as rollback_error:
+                    logger.error(f"Failed to rollback transaction: {rollback_error}")
+                    return
+        logger.info(f"Logged {saved}/{len(entries)} queries after retrying individually")
+    
+    def flush_query_logs(self) -> None:
+        """阻塞直到队列中的查询日志全部写入（用于测试和关闭服务）"""
+        _query_log_writer.flush()
     
     def get_query_history(
         self,
         user_id: Optional[int] = None,
         limit: int = 100,
-        offset: int = 0
+        offset: int = 0,
+        before_created_at: Optional[datetime] = None,
+        before_id: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """
         Get query history from database
@@ -1486,6 +2976,8 @@ class QueryService:
             user_id: Filter by user ID (None for all users)
             limit: Maximum number of records to return
             offset: Number of records to skip
+            before_created_at: 键集分页游标，只返回早于该时间的记录（提供时忽略offset）
+            before_id: 上一页最后一条的id，与before_created_at组成(created_at, id)复合游标
         
         Returns:
             List of query log records
@@ -1496,8 +2988,16 @@ class QueryService:
             if user_id is not None:
                 query = query.filter(QueryLog.user_id == user_id)
             
-            query = query.order_by(QueryLog.created_at.desc())
-            query = query.limit(limit).offset(offset)
+            # 键集分页：按上一页最后一条的(时间, id)定位，走(user_id, created_at, id)索引，
+            # 不像OFFSET那样随页码线性扫描被跳过的行；批量写入的日志时间可能相同，需要id区分
+            if before_created_at is not None and before_id is not None:
+                query = query.filter(tuple_(QueryLog.created_at, QueryLog.id) < (before_created_at, before_id))
+            elif before_created_at is not None:
+                query = query.filter(QueryLog.created_at < before_created_at)
+            
+            query = query.order_by(QueryLog.created_at.desc(), QueryLog.id.desc()).limit(limit)
+            if before_created_at is None and offset:
+                query = query.offset(offset)
             
             logs = query.all()
             
@@ -1507,6 +3007,53 @@ class QueryService:
             logger.error(f"Failed to get query history: {e}")
             return []
     
+    # 最新模型缓存（所有实例和query API共用）：(查询时间, (训练任务ID, 模型名称, 模型路径, 模型文件是否存在))，
+    # 避免每个请求都查询训练任务表和检查文件系统；加载模型或清空模型缓存时失效
+    _latest_model_cache: Optional[Tuple[float, Optional[Tuple[int, str, str, bool]]]] = None
+    _latest_model_ttl = 30  # 秒
+    
+    @classmethod
+    def _latest_model_entry(cls, db: Session) -> Optional[Tuple[int, str, str, bool]]:
+        """查询最新完成训练的模型（结果缓存_latest_model_ttl秒），没有时返回None"""
+        cached = cls._latest_model_cache
+        if cached is not None and time.time() - cached[0] < cls._latest_model_ttl:
+            return cached[1]
+        
+        latest_job = db.query(TrainingJob).filter(
+            TrainingJob.status == "completed",
+            TrainingJob.model_path.isnot(None)
+        ).order_by(TrainingJob.completed_at.desc()).first()
+        
+        entry = None
+        if latest_job:
+            entry = (
+                latest_job.id,
+                latest_job.model_name,
+                latest_job.model_path,
+                bool(latest_job.model_path) and os.path.exists(latest_job.model_path)
+            )
+        cls._latest_model_cache = (time.time(), entry)
+        return entry
+    
+    @classmethod
+    def get_latest_model(cls, db: Session) -> Optional[Tuple[int, str, str]]:
+        """
+        获取最新完成训练的模型（结果缓存_latest_model_ttl秒）
+        
+        Args:
+            db: 数据库会话
+        
+        Returns:
+            (训练任务ID, 模型名称, 模型路径)；没有可用模型时返回None
+        """
+        entry = cls._latest_model_entry(db)
+        return entry[:3] if entry else None
+    
+    @classmethod
+    def clear_latest_model_cache(cls) -> None:
+        """使最新模型缓存失效（下次调用重新查询训练任务表）"""
+        cls._latest_model_cache = None
+    
     def get_latest_model_path(self) -> Optional[str]:
         """
         Get the path to the latest trained model
@@ -1515,18 +3062,8 @@ class QueryService:
             Path to latest model or None if no model found
         """
         try:
-            # Find the latest completed training job
-            latest_job = self.db.query(TrainingJob).filter(
-                TrainingJob.status == "completed",
-                TrainingJob.model_path.isnot(None)
-            ).order_by(TrainingJob.completed_at.desc()).first()
-            
-            if latest_job and latest_job.model_path:
-                model_path = latest_job.model_path
-                if os.path.exists(model_path):
-                    return model_path
-            
-            return None
+            entry = self._latest_model_entry(self.db)
+            return entry[2] if entry and entry[3] else None
         
         except Exception as e:
             logger.error(f"Failed to get latest model path: {e}")
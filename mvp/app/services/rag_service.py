@@ -31,11 +31,23 @@ RAG Service - 检索增强生成服务
     >>> await rag_service.update_vector_db()
 """
 import os
+import re
+import queue
+import sqlite3
 import asyncio
-from typing import List, Dict, Any, Optional
+import hashlib
+import heapq
+import itertools
+import operator
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
 from pathlib import Path
 
 import chromadb
+import torch
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 import numpy as np
@@ -44,6 +56,687 @@ from loguru import logger
 
 from app.models.bank_code import BankCode
 
+try:
+    import ahocorasick  # 可选依赖：pyahocorasick，多模式匹配
+except ImportError:
+    logger.info("pyahocorasick not available, RAG keyword extraction uses substring scans")
+    ahocorasick = None
+
+try:
+    import faiss  # 可选依赖：faiss，内存向量检索
+except ImportError:
+    logger.info("faiss not available, flat vector search uses NumPy")
+    faiss = None
+
+# 关键词/实体提取用的词表（模块加载时构建一次，不在每次调用时重建）
+# 银行全称 -> 简称/别名（索引银行时提取关键词用；按顺序匹配）
+_BANK_KEYWORD_ALIASES = {
+    # 国有大型银行
+    "中国工商银行": ["工商银行", "工行", "ICBC", "中国工商", "工商", "工商行"],
+    "中国农业银行": ["农业银行", "农行", "ABC", "中国农业", "农业", "农行银行"],
+    "中国银行": ["中行", "BOC", "中银", "中国银行"],
+    "中国建设银行": ["建设银行", "建行", "CCB", "中国建设", "建设", "建行银行"],
+
+    # 股份制银行
+    "交通银行": ["交行", "BOCOM", "交通", "交银"],
+    "中国邮政储蓄银行": ["邮储银行", "邮政银行", "PSBC", "邮储", "邮政储蓄", "邮政", "邮储行", "邮政行"],
+    "招商银行": ["招行", "CMB", "招商", "招银"],
+    "浦发银行": ["上海浦东发展银行", "SPDB", "浦东发展银行", "浦东发展", "浦发", "浦东银行"],
+    "中信银行": ["CITIC", "中信", "中信行"],
+    "中国光大银行": ["光大银行", "CEB", "光大", "光大行"],
+    "华夏银行": ["HXB", "华夏", "华夏行"],
+    "中国民生银行": ["民生银行", "CMBC", "民生", "民生行"],
+    "广发银行": ["CGB", "广发", "广东发展银行", "广发行", "广东发展"],
+    "平安银行": ["PAB", "平安", "平安行"],
+    "兴业银行": ["CIB", "兴业", "兴业行"],
+
+    # 城市商业银行
+    "北京银行": ["BOB", "北京", "北京行", "京行"],
+    "上海银行": ["BOS", "上海", "上海行", "沪行"],
+    "江苏银行": ["江苏", "江苏行", "苏行"],
+    "浙商银行": ["浙商", "浙商行"],
+    "渤海银行": ["渤海", "渤海行"],
+    "恒丰银行": ["恒丰", "恒丰行"],
+    "南京银行": ["南京", "南京行", "宁行"],
+    "宁波银行": ["宁波", "宁波行", "甬行"],
+    "杭州银行": ["杭州", "杭州行", "杭行"],
+    "徽商银行": ["徽商", "徽商行", "皖行"],
+    "长沙银行": ["长沙", "长沙行", "湘行"],
+    "郑州银行": ["郑州", "郑州行", "豫行"],
+    "青岛银行": ["青岛", "青岛行", "青行"],
+    "大连银行": ["大连", "大连行", "连行"],
+    "哈尔滨银行": ["哈尔滨", "哈尔滨行", "哈行"],
+    "盛京银行": ["盛京", "盛京行"],
+    "锦州银行": ["锦州", "锦州行"],
+
+    # 农村商业银行
+    "北京农商银行": ["北京农商", "京农商", "北京农村商业银行"],
+    "上海农商银行": ["上海农商", "沪农商", "上海农村商业银行"],
+    "重庆农商银行": ["重庆农商", "渝农商", "重庆农村商业银行"],
+    "广州农商银行": ["广州农商", "穗农商", "广州农村商业银行"],
+    "深圳农商银行": ["深圳农商", "深农商", "深圳农村商业银行"],
+
+    # 外资银行
+    "东亚银行": ["东亚", "东亚行", "BEA"],
+    "花旗银行": ["花旗", "花旗行", "Citibank"],
+    "汇丰银行": ["汇丰", "汇丰行", "HSBC"],
+    "渣打银行": ["渣打", "渣打行", "Standard Chartered"],
+    "星展银行": ["星展", "星展行", "DBS"],
+    "三菱银行": ["三菱", "三菱行", "MUFG"],
+    "三井银行": ["三井", "三井行", "SMBC"],
+
+    # 政策性银行
+    "国家开发银行": ["国开行", "国家开发", "CDB"],
+    "中国进出口银行": ["进出口银行", "进出口行", "EXIM"],
+    "中国农业发展银行": ["农发行", "农业发展银行", "ADBC"],
+
+    # 其他银行
+    "中国银联": ["银联", "UnionPay"],
+    "网商银行": ["网商", "网商行"],
+    "微众银行": ["微众", "微众行"],
+    "新网银行": ["新网", "新网行"],
+    "亿联银行": ["亿联", "亿联行"]
+}
+
+# 银行名称中识别的地理位置
+_BANK_KEYWORD_LOCATIONS = (
+    # 直辖市
+    "北京", "上海", "天津", "重庆",
+    # 省会城市
+    "石家庄", "太原", "呼和浩特", "沈阳", "长春", "哈尔滨",
+    "南京", "杭州", "合肥", "福州", "南昌", "济南", "郑州",
+    "武汉", "长沙", "广州", "南宁", "海口", "成都", "贵阳",
+    "昆明", "拉萨", "西安", "兰州", "西宁", "银川", "乌鲁木齐",
+    # 计划单列市
+    "厦门", "深圳", "青岛", "大连", "宁波",
+    # 重要地级市
+    "苏州", "无锡", "常州", "温州", "嘉兴", "湖州", "绍兴", "金华", 
+    "衢州", "舟山", "台州", "丽水", "芜湖", "蚌埠", "淮南", "马鞍山", 
+    "淮北", "铜陵", "安庆", "黄山", "滁州", "阜阳", "宿州", "六安", 
+    "亳州", "池州", "宣城", "莆田", "三明", "泉州", "漳州", "南平", 
+    "龙岩", "宁德", "景德镇", "萍乡", "九江", "新余", "鹰潭", "赣州", 
+    "吉安", "宜春", "抚州", "上饶", "淄博", "枣庄", "东营", "烟台", 
+    "潍坊", "济宁", "泰安", "威海", "日照", "莱芜", "临沂", "德州", 
+    "聊城", "滨州", "菏泽", "开封", "洛阳", "平顶山", "安阳", "鹤壁", 
+    "新乡", "焦作", "濮阳", "许昌", "漯河", "三门峡", "南阳", "商丘", 
+    "信阳", "周口", "驻马店", "黄石", "十堰", "宜昌", "襄阳", "鄂州", 
+    "荆门", "孝感", "荆州", "黄冈", "咸宁", "随州", "恩施", "株洲", 
+    "湘潭", "衡阳", "邵阳", "岳阳", "常德", "张家界", "益阳", "郴州", 
+    "永州", "怀化", "娄底", "韶关", "珠海", "汕头", "佛山", "江门", 
+    "湛江", "茂名", "肇庆", "惠州", "梅州", "汕尾", "河源", "阳江", 
+    "清远", "东莞", "中山", "潮州", "揭阳", "云浮", "柳州", "桂林", 
+    "梧州", "北海", "防城港", "钦州", "贵港", "玉林", "百色", "贺州", 
+    "河池", "来宾", "崇左", "三亚", "三沙", "儋州", "自贡", "攀枝花", 
+    "泸州", "德阳", "绵阳", "广元", "遂宁", "内江", "乐山", "南充", 
+    "眉山", "宜宾", "广安", "达州", "雅安", "巴中", "资阳", "江油", 
+    "六盘水", "遵义", "安顺", "毕节", "铜仁", "曲靖", "玉溪", "保山", 
+    "昭通", "丽江", "普洱", "临沧", "昌都", "山南", "日喀则", "那曲", 
+    "阿里", "林芝", "铜川", "宝鸡", "咸阳", "渭南", "延安", "汉中", 
+    "榆林", "安康", "商洛", "嘉峪关", "金昌", "白银", "天水", "武威", 
+    "张掖", "平凉", "酒泉", "庆阳", "定西", "陇南", "海东", "石嘴山", 
+    "吴忠", "固原", "中卫", "克拉玛依", "吐鲁番", "哈密"
+)
+
+# 支行、分行等网点类型
+_BANK_KEYWORD_BRANCH_TYPES = (
+    "支行", "分行", "分理处", "储蓄所", "营业部", "营业厅", "网点", 
+    "分支机构", "办事处", "代理点", "服务点", "自助银行", "便民服务点"
+)
+
+# 特殊区域标识
+_BANK_KEYWORD_SPECIAL_AREAS = (
+    # 开发区
+    "开发区", "高新区", "经济开发区", "技术开发区", "工业园区", "科技园",
+    "保税区", "自贸区", "新区", "示范区", "试验区",
+    # 商业区
+    "CBD", "商务区", "金融区", "商业区", "购物中心", "广场", "大厦",
+    "中心", "城", "港", "湾", "岛", "山", "湖", "河", "桥", "路", "街",
+    # 交通枢纽
+    "机场", "火车站", "高铁站", "地铁站", "汽车站", "港口", "码头"
+)
+
+# 问题中的银行简称 -> 全称（按顺序匹配，先匹配到的优先）
+_QUESTION_BANK_NAMES = {
+    # 国有大型银行
+    '工商银行': '中国工商银行',
+    '工行': '中国工商银行',
+    'ICBC': '中国工商银行',
+    '农业银行': '中国农业银行',
+    '农行': '中国农业银行', 
+    'ABC': '中国农业银行',
+    '中国银行': '中国银行',
+    '中行': '中国银行',
+    'BOC': '中国银行',
+    '建设银行': '中国建设银行',
+    '建行': '中国建设银行',
+    'CCB': '中国建设银行',
+
+    # 股份制银行
+    '交通银行': '交通银行',
+    '交行': '交通银行',
+    'BOCOM': '交通银行',
+    '招商银行': '招商银行',
+    '招行': '招商银行',
+    'CMB': '招商银行',
+    '浦发银行': '上海浦东发展银行',
+    '浦东发展银行': '上海浦东发展银行',
+    'SPDB': '上海浦东发展银行',
+    '中信银行': '中信银行',
+    '中信': '中信银行',
+    'CITIC': '中信银行',
+    '光大银行': '中国光大银行',
+    '光大': '中国光大银行',
+    'CEB': '中国光大银行',
+    '华夏银行': '华夏银行',
+    '华夏': '华夏银行',
+    'HXB': '华夏银行',
+    '民生银行': '中国民生银行',
+    '民生': '中国民生银行',
+    'CMBC': '中国民生银行',
+    '广发银行': '广发银行',
+    '广发': '广发银行',
+    'CGB': '广发银行',
+    '广东发展银行': '广发银行',
+    '平安银行': '平安银行',
+    '平安': '平安银行',
+    'PAB': '平安银行',
+    '兴业银行': '兴业银行',
+    '兴业': '兴业银行',
+    'CIB': '兴业银行',
+
+    # 邮政储蓄银行
+    '邮储银行': '中国邮政储蓄银行',
+    '邮政储蓄银行': '中国邮政储蓄银行',
+    '邮政银行': '中国邮政储蓄银行',
+    '邮储': '中国邮政储蓄银行',
+    '邮政储蓄': '中国邮政储蓄银行',
+    'PSBC': '中国邮政储蓄银行',
+
+    # 城市商业银行
+    '北京银行': '北京银行',
+    'BOB': '北京银行',
+    '上海银行': '上海银行',
+    'BOS': '上海银行',
+    '江苏银行': '江苏银行',
+    '浙商银行': '浙商银行',
+    '浙商': '浙商银行',
+    '渤海银行': '渤海银行',
+    '渤海': '渤海银行',
+    '恒丰银行': '恒丰银行',
+    '恒丰': '恒丰银行',
+    '南京银行': '南京银行',
+    '宁波银行': '宁波银行',
+    '杭州银行': '杭州银行',
+    '徽商银行': '徽商银行',
+    '长沙银行': '长沙银行',
+    '郑州银行': '郑州银行',
+    '青岛银行': '青岛银行',
+    '大连银行': '大连银行',
+    '哈尔滨银行': '哈尔滨银行',
+    '盛京银行': '盛京银行',
+    '锦州银行': '锦州银行',
+
+    # 外资银行
+    '东亚银行': '东亚银行',
+    '花旗银行': '花旗银行',
+    '花旗': '花旗银行',
+    '汇丰银行': '汇丰银行',
+    '汇丰': '汇丰银行',
+    '渣打银行': '渣打银行',
+    '渣打': '渣打银行',
+    '星展银行': '星展银行',
+    '星展': '星展银行',
+    '三菱银行': '三菱银行',
+    '三井银行': '三井银行'
+}
+
+# 问题中识别的城市
+_QUESTION_LOCATIONS = (
+    # 直辖市
+    '北京', '上海', '天津', '重庆',
+    # 省会城市和计划单列市
+    '广州', '深圳', '厦门', '青岛', '大连', '宁波', '苏州', '杭州', '南京', 
+    '武汉', '成都', '西安', '长沙', '郑州', '济南', '合肥', '福州', '南昌', 
+    '太原', '石家庄', '沈阳', '长春', '哈尔滨', '昆明', '贵阳', '南宁', 
+    '海口', '兰州', '银川', '西宁', '乌鲁木齐', '拉萨', '呼和浩特',
+    # 重要地级市
+    '无锡', '常州', '温州', '嘉兴', '湖州', '绍兴', '金华', '衢州', 
+    '舟山', '台州', '丽水', '芜湖', '蚌埠', '淮南', '马鞍山', '淮北', 
+    '铜陵', '安庆', '黄山', '滁州', '阜阳', '宿州', '六安', '亳州', 
+    '池州', '宣城', '莆田', '三明', '泉州', '漳州', '南平', '龙岩', 
+    '宁德', '景德镇', '萍乡', '九江', '新余', '鹰潭', '赣州', '吉安', 
+    '宜春', '抚州', '上饶', '淄博', '枣庄', '东营', '烟台', '潍坊', 
+    '济宁', '泰安', '威海', '日照', '莱芜', '临沂', '德州', '聊城', 
+    '滨州', '菏泽', '开封', '洛阳', '平顶山', '安阳', '鹤壁', '新乡', 
+    '焦作', '濮阳', '许昌', '漯河', '三门峡', '南阳', '商丘', '信阳', 
+    '周口', '驻马店', '黄石', '十堰', '宜昌', '襄阳', '鄂州', '荆门', 
+    '孝感', '荆州', '黄冈', '咸宁', '随州', '恩施', '株洲', '湘潭', 
+    '衡阳', '邵阳', '岳阳', '常德', '张家界', '益阳', '郴州', '永州', 
+    '怀化', '娄底', '韶关', '珠海', '汕头', '佛山', '江门', '湛江', 
+    '茂名', '肇庆', '惠州', '梅州', '汕尾', '河源', '阳江', '清远', 
+    '东莞', '中山', '潮州', '揭阳', '云浮', '柳州', '桂林', '梧州', 
+    '北海', '防城港', '钦州', '贵港', '玉林', '百色', '贺州', '河池', 
+    '来宾', '崇左', '三亚', '三沙', '儋州'
+)
+
+# 支行名称规则（按顺序匹配）
+_QUESTION_BRANCH_SUFFIXES = ('支行', '分行', '营业部', '营业厅', '分理处', '储蓄所', '网点')
+
+# (后缀, 支行名称模式)，按后缀顺序依次匹配：先列出的后缀优先，而不是问题中先出现的
+_QUESTION_BRANCH_PATTERNS = tuple(
+    (suffix, re.compile(r'([^银行]{2,12}' + suffix + ')'))
+    for suffix in _QUESTION_BRANCH_SUFFIXES
+)
+
+# 商业区、商圈、地标
+_QUESTION_COMMERCIAL_AREAS = (
+    # 北京
+    '西单', '王府井', '中关村', '国贸', '金融街', '望京', '三里屯', 
+    '朝阳门', '建国门', '复兴门', '西直门', '东直门', '安定门', '崇文门',
+    '宣武门', '阜成门', '德胜门', '和平门', '前门', '天安门', '雍和宫',
+    '北京站', '北京西站', '北京南站', '首都机场', '大兴机场',
+    # 上海
+    '陆家嘴', '外滩', '南京路', '淮海路', '徐家汇', '人民广场', '静安寺',
+    '虹桥', '浦东', '黄浦', '长宁', '普陀', '闸北', '虹口', '杨浦',
+    '闵行', '宝山', '嘉定', '金山', '松江', '青浦', '奉贤', '崇明',
+    # 广州
+    '天河', '越秀', '荔湾', '海珠', '白云', '黄埔', '番禺', '花都',
+    '南沙', '从化', '增城', '珠江新城', '体育中心', '五羊新城',
+    # 深圳
+    '福田', '罗湖', '南山', '宝安', '龙岗', '盐田', '龙华', '坪山',
+    '光明', '大鹏', '华强北', '科技园', '蛇口', '前海'
+)
+
+# 同时可作为地理位置的知名商业区
+_QUESTION_LANDMARK_LOCATIONS = frozenset(['西单', '王府井', '中关村', '国贸', '金融街', '陆家嘴', '外滩'])
+
+# 问题关键词提取（_extract_question_keywords）的银行名称、地理位置、支行类型模式
+_KEYWORD_BANK_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'(中国工商银行|工商银行|工行)',
+    r'(中国农业银行|农业银行|农行)',
+    r'(中国银行|中行)',
+    r'(中国建设银行|建设银行|建行)',
+    r'(交通银行|交行)',
+    r'(招商银行|招行)',
+    r'(浦发银行|上海浦东发展银行)',
+    r'(中信银行|中信)',
+    r'(光大银行|中国光大银行)',
+    r'(华夏银行|华夏)',
+    r'(民生银行|中国民生银行)',
+    r'(广发银行|广发)',
+    r'(平安银行|平安)',
+    r'(兴业银行|兴业)',
+    r'(浙商银行|浙商)',
+    r'(渤海银行|渤海)',
+    r'(恒丰银行|恒丰)',
+    r'(邮储银行|邮政储蓄银行|邮政银行)',
+    r'([^，。！？\s]{2,8}银行)'  # 通用银行名称模式
+))
+_KEYWORD_LOCATION_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'(北京|上海|天津|重庆)',
+    r'(广州|深圳|厦门|青岛|大连|宁波|苏州|杭州|南京|武汉|成都|西安)',
+    r'([^，。！？\s]{2,6}[市县区镇])',
+    r'([^，。！？\s]{2,8}[省])'
+))
+_KEYWORD_BRANCH_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'([^，。！？\s]{1,10}支行)',
+    r'([^，。！？\s]{1,10}分行)',
+    r'(营业部|营业厅|分理处|储蓄所)'
+))
+# 分词时含有这些字符（常见停用词和标点）的词组不作为关键词
+_KEYWORD_STOPWORD_RE = re.compile(r'[，。！？\s的是在有什么多少哪里怎么样]')
+
+# 核心关键词提取（_extract_core_keywords）的模式
+_CORE_KEYWORD_BANK_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'(中国工商银行|工商银行)',
+    r'(中国农业银行|农业银行)',
+    r'(中国银行)',
+    r'(中国建设银行|建设银行)',
+    r'(交通银行)',
+    r'(招商银行)',
+    r'(浦发银行|上海浦东发展银行)',
+    r'(中信银行)',
+    r'(光大银行|中国光大银行)',
+    r'(华夏银行)',
+    r'(民生银行|中国民生银行)',
+    r'(广发银行)',
+    r'(平安银行)',
+    r'(兴业银行)',
+    r'(邮储银行|邮政储蓄银行)',
+))
+_CORE_KEYWORD_LOCATION_PATTERNS = _KEYWORD_LOCATION_PATTERNS[:2]  # 只取主要城市
+_CORE_KEYWORD_BRANCH_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'([^，。！？\s]{2,8}支行)',
+    r'([^，。！？\s]{2,8}分行)',
+    r'(营业部|营业厅|分理处)'
+))
+_CORE_KEYWORD_LONG_WORD_RE = re.compile(r'[^，。！？\s]{4,8}')
+_CORE_KEYWORD_STOPWORD_RE = re.compile(r'[的是在有什么多少哪里怎么样]')
+
+# 名称倒排索引的n-gram长度，以及长文本求交集后候选少于该数量时直接逐个确认
+_NAME_INDEX_GRAM_SIZES = (2, 3, 4)
+_NAME_INDEX_CONFIRM_LIMIT = 64
+
+# 检索文本嵌入向量缓存的最大条目数
+_QUERY_EMBEDDING_CACHE_SIZE = 10000
+
+
+class _WordMatcher:
+    """
+    在文本中一次找出若干词表中出现的所有词
+    
+    安装了pyahocorasick时使用Aho-Corasick自动机，扫描一遍文本即可得到全部匹配（含重叠和嵌套的词）；
+    否则逐词做子串判断。in_order按各词表自身的顺序返回匹配结果，保持原有的先匹配优先规则。
+    """
+    
+    def __init__(self, **word_lists):
+        # 词表名 -> {词: 在该词表中的位置}（重复的词取第一次出现的位置）
+        self._orders = {}
+        for name, words in word_lists.items():
+            order = {}
+            for index, word in enumerate(words):
+                order.setdefault(word, index)
+            self._orders[name] = order
+        self.words = tuple({word for order in self._orders.values() for word in order if word})
+        self.automaton = None
+        if ahocorasick is not None:
+            self.automaton = ahocorasick.Automaton()
+            for word in self.words:
+                self.automaton.add_word(word, word)
+            self.automaton.make_automaton()
+    
+    def find(self, text: str) -> set:
+        """返回在文本中出现过的词"""
+        if self.automaton is not None:
+            return {word for _, word in self.automaton.iter(text)}
+        return {word for word in self.words if word in text}
+    
+    def in_order(self, found: set, name: str) -> List[str]:
+        """按词表name的顺序列出found中属于该词表的词"""
+        if not found:
+            return []
+        order = self._orders[name]
+        return sorted((word for word in found if word in order), key=order.__getitem__)
+
+
+# 银行名称关键词提取用的匹配器
+_BANK_KEYWORD_MATCHER = _WordMatcher(
+    full_names=list(_BANK_KEYWORD_ALIASES),
+    locations=_BANK_KEYWORD_LOCATIONS,
+    branch_types=_BANK_KEYWORD_BRANCH_TYPES,
+    special_areas=_BANK_KEYWORD_SPECIAL_AREAS,
+    aliases=[alias for aliases in _BANK_KEYWORD_ALIASES.values() for alias in aliases]
+)
+
+# 全称/别名 -> 包含该词的_BANK_KEYWORD_ALIASES条目下标（只需检查名称中出现过的词所在的条目）
+_BANK_KEYWORD_ALIAS_ITEMS = tuple(_BANK_KEYWORD_ALIASES.items())
+_BANK_KEYWORD_ALIAS_ENTRIES: Dict[str, List[int]] = {}
+for _index, (_full_name, _aliases) in enumerate(_BANK_KEYWORD_ALIAS_ITEMS):
+    for _word in dict.fromkeys([_full_name] + _aliases):
+        _BANK_KEYWORD_ALIAS_ENTRIES.setdefault(_word, []).append(_index)
+del _index, _full_name, _aliases, _word
+
+# 问题实体提取用的匹配器
+_QUESTION_ENTITY_MATCHER = _WordMatcher(
+    short_names=list(_QUESTION_BANK_NAMES),
+    full_names=list(_QUESTION_BANK_NAMES.values()),
+    locations=_QUESTION_LOCATIONS,
+    commercial_areas=_QUESTION_COMMERCIAL_AREAS
+)
+
+
+class _FlatL2Index:
+    """
+    内存中的精确向量检索，距离为平方L2（与ChromaDB集合默认的l2距离一致）
+    
+    安装了faiss时使用faiss.IndexFlatL2，fp16=True时改用FP16标量量化存储（内存和扫描带宽减半，距离相对误差实测不超过4e-5），
+    int8=True时改用按维度取值范围训练的8位标量量化（内存为FP32的1/4，距离为近似值，优先于fp16）；
+    否则用NumPy矩阵向量乘法计算全部距离（NumPy在CPU上没有高效的FP16/INT8矩阵运算，始终使用FP32）。
+    """
+    
+    def __init__(self, embeddings: np.ndarray, fp16: bool = False, int8: bool = False):
+        self.size = len(embeddings)
+        self.index = None
+        if faiss is not None:
+            dimension = embeddings.shape[1]
+            if int8:
+                self.index = faiss.IndexScalarQuantizer(
+                    dimension, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2
+                )
+                self.index.train(embeddings)
+            elif fp16:
+                self.index = faiss.IndexScalarQuantizer(
+                    dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2
+                )
+                self.index.train(embeddings)
+            else:
+                self.index = faiss.IndexFlatL2(dimension)
+            self.index.add(embeddings)
+        else:
+            self.embeddings = embeddings
+            self.squared_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+    
+    # NumPy路径每次矩阵乘法处理的查询数（距离矩阵为 查询数 x 条目数，限制临时内存）
+    QUERY_BLOCK_SIZE = 32
+    
+    def search(self, query: np.ndarray, n_results: int):
+        """
+        返回与query最近的n_results个条目
+        
+        Returns:
+            (距离数组, 下标数组)，按距离升序
+        """
+        distances, indices = self.search_many(np.asarray(query).reshape(1, -1), n_results)
+        return distances[0], indices[0]
+    
+    def search_many(self, queries: np.ndarray, n_results: int):
+        """
+        一次检索多个查询向量，NumPy路径下每批查询只做一次矩阵乘法（SGEMM）
+        
+        Returns:
+            (距离矩阵, 下标矩阵)，形状均为(查询数, n)，每行按距离升序
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        n_results = min(n_results, self.size)
+        if n_results <= 0:
+            return (
+                np.zeros((len(queries), 0), dtype=np.float32),
+                np.zeros((len(queries), 0), dtype=np.int64)
+            )
+        
+        if self.index is not None:
+            return self.index.search(queries, n_results)
+        
+        all_distances, all_indices = [], []
+        for start in range(0, len(queries), self.QUERY_BLOCK_SIZE):
+            block = queries[start:start + self.QUERY_BLOCK_SIZE]
+            distances = (
+                self.squared_norms[None, :]
+                - 2.0 * (block @ self.embeddings.T)
+                + np.einsum("ij,ij->i", block, block)[:, None]
+            )
+            np.maximum(distances, 0.0, out=distances)
+            candidates = np.argpartition(distances, n_results - 1, axis=1)[:, :n_results]
+            order = np.argsort(np.take_along_axis(distances, candidates, axis=1), axis=1, kind="stable")
+            indices = np.take_along_axis(candidates, order, axis=1)
+            all_distances.append(np.take_along_axis(distances, indices, axis=1))
+            all_indices.append(indices)
+        return np.concatenate(all_distances), np.concatenate(all_indices)
+
+
+class _EmbeddingBatcher:
+    """
+    合并多个线程并发提交的检索文本嵌入计算
+    
+    后台线程每次取出队列中已有的全部请求（最多max_batch_size条），用一次encode调用批量计算。
+    不为凑批额外等待：空闲时单个请求立即计算，只有上一批计算期间到达的请求才会合并，低负载时不增加延迟。
+    """
+    
+    def __init__(self, model: SentenceTransformer, max_batch_size: int = 64):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self._queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        # 检索文本 -> (写入时间, 嵌入向量)，与模型一起在进程内共享（由RAGService._embed_queries读写）
+        self.query_cache: "OrderedDict[str, Tuple[float, np.ndarray]]" = OrderedDict()
+        self.query_cache_lock = threading.Lock()
+    
+    def encode(self, text: str) -> np.ndarray:
+        """计算单条文本的嵌入向量，形状与model.encode([text])相同"""
+        return self.encode_many([text])[0]
+    
+    def encode_many(self, texts: List[str]) -> List[np.ndarray]:
+        """一次提交多条文本（后台线程按max_batch_size分批计算），返回与texts一一对应的向量"""
+        return [future.result() for future in self.submit(texts)]
+    
+    def submit(self, texts: List[str]) -> List[Future]:
+        """提交多条文本，立即返回与texts一一对应的Future（协程中可用asyncio.wrap_future等待）"""
+        futures: List[Future] = []
+        for text in texts:
+            future: Future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        if self._worker is None or not self._worker.is_alive():
+            with self._worker_lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._start_worker()
+        return futures
+    
+    def _start_worker(self) -> None:
+        """启动后台计算线程（调用方持有_worker_lock）"""
+        self._worker = threading.Thread(target=self._run, name="rag-embedding-batcher", daemon=True)
+        self._worker.start()
+    
+    def _run(self) -> None:
+        batch: List[Tuple[str, Future]] = []
+        try:
+            while True:
+                # 取出时把Future标记为运行中：已取消的请求（如asyncio.wrap_future的等待方被取消）直接跳过，
+                # 之后等待方的取消不再作用于该Future，set_result不会抛出InvalidStateError
+                item = self._queue.get()
+                while True:
+                    if item[1].set_running_or_notify_cancel():
+                        batch.append(item)
+                    if len(batch) >= self.max_batch_size:
+                        break
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if not batch:
+                    continue
+                
+                try:
+                    embeddings = self.model.encode([text for text, _ in batch], convert_to_tensor=False)
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                    batch = []
+                    continue
+                
+                for index, (_, future) in enumerate(batch):
+                    future.set_result(embeddings[index:index + 1])
+                batch = []
+        finally:
+            # 线程因BaseException（如SystemExit）退出时，正在计算的请求以异常结束，调用方不会永远阻塞；
+            # 队列中还有请求时启动新线程继续处理（之后的submit同样会重新启动）
+            error = RuntimeError("Embedding batcher worker stopped unexpectedly")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            with self._worker_lock:
+                if self._worker is threading.current_thread():
+                    self._worker = None
+                    if not self._queue.empty():
+                        self._start_worker()
+
+
+class _QueryEmbeddingDiskCache:
+    """
+    检索文本嵌入向量的SQLite持久化缓存，进程重启后常见问题不必重新计算
+    
+    键为SHA-256(模型标识|文本)，向量按FP32原样保存（命中时与重新计算的结果完全相同）。
+    作为进程内LRU缓存之后的第二级，由RAGService._embed_queries读写。
+    写入时每隔PRUNE_INTERVAL秒清理一次过期条目，长时间运行的进程中表不会无限增长。
+    """
+    
+    # 单条SQL语句中IN列表的最大参数数（SQLite默认上限999）
+    MAX_QUERY_PARAMS = 500
+    # 写入时清理过期条目的最小间隔（秒）
+    PRUNE_INTERVAL = 600.0
+    
+    def __init__(self, path: Path, model_id: str):
+        self.model_id = model_id
+        self._lock = threading.Lock()
+        self._last_prune = float("-inf")
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "key BLOB PRIMARY KEY, dim INTEGER NOT NULL, vector BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+    
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model_id}|{text}".encode("utf-8")).digest()
+    
+    def get_many(self, texts: List[str], max_age: float) -> Dict[str, np.ndarray]:
+        """读取未过期的向量，返回 文本 -> 形状为(1, 维度)的向量"""
+        texts_by_key = {self._key(text): text for text in texts}
+        keys = list(texts_by_key)
+        oldest = time.time() - max_age
+        found: Dict[str, np.ndarray] = {}
+        with self._lock:
+            for start in range(0, len(keys), self.MAX_QUERY_PARAMS):
+                chunk = keys[start:start + self.MAX_QUERY_PARAMS]
+                rows = self._connection.execute(
+                    "SELECT key, dim, vector FROM query_embeddings "
+                    f"WHERE key IN ({','.join('?' * len(chunk))}) AND created_at >= ?",
+                    (*chunk, oldest)
+                ).fetchall()
+                for key, dim, vector in rows:
+                    found[texts_by_key[key]] = np.frombuffer(vector, dtype=np.float32).reshape(1, dim)
+        return found
+    
+    def put_many(self, texts: List[str], embeddings: List[np.ndarray], max_age: float) -> None:
+        """写入向量（已有的键覆盖并刷新写入时间），距上次清理超过PRUNE_INTERVAL时顺带删除过期条目"""
+        now = time.time()
+        rows = []
+        for text, embedding in zip(texts, embeddings):
+            vector = np.ascontiguousarray(embedding, dtype=np.float32).reshape(-1)
+            rows.append((self._key(text), len(vector), vector.tobytes(), now))
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO query_embeddings (key, dim, vector, created_at) VALUES (?, ?, ?, ?)", rows
+            )
+            if now - self._last_prune >= self.PRUNE_INTERVAL:
+                self._delete_expired(now - max_age)
+                self._last_prune = now
+    
+    def prune(self, max_age: float) -> None:
+        """删除过期的向量"""
+        now = time.time()
+        with self._lock, self._connection:
+            self._delete_expired(now - max_age)
+            self._last_prune = now
+    
+    def _delete_expired(self, oldest: float) -> None:
+        """删除写入时间早于oldest的向量（调用方持有锁并负责提交）"""
+        self._connection.execute("DELETE FROM query_embeddings WHERE created_at < ?", (oldest,))
+
+
+class _MetadataCacheSlot:
+    """同一向量库（存储路径+集合）的元数据缓存，由使用该向量库的所有RAGService实例共享"""
+    
+    # 加载失败后的退避间隔（秒）：期间同一状态的向量库不再重新加载，调用方直接走各自的降级路径
+    RETRY_INTERVAL = 30.0
+    
+    def __init__(self):
+        self.cache: Optional[Dict[str, Any]] = None
+        self.lock = threading.Lock()
+        # 最近一次加载失败：(条目数和索引配置, 失败时间, 异常)
+        self.load_failure: Optional[Tuple[Tuple[Any, ...], float, Exception]] = None
+
 
 class RAGService:
     """
@@ -90,20 +783,11 @@ class RAGService:
         if config:
             self.config.update(config)
         
-        # 初始化ChromaDB客户端
-        self.chroma_client = chromadb.PersistentClient(
-            path=str(self.vector_db_path),
-            settings=Settings(
-                anonymized_telemetry=False,
-                allow_reset=True,
-                is_persistent=True
-            )
+        # 初始化ChromaDB客户端和嵌入模型（进程内按路径/模型共享，见_get_shared_resources）
+        self.chroma_client, self._embedding_batcher = self._get_shared_resources(
+            self.vector_db_path, embedding_model_name, self.config["quantize_embedding_model"]
         )
-        
-        # 初始化嵌入模型
-        logger.info(f"Loading embedding model: {embedding_model_name}")
-        self.embedding_model = SentenceTransformer(embedding_model_name)
-        logger.info("Embedding model loaded successfully")
+        self.embedding_model = self._embedding_batcher.model
         
         # 获取或创建集合
         self.collection_name = "bank_codes"
@@ -116,6 +800,114 @@ class RAGService:
                 metadata={"description": "Bank codes and information for RAG retrieval"}
             )
             logger.info(f"Created new collection: {self.collection_name}")
+        
+        # 精确匹配/关键词检索用的元数据缓存（见_get_metadata_cache），避免每次检索都从ChromaDB拉取全部元数据；
+        # 按向量库在进程内共享，按请求创建的实例也能直接使用已加载的缓存
+        self._metadata_cache_slot = self._get_shared_metadata_cache_slot(
+            self.vector_db_path, self.collection_name
+        )
+        
+        # 检索文本 -> (写入时间, 嵌入向量)，LRU淘汰 + cache_ttl过期（见_embed_query）；
+        # 放在共享的嵌入模型批量计算器上，按请求创建的实例之间也能命中
+        self._query_embedding_cache = self._embedding_batcher.query_cache
+        self._query_embedding_cache_lock = self._embedding_batcher.query_cache_lock
+        
+        # 第二级：向量库目录下的持久化缓存（可选，见_QueryEmbeddingDiskCache）
+        self._query_embedding_disk_cache = None
+        if self.config["cache_enabled"] and self.config["query_embedding_disk_cache"]:
+            try:
+                self._query_embedding_disk_cache = self._get_shared_query_embedding_disk_cache(
+                    self.vector_db_path, embedding_model_name, self.config["quantize_embedding_model"],
+                    self.config["cache_ttl"]
+                )
+            except Exception as e:
+                logger.warning(f"Query embedding disk cache unavailable: {e}")
+    
+    # 进程内共享的ChromaDB客户端（按存储路径）和嵌入模型及其批量计算器（按模型名和是否量化）
+    _shared_chroma_clients: Dict[str, Any] = {}
+    _shared_embedding_batchers: Dict[Tuple[str, bool], _EmbeddingBatcher] = {}
+    _shared_metadata_cache_slots: Dict[Tuple[str, str], _MetadataCacheSlot] = {}
+    _shared_query_embedding_disk_caches: Dict[Tuple[str, str, bool], _QueryEmbeddingDiskCache] = {}
+    _shared_resources_lock = threading.Lock()
+    
+    # 问题向量预计算线程池（所有实例共享），批量检索时在事件循环之外一次计算全部问题的向量
+    _embedding_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rag-embedding")
+    
+    @classmethod
+    def _get_shared_resources(
+        cls,
+        vector_db_path: Path,
+        embedding_model_name: str,
+        quantize: bool
+    ) -> Tuple[Any, _EmbeddingBatcher]:
+        """
+        获取进程内共享的ChromaDB客户端和嵌入模型
+        
+        查询服务、定时任务和各API会各自创建RAGService，嵌入模型加载需要数秒和数百MB内存，
+        因此同一存储路径/模型只在首次使用时创建，之后的实例直接复用（两者都可在多线程中共用）。
+        嵌入模型包装在共享的_EmbeddingBatcher中，所有实例的检索文本向量计算可以合并成批。
+        
+        Returns:
+            (ChromaDB客户端, 嵌入模型的批量计算器)
+        """
+        path_key = str(vector_db_path.resolve())
+        with cls._shared_resources_lock:
+            chroma_client = cls._shared_chroma_clients.get(path_key)
+            if chroma_client is None:
+                chroma_client = chromadb.PersistentClient(
+                    path=str(vector_db_path),
+                    settings=Settings(
+                        anonymized_telemetry=False,
+                        allow_reset=True,
+                        is_persistent=True
+                    )
+                )
+                cls._shared_chroma_clients[path_key] = chroma_client
+            
+            model_key = (embedding_model_name, quantize)
+            embedding_batcher = cls._shared_embedding_batchers.get(model_key)
+            if embedding_batcher is None:
+                logger.info(f"Loading embedding model: {embedding_model_name}")
+                embedding_model = SentenceTransformer(embedding_model_name)
+                if quantize:
+                    embedding_model = cls._quantize_embedding_model(embedding_model)
+                embedding_batcher = _EmbeddingBatcher(embedding_model)
+                cls._shared_embedding_batchers[model_key] = embedding_batcher
+                logger.info("Embedding model loaded successfully")
+        
+        return chroma_client, embedding_batcher
+    
+    @classmethod
+    def _get_shared_metadata_cache_slot(cls, vector_db_path: Path, collection_name: str) -> _MetadataCacheSlot:
+        """获取进程内共享的向量库元数据缓存"""
+        slot_key = (str(vector_db_path.resolve()), collection_name)
+        with cls._shared_resources_lock:
+            slot = cls._shared_metadata_cache_slots.get(slot_key)
+            if slot is None:
+                slot = _MetadataCacheSlot()
+                cls._shared_metadata_cache_slots[slot_key] = slot
+        return slot
+    
+    @classmethod
+    def _get_shared_query_embedding_disk_cache(
+        cls,
+        vector_db_path: Path,
+        embedding_model_name: str,
+        quantize: bool,
+        max_age: float
+    ) -> _QueryEmbeddingDiskCache:
+        """获取进程内共享的检索文本向量持久化缓存（按存储路径和模型），首次打开时清理过期条目"""
+        cache_key = (str(vector_db_path.resolve()), embedding_model_name, quantize)
+        with cls._shared_resources_lock:
+            disk_cache = cls._shared_query_embedding_disk_caches.get(cache_key)
+            if disk_cache is None:
+                disk_cache = _QueryEmbeddingDiskCache(
+                    vector_db_path / "query_embedding_cache.sqlite3",
+                    f"{embedding_model_name}|int8={quantize}"
+                )
+                disk_cache.prune(max_age)
+                cls._shared_query_embedding_disk_caches[cache_key] = disk_cache
+        return disk_cache
     
     def _get_default_config(self) -> Dict[str, Any]:
         """
@@ -144,9 +936,14 @@ class RAGService:
             "enable_hybrid": True,                # 启用混合检索
             
             # 性能优化参数
-            "batch_size": 100,                    # 批处理大小
+            "batch_size": 1000,                   # 批处理大小（入库时每批向量化的文档数）
             "cache_enabled": True,                # 启用缓存
             "cache_ttl": 3600,                   # 缓存过期时间（秒）
+            "query_embedding_disk_cache": False,  # 检索文本向量同时缓存到向量库目录下的SQLite文件（重启后仍可命中）
+            "quantize_embedding_model": False,    # 嵌入模型int8动态量化（仅CPU；开启后需重建向量库）
+            "vector_search_backend": "chromadb",  # 向量检索后端：chromadb（HNSW近似）或flat（内存精确检索，适合10万条以内）
+            "flat_index_fp16": True,              # flat后端用FP16存储向量（需安装faiss）
+            "flat_index_int8": False,             # flat后端用8位标量量化存储向量（需安装faiss，优先于FP16，距离为近似值）
         }
     
     def get_config(self) -> Dict[str, Any]:
@@ -294,8 +1091,184 @@ class RAGService:
                 raise ValueError("cache_ttl必须在60-86400秒之间")
             validated["cache_ttl"] = cache_ttl
         
+        if "query_embedding_disk_cache" in config:
+            validated["query_embedding_disk_cache"] = bool(config["query_embedding_disk_cache"])
+        
+        if "quantize_embedding_model" in config:
+            validated["quantize_embedding_model"] = bool(config["quantize_embedding_model"])
+        
+        if "vector_search_backend" in config:
+            if config["vector_search_backend"] not in ("chromadb", "flat"):
+                raise ValueError("vector_search_backend必须是chromadb或flat")
+            validated["vector_search_backend"] = config["vector_search_backend"]
+        
+        if "flat_index_fp16" in config:
+            validated["flat_index_fp16"] = bool(config["flat_index_fp16"])
+        
+        if "flat_index_int8" in config:
+            validated["flat_index_int8"] = bool(config["flat_index_int8"])
+        
         return validated
     
+    @staticmethod
+    def _quantize_embedding_model(model: SentenceTransformer) -> SentenceTransformer:
+        """
+        将嵌入模型的全连接层动态量化为int8（CPU推理约快2-3倍）
+        
+        量化后的向量与FP32模型略有差异，已有向量库需要用量化模型重建（initialize_vector_db(force_rebuild=True)），
+        否则问题向量与库中向量来自不同模型。量化失败时继续使用原模型。
+        
+        Args:
+            model: 已加载的嵌入模型
+        
+        Returns:
+            量化后的模型；不在CPU上或量化失败时返回原模型
+        """
+        if model.device.type != "cpu":
+            logger.info("Embedding model is not on CPU, skipping int8 quantization")
+            return model
+        
+        try:
+            quantized_model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+            logger.info("Embedding model quantized to int8")
+            return quantized_model
+        except Exception as e:
+            logger.warning(f"Embedding model quantization failed, using FP32 model: {e}")
+            return model
+    
+    def _encode_documents(self, documents: List[str]) -> List[List[float]]:
+        """
+        批量生成入库文档的嵌入向量
+        
+        sentence-transformers在一次encode调用内按文本长度排序后再分小批前向计算，最后还原顺序，
+        因此整批文档一次传入（批越大，同一小批内长度越接近）可以减少padding带来的无效计算。
+        
+        Args:
+            documents: 文档文本列表
+        
+        Returns:
+            与documents顺序一致的嵌入向量列表
+        """
+        embeddings = self.embedding_model.encode(
+            documents,
+            convert_to_tensor=False,
+            show_progress_bar=False
+        )
+        return embeddings.tolist()
+    
+    def _embed_query(self, text: str) -> np.ndarray:
+        """
+        生成检索文本的嵌入向量，相同文本在cache_ttl内直接复用
+        
+        按原文缓存（不做大小写等归一化）：嵌入模型的分词区分大小写，归一化后向量会变。
+        需要计算时交给共享的_EmbeddingBatcher，与其他线程同时提交的文本合并计算。
+        
+        Args:
+            text: 检索文本
+        
+        Returns:
+            形状为(1, 维度)的向量，调用方不得修改
+        """
+        return self._embed_queries([text])[0]
+    
+    def _embed_queries(self, texts: List[str]) -> List[np.ndarray]:
+        """
+        批量生成检索文本的嵌入向量，缓存未命中的文本一次提交给_EmbeddingBatcher
+        
+        Args:
+            texts: 检索文本列表
+        
+        Returns:
+            与texts一一对应、形状为(1, 维度)的向量列表，调用方不得修改
+        """
+        now = time.monotonic()
+        embeddings = self._get_cached_query_embeddings(texts, now)
+        missing = [text for text in dict.fromkeys(texts) if text not in embeddings]
+        if missing:
+            stored = self._get_disk_cached_query_embeddings(missing)
+            self._cache_query_embeddings(list(stored), list(stored.values()), now)
+            embeddings.update(stored)
+            missing = [text for text in missing if text not in stored]
+        if missing:
+            computed = self._embedding_batcher.encode_many(missing)
+            self._cache_query_embeddings(missing, computed, now)
+            self._disk_cache_query_embeddings(missing, computed)
+            embeddings.update(zip(missing, computed))
+        
+        return [embeddings[text] for text in texts]
+    
+    async def _embed_query_async(self, text: str) -> np.ndarray:
+        """
+        _embed_query的协程版本：需要计算时等待批量计算器的结果，计算期间不阻塞事件循环
+        
+        持久化缓存的读写（SQLite查询、提交）同样在线程池中进行，不阻塞事件循环。
+        
+        Args:
+            text: 检索文本
+        
+        Returns:
+            形状为(1, 维度)的向量，调用方不得修改
+        """
+        now = time.monotonic()
+        embedding = self._get_cached_query_embeddings([text], now).get(text)
+        if embedding is None:
+            use_disk_cache = self._query_embedding_disk_cache is not None and self.config["cache_enabled"]
+            if use_disk_cache:
+                embedding = (await asyncio.to_thread(self._get_disk_cached_query_embeddings, [text])).get(text)
+            if embedding is None:
+                embedding = await asyncio.wrap_future(self._embedding_batcher.submit([text])[0])
+                if use_disk_cache:
+                    await asyncio.to_thread(self._disk_cache_query_embeddings, [text], [embedding])
+            self._cache_query_embeddings([text], [embedding], now)
+        return embedding
+    
+    def _get_cached_query_embeddings(self, texts: List[str], now: float) -> Dict[str, np.ndarray]:
+        """查询向量缓存中未过期的条目（关闭缓存时返回空字典）"""
+        embeddings: Dict[str, np.ndarray] = {}
+        if not self.config["cache_enabled"]:
+            return embeddings
+        
+        with self._query_embedding_cache_lock:
+            for text in texts:
+                entry = self._query_embedding_cache.get(text)
+                if entry is not None and now - entry[0] < self.config["cache_ttl"]:
+                    self._query_embedding_cache.move_to_end(text)
+                    embeddings[text] = entry[1]
+        return embeddings
+    
+    def _get_disk_cached_query_embeddings(self, texts: List[str]) -> Dict[str, np.ndarray]:
+        """查询持久化缓存（未启用或读取失败时返回空字典）"""
+        if self._query_embedding_disk_cache is None or not self.config["cache_enabled"]:
+            return {}
+        try:
+            return self._query_embedding_disk_cache.get_many(texts, self.config["cache_ttl"])
+        except Exception as e:
+            logger.warning(f"Query embedding disk cache read failed: {e}")
+            return {}
+    
+    def _disk_cache_query_embeddings(self, texts: List[str], embeddings: List[np.ndarray]) -> None:
+        """写入持久化缓存（未启用时跳过，写入失败只记录日志）"""
+        if self._query_embedding_disk_cache is None or not self.config["cache_enabled"]:
+            return
+        try:
+            self._query_embedding_disk_cache.put_many(texts, embeddings, self.config["cache_ttl"])
+        except Exception as e:
+            logger.warning(f"Query embedding disk cache write failed: {e}")
+    
+    def _cache_query_embeddings(self, texts: List[str], embeddings: List[np.ndarray], now: float) -> None:
+        """写入向量缓存并按LRU淘汰超出容量的条目（关闭缓存时不写入）"""
+        if not self.config["cache_enabled"]:
+            return
+        
+        with self._query_embedding_cache_lock:
+            for text, embedding in zip(texts, embeddings):
+                self._query_embedding_cache[text] = (now, embedding)
+                self._query_embedding_cache.move_to_end(text)
+            while len(self._query_embedding_cache) > _QUERY_EMBEDDING_CACHE_SIZE:
+                self._query_embedding_cache.popitem(last=False)
+    
     def _create_document_text(self, bank_record: BankCode) -> str:
         """
         创建用于向量化的文档文本
@@ -330,170 +1303,39 @@ class RAGService:
         # 常见银行关键词
         bank_keywords = []
         
-        # 主要银行简称映射 - 大幅扩展版本
-        bank_mappings = {
-            # 国有大型银行
-            "中国工商银行": ["工商银行", "工行", "ICBC", "中国工商", "工商", "工商行"],
-            "中国农业银行": ["农业银行", "农行", "ABC", "中国农业", "农业", "农行银行"],
-            "中国银行": ["中行", "BOC", "中银", "中国银行"],
-            "中国建设银行": ["建设银行", "建行", "CCB", "中国建设", "建设", "建行银行"],
-            
-            # 股份制银行
-            "交通银行": ["交行", "BOCOM", "交通", "交银"],
-            "中国邮政储蓄银行": ["邮储银行", "邮政银行", "PSBC", "邮储", "邮政储蓄", "邮政", "邮储行", "邮政行"],
-            "招商银行": ["招行", "CMB", "招商", "招银"],
-            "浦发银行": ["上海浦东发展银行", "SPDB", "浦东发展银行", "浦东发展", "浦发", "浦东银行"],
-            "中信银行": ["CITIC", "中信", "中信行"],
-            "中国光大银行": ["光大银行", "CEB", "光大", "光大行"],
-            "华夏银行": ["HXB", "华夏", "华夏行"],
-            "中国民生银行": ["民生银行", "CMBC", "民生", "民生行"],
-            "广发银行": ["CGB", "广发", "广东发展银行", "广发行", "广东发展"],
-            "平安银行": ["PAB", "平安", "平安行"],
-            "兴业银行": ["CIB", "兴业", "兴业行"],
-            
-            # 城市商业银行
-            "北京银行": ["BOB", "北京", "北京行", "京行"],
-            "上海银行": ["BOS", "上海", "上海行", "沪行"],
-            "江苏银行": ["江苏", "江苏行", "苏行"],
-            "浙商银行": ["浙商", "浙商行"],
-            "渤海银行": ["渤海", "渤海行"],
-            "恒丰银行": ["恒丰", "恒丰行"],
-            "南京银行": ["南京", "南京行", "宁行"],
-            "宁波银行": ["宁波", "宁波行", "甬行"],
-            "杭州银行": ["杭州", "杭州行", "杭行"],
-            "徽商银行": ["徽商", "徽商行", "皖行"],
-            "长沙银行": ["长沙", "长沙行", "湘行"],
-            "郑州银行": ["郑州", "郑州行", "豫行"],
-            "青岛银行": ["青岛", "青岛行", "青行"],
-            "大连银行": ["大连", "大连行", "连行"],
-            "哈尔滨银行": ["哈尔滨", "哈尔滨行", "哈行"],
-            "盛京银行": ["盛京", "盛京行"],
-            "锦州银行": ["锦州", "锦州行"],
-            
-            # 农村商业银行
-            "北京农商银行": ["北京农商", "京农商", "北京农村商业银行"],
-            "上海农商银行": ["上海农商", "沪农商", "上海农村商业银行"],
-            "重庆农商银行": ["重庆农商", "渝农商", "重庆农村商业银行"],
-            "广州农商银行": ["广州农商", "穗农商", "广州农村商业银行"],
-            "深圳农商银行": ["深圳农商", "深农商", "深圳农村商业银行"],
-            
-            # 外资银行
-            "东亚银行": ["东亚", "东亚行", "BEA"],
-            "花旗银行": ["花旗", "花旗行", "Citibank"],
-            "汇丰银行": ["汇丰", "汇丰行", "HSBC"],
-            "渣打银行": ["渣打", "渣打行", "Standard Chartered"],
-            "星展银行": ["星展", "星展行", "DBS"],
-            "三菱银行": ["三菱", "三菱行", "MUFG"],
-            "三井银行": ["三井", "三井行", "SMBC"],
-            
-            # 政策性银行
-            "国家开发银行": ["国开行", "国家开发", "CDB"],
-            "中国进出口银行": ["进出口银行", "进出口行", "EXIM"],
-            "中国农业发展银行": ["农发行", "农业发展银行", "ADBC"],
-            
-            # 其他银行
-            "中国银联": ["银联", "UnionPay"],
-            "网商银行": ["网商", "网商行"],
-            "微众银行": ["微众", "微众行"],
-            "新网银行": ["新网", "新网行"],
-            "亿联银行": ["亿联", "亿联行"]
-        }
-        
         # 添加完整银行名称
         bank_keywords.append(bank_name)
         
-        # 查找匹配的简称 - 使用更精确的匹配
-        for full_name, aliases in bank_mappings.items():
+        # 一次扫描找出名称中出现的所有词，下面只做集合判断
+        found = _BANK_KEYWORD_MATCHER.find(bank_name)
+        
+        # 查找匹配的简称 - 使用更精确的匹配（按映射表顺序，只看名称中出现过的词所在的条目）
+        entry_indices = sorted({
+            index for word in found for index in _BANK_KEYWORD_ALIAS_ENTRIES.get(word, ())
+        })
+        for index in entry_indices:
+            full_name, aliases = _BANK_KEYWORD_ALIAS_ITEMS[index]
             # 完全匹配或包含匹配
-            if full_name == bank_name or full_name in bank_name:
+            if full_name in found:
                 bank_keywords.extend(aliases)
                 break
             # 检查是否银行名称包含任何别名
             for alias in aliases:
-                if alias in bank_name and len(alias) >= 2:  # 至少2个字符的别名
+                if alias in found and len(alias) >= 2:  # 至少2个字符的别名
                     bank_keywords.extend([full_name] + aliases)
                     break
         
-        # 提取地理位置信息 - 大幅扩展版本
-        locations = []
-        common_locations = [
-            # 直辖市
-            "北京", "上海", "天津", "重庆",
-            # 省会城市
-            "石家庄", "太原", "呼和浩特", "沈阳", "长春", "哈尔滨",
-            "南京", "杭州", "合肥", "福州", "南昌", "济南", "郑州",
-            "武汉", "长沙", "广州", "南宁", "海口", "成都", "贵阳",
-            "昆明", "拉萨", "西安", "兰州", "西宁", "银川", "乌鲁木齐",
-            # 计划单列市
-            "厦门", "深圳", "青岛", "大连", "宁波",
-            # 重要地级市
-            "苏州", "无锡", "常州", "温州", "嘉兴", "湖州", "绍兴", "金华", 
-            "衢州", "舟山", "台州", "丽水", "芜湖", "蚌埠", "淮南", "马鞍山", 
-            "淮北", "铜陵", "安庆", "黄山", "滁州", "阜阳", "宿州", "六安", 
-            "亳州", "池州", "宣城", "莆田", "三明", "泉州", "漳州", "南平", 
-            "龙岩", "宁德", "景德镇", "萍乡", "九江", "新余", "鹰潭", "赣州", 
-            "吉安", "宜春", "抚州", "上饶", "淄博", "枣庄", "东营", "烟台", 
-            "潍坊", "济宁", "泰安", "威海", "日照", "莱芜", "临沂", "德州", 
-            "聊城", "滨州", "菏泽", "开封", "洛阳", "平顶山", "安阳", "鹤壁", 
-            "新乡", "焦作", "濮阳", "许昌", "漯河", "三门峡", "南阳", "商丘", 
-            "信阳", "周口", "驻马店", "黄石", "十堰", "宜昌", "襄阳", "鄂州", 
-            "荆门", "孝感", "荆州", "黄冈", "咸宁", "随州", "恩施", "株洲", 
-            "湘潭", "衡阳", "邵阳", "岳阳", "常德", "张家界", "益阳", "郴州", 
-            "永州", "怀化", "娄底", "韶关", "珠海", "汕头", "佛山", "江门", 
-            "湛江", "茂名", "肇庆", "惠州", "梅州", "汕尾", "河源", "阳江", 
-            "清远", "东莞", "中山", "潮州", "揭阳", "云浮", "柳州", "桂林", 
-            "梧州", "北海", "防城港", "钦州", "贵港", "玉林", "百色", "贺州", 
-            "河池", "来宾", "崇左", "三亚", "三沙", "儋州", "自贡", "攀枝花", 
-            "泸州", "德阳", "绵阳", "广元", "遂宁", "内江", "乐山", "南充", 
-            "眉山", "宜宾", "广安", "达州", "雅安", "巴中", "资阳", "江油", 
-            "六盘水", "遵义", "安顺", "毕节", "铜仁", "曲靖", "玉溪", "保山", 
-            "昭通", "丽江", "普洱", "临沧", "昌都", "山南", "日喀则", "那曲", 
-            "阿里", "林芝", "铜川", "宝鸡", "咸阳", "渭南", "延安", "汉中", 
-            "榆林", "安康", "商洛", "嘉峪关", "金昌", "白银", "天水", "武威", 
-            "张掖", "平凉", "酒泉", "庆阳", "定西", "陇南", "海东", "石嘴山", 
-            "吴忠", "固原", "中卫", "克拉玛依", "吐鲁番", "哈密"
-        ]
-        
-        for location in common_locations:
-            if location in bank_name:
-                locations.append(location)
+        # 提取地理位置信息
+        bank_keywords.extend(_BANK_KEYWORD_MATCHER.in_order(found, "locations"))
         
-        bank_keywords.extend(locations)
-        
-        # 提取支行、分行等类型信息 - 扩展版本
-        branch_types = [
-            "支行", "分行", "分理处", "储蓄所", "营业部", "营业厅", "网点", 
-            "分支机构", "办事处", "代理点", "服务点", "自助银行", "便民服务点"
-        ]
-        for branch_type in branch_types:
-            if branch_type in bank_name:
-                bank_keywords.append(branch_type)
-        
-        # 提取特殊区域标识 - 新增功能
-        special_areas = [
-            # 开发区
-            "开发区", "高新区", "经济开发区", "技术开发区", "工业园区", "科技园",
-            "保税区", "自贸区", "新区", "示范区", "试验区",
-            # 商业区
-            "CBD", "商务区", "金融区", "商业区", "购物中心", "广场", "大厦",
-            "中心", "城", "港", "湾", "岛", "山", "湖", "河", "桥", "路", "街",
-            # 交通枢纽
-            "机场", "火车站", "高铁站", "地铁站", "汽车站", "港口", "码头"
-        ]
+        # 提取支行、分行等类型信息
+        bank_keywords.extend(_BANK_KEYWORD_MATCHER.in_order(found, "branch_types"))
         
-        for area in special_areas:
-            if area in bank_name:
-                bank_keywords.append(area)
+        # 提取特殊区域标识
+        bank_keywords.extend(_BANK_KEYWORD_MATCHER.in_order(found, "special_areas"))
         
-        # 去重并过滤短关键词
-        unique_keywords = []
-        seen = set()
-        for keyword in bank_keywords:
-            if keyword not in seen and len(keyword) >= 2:  # 至少2个字符
-                seen.add(keyword)
-                unique_keywords.append(keyword)
-        
-        return unique_keywords
+        # 去重（保持顺序）并过滤短关键词（至少2个字符）
+        return list(dict.fromkeys(keyword for keyword in bank_keywords if len(keyword) >= 2))
     
     def _extract_question_entities(self, question: str) -> Dict[str, str]:
         """
@@ -505,8 +1347,6 @@ class RAGService:
         Returns:
             提取的实体字典
         """
-        import re
-        
         entities = {
             'bank_name': None,
             'bank_type': None,
@@ -521,208 +1361,328 @@ class RAGService:
             entities['full_name'] = question.strip()
             logger.info(f"RAG: Detected full bank name: {entities['full_name']}")
         
-        # 银行名称映射（大幅扩展，支持更多银行简称和别名）
-        bank_mappings = {
-            # 国有大型银行
-            '工商银行': '中国工商银行',
-            '工行': '中国工商银行',
-            'ICBC': '中国工商银行',
-            '农业银行': '中国农业银行',
-            '农行': '中国农业银行', 
-            'ABC': '中国农业银行',
-            '中国银行': '中国银行',
-            '中行': '中国银行',
-            'BOC': '中国银行',
-            '建设银行': '中国建设银行',
-            '建行': '中国建设银行',
-            'CCB': '中国建设银行',
-            
-            # 股份制银行
-            '交通银行': '交通银行',
-            '交行': '交通银行',
-            'BOCOM': '交通银行',
-            '招商银行': '招商银行',
-            '招行': '招商银行',
-            'CMB': '招商银行',
-            '浦发银行': '上海浦东发展银行',
-            '浦东发展银行': '上海浦东发展银行',
-            'SPDB': '上海浦东发展银行',
-            '中信银行': '中信银行',
-            '中信': '中信银行',
-            'CITIC': '中信银行',
-            '光大银行': '中国光大银行',
-            '光大': '中国光大银行',
-            'CEB': '中国光大银行',
-            '华夏银行': '华夏银行',
-            '华夏': '华夏银行',
-            'HXB': '华夏银行',
-            '民生银行': '中国民生银行',
-            '民生': '中国民生银行',
-            'CMBC': '中国民生银行',
-            '广发银行': '广发银行',
-            '广发': '广发银行',
-            'CGB': '广发银行',
-            '广东发展银行': '广发银行',
-            '平安银行': '平安银行',
-            '平安': '平安银行',
-            'PAB': '平安银行',
-            '兴业银行': '兴业银行',
-            '兴业': '兴业银行',
-            'CIB': '兴业银行',
-            
-            # 邮政储蓄银行
-            '邮储银行': '中国邮政储蓄银行',
-            '邮政储蓄银行': '中国邮政储蓄银行',
-            '邮政银行': '中国邮政储蓄银行',
-            '邮储': '中国邮政储蓄银行',
-            '邮政储蓄': '中国邮政储蓄银行',
-            'PSBC': '中国邮政储蓄银行',
-            
-            # 城市商业银行
-            '北京银行': '北京银行',
-            'BOB': '北京银行',
-            '上海银行': '上海银行',
-            'BOS': '上海银行',
-            '江苏银行': '江苏银行',
-            '浙商银行': '浙商银行',
-            '浙商': '浙商银行',
-            '渤海银行': '渤海银行',
-            '渤海': '渤海银行',
-            '恒丰银行': '恒丰银行',
-            '恒丰': '恒丰银行',
-            '南京银行': '南京银行',
-            '宁波银行': '宁波银行',
-            '杭州银行': '杭州银行',
-            '徽商银行': '徽商银行',
-            '长沙银行': '长沙银行',
-            '郑州银行': '郑州银行',
-            '青岛银行': '青岛银行',
-            '大连银行': '大连银行',
-            '哈尔滨银行': '哈尔滨银行',
-            '盛京银行': '盛京银行',
-            '锦州银行': '锦州银行',
-            
-            # 外资银行
-            '东亚银行': '东亚银行',
-            '花旗银行': '花旗银行',
-            '花旗': '花旗银行',
-            '汇丰银行': '汇丰银行',
-            '汇丰': '汇丰银行',
-            '渣打银行': '渣打银行',
-            '渣打': '渣打银行',
-            '星展银行': '星展银行',
-            '星展': '星展银行',
-            '三菱银行': '三菱银行',
-            '三井银行': '三井银行'
-        }
+        # 一次扫描找出问题中出现的银行名称、城市和商业区
+        found = _QUESTION_ENTITY_MATCHER.find(question)
         
-        # 提取银行名称 - 增强匹配逻辑
-        for short_name, full_name in bank_mappings.items():
-            if short_name in question:
-                entities['bank_name'] = full_name
-                entities['bank_type'] = short_name
-                entities['keywords'].append(short_name)
-                entities['keywords'].append(full_name)
-                break
+        # 提取银行名称 - 增强匹配逻辑（简称表中最靠前的匹配优先）
+        short_names = _QUESTION_ENTITY_MATCHER.in_order(found, "short_names")
+        if short_names:
+            short_name = short_names[0]
+            full_name = _QUESTION_BANK_NAMES[short_name]
+            entities['bank_name'] = full_name
+            entities['bank_type'] = short_name
+            entities['keywords'].append(short_name)
+            entities['keywords'].append(full_name)
         
         # 如果没有找到简称，尝试完整名称匹配
         if not entities['bank_name']:
-            for full_name in bank_mappings.values():
-                if full_name in question:
-                    entities['bank_name'] = full_name
-                    entities['bank_type'] = full_name
-                    entities['keywords'].append(full_name)
-                    break
-        
-        # 提取地理位置 - 大幅扩展城市列表
-        locations = [
-            # 直辖市
-            '北京', '上海', '天津', '重庆',
-            # 省会城市和计划单列市
-            '广州', '深圳', '厦门', '青岛', '大连', '宁波', '苏州', '杭州', '南京', 
-            '武汉', '成都', '西安', '长沙', '郑州', '济南', '合肥', '福州', '南昌', 
-            '太原', '石家庄', '沈阳', '长春', '哈尔滨', '昆明', '贵阳', '南宁', 
-            '海口', '兰州', '银川', '西宁', '乌鲁木齐', '拉萨', '呼和浩特',
-            # 重要地级市
-            '无锡', '常州', '温州', '嘉兴', '湖州', '绍兴', '金华', '衢州', 
-            '舟山', '台州', '丽水', '芜湖', '蚌埠', '淮南', '马鞍山', '淮北', 
-            '铜陵', '安庆', '黄山', '滁州', '阜阳', '宿州', '六安', '亳州', 
-            '池州', '宣城', '莆田', '三明', '泉州', '漳州', '南平', '龙岩', 
-            '宁德', '景德镇', '萍乡', '九江', '新余', '鹰潭', '赣州', '吉安', 
-            '宜春', '抚州', '上饶', '淄博', '枣庄', '东营', '烟台', '潍坊', 
-            '济宁', '泰安', '威海', '日照', '莱芜', '临沂', '德州', '聊城', 
-            '滨州', '菏泽', '开封', '洛阳', '平顶山', '安阳', '鹤壁', '新乡', 
-            '焦作', '濮阳', '许昌', '漯河', '三门峡', '南阳', '商丘', '信阳', 
-            '周口', '驻马店', '黄石', '十堰', '宜昌', '襄阳', '鄂州', '荆门', 
-            '孝感', '荆州', '黄冈', '咸宁', '随州', '恩施', '株洲', '湘潭', 
-            '衡阳', '邵阳', '岳阳', '常德', '张家界', '益阳', '郴州', '永州', 
-            '怀化', '娄底', '韶关', '珠海', '汕头', '佛山', '江门', '湛江', 
-            '茂名', '肇庆', '惠州', '梅州', '汕尾', '河源', '阳江', '清远', 
-            '东莞', '中山', '潮州', '揭阳', '云浮', '柳州', '桂林', '梧州', 
-            '北海', '防城港', '钦州', '贵港', '玉林', '百色', '贺州', '河池', 
-            '来宾', '崇左', '三亚', '三沙', '儋州'
-        ]
-        
-        for location in locations:
-            if location in question:
-                entities['location'] = location
-                entities['keywords'].append(location)
-                break
-        
-        # 提取支行名称（更精确的模式）- 增强支行类型识别
-        branch_patterns = [
-            r'([^银行]{2,12}支行)',
-            r'([^银行]{2,12}分行)',
-            r'([^银行]{2,12}营业部)',
-            r'([^银行]{2,12}营业厅)',
-            r'([^银行]{2,12}分理处)',
-            r'([^银行]{2,12}储蓄所)',
-            r'([^银行]{2,12}网点)'
-        ]
+            full_names = _QUESTION_ENTITY_MATCHER.in_order(found, "full_names")
+            if full_names:
+                full_name = full_names[0]
+                entities['bank_name'] = full_name
+                entities['bank_type'] = full_name
+                entities['keywords'].append(full_name)
         
-        for pattern in branch_patterns:
-            match = re.search(pattern, question)
+        # 提取地理位置
+        locations = _QUESTION_ENTITY_MATCHER.in_order(found, "locations")
+        if locations:
+            entities['location'] = locations[0]
+            entities['keywords'].append(locations[0])
+        
+        # 提取支行名称（更精确的模式）
+        for suffix, pattern in _QUESTION_BRANCH_PATTERNS:
+            # 问题中没有该后缀时不必运行正则
+            if suffix not in question:
+                continue
+            match = pattern.search(question)
             if match:
                 branch_full = match.group(1)
                 # 提取支行名称（去掉类型后缀）
-                for suffix in ['支行', '分行', '营业部', '营业厅', '分理处', '储蓄所', '网点']:
-                    if branch_full.endswith(suffix):
-                        entities['branch_name'] = branch_full[:-len(suffix)].strip()
-                        break
-                else:
-                    entities['branch_name'] = branch_full.strip()
+                entities['branch_name'] = branch_full[:-len(suffix)].strip()
                 entities['keywords'].append(branch_full)
                 break
         
         # 特殊处理：商业区、商圈、地标等
-        commercial_areas = [
-            # 北京
-            '西单', '王府井', '中关村', '国贸', '金融街', '望京', '三里屯', 
-            '朝阳门', '建国门', '复兴门', '西直门', '东直门', '安定门', '崇文门',
-            '宣武门', '阜成门', '德胜门', '和平门', '前门', '天安门', '雍和宫',
-            '北京站', '北京西站', '北京南站', '首都机场', '大兴机场',
-            # 上海
-            '陆家嘴', '外滩', '南京路', '淮海路', '徐家汇', '人民广场', '静安寺',
-            '虹桥', '浦东', '黄浦', '长宁', '普陀', '闸北', '虹口', '杨浦',
-            '闵行', '宝山', '嘉定', '金山', '松江', '青浦', '奉贤', '崇明',
-            # 广州
-            '天河', '越秀', '荔湾', '海珠', '白云', '黄埔', '番禺', '花都',
-            '南沙', '从化', '增城', '珠江新城', '体育中心', '五羊新城',
-            # 深圳
-            '福田', '罗湖', '南山', '宝安', '龙岗', '盐田', '龙华', '坪山',
-            '光明', '大鹏', '华强北', '科技园', '蛇口', '前海'
+        for area in _QUESTION_ENTITY_MATCHER.in_order(found, "commercial_areas"):
+            if not entities['branch_name']:
+                entities['branch_name'] = area
+            entities['keywords'].append(area)
+            # 如果是知名商业区，也可能是地理位置
+            if not entities['location'] and area in _QUESTION_LANDMARK_LOCATIONS:
+                entities['location'] = area
+        
+        return entities
+    
+    def _refresh_metadata_cache(self) -> None:
+        """向量库内容变化后重建元数据缓存（之后的检索不必再等待加载）"""
+        with self._metadata_cache_slot.lock:
+            self._metadata_cache_slot.cache = None
+        try:
+            self._get_metadata_cache()
+        except Exception as e:
+            logger.warning(f"Failed to rebuild metadata cache: {e}")
+    
+    def _get_metadata_cache(self) -> Optional[Dict[str, Any]]:
+        """
+        向量库全部元数据的本地缓存
+        
+        首次使用时从ChromaDB加载一次，并预先计算小写名称数组和每个名称的字符集合，
+        检索时用NumPy向量化比较；向量检索后端为flat时同时加载全部向量和文档，建立内存精确检索索引。
+        同一向量库的所有实例共享，更新向量库后立即重建；条目数变化（其他进程更新了向量库）
+        或修改向量检索后端配置时重新加载。加载失败后_MetadataCacheSlot.RETRY_INTERVAL秒内不再重试。
+        
+        Returns:
+            缓存字典；向量库为空时返回None
+        """
+        count = self.collection.count()
+        backend = self.config["vector_search_backend"]
+        vector_index_config = (backend, self.config["flat_index_fp16"], self.config["flat_index_int8"])
+        slot = self._metadata_cache_slot
+        cache = slot.cache
+        if cache is not None and cache["count"] == count and cache["vector_index_config"] == vector_index_config:
+            return cache
+        
+        with slot.lock:
+            cache = slot.cache
+            if cache is not None and cache["count"] == count and cache["vector_index_config"] == vector_index_config:
+                return cache
+            
+            # 最近一次加载失败且向量库状态未变时，在退避间隔内直接失败，不再每次查询都重新读取全部元数据和向量
+            load_key = (count, vector_index_config)
+            failure = slot.load_failure
+            if (failure is not None and failure[0] == load_key
+                    and time.monotonic() - failure[1] < slot.RETRY_INTERVAL):
+                raise RuntimeError(f"Metadata cache load failed recently, retrying later: {failure[2]}")
+            
+            try:
+                cache = self._load_metadata_cache(count, backend, vector_index_config)
+            except Exception as e:
+                slot.load_failure = (load_key, time.monotonic(), e)
+                raise
+            slot.load_failure = None
+            if cache is None:
+                return None
+            slot.cache = cache
+            logger.info(f"RAG: Cached metadata for {len(cache['metadatas'])} banks")
+            return cache
+    
+    def _load_metadata_cache(
+        self,
+        count: int,
+        backend: str,
+        vector_index_config: Tuple[Any, ...]
+    ) -> Optional[Dict[str, Any]]:
+        """从ChromaDB读取全部元数据（flat后端同时读取向量和文档）并构建缓存字典，向量库为空时返回None"""
+        include = ["metadatas"]
+        if backend == "flat":
+            include += ["embeddings", "documents"]
+        all_results = self.collection.get(include=include)
+        metadatas = all_results["metadatas"]
+        if not metadatas:
+            return None
+        
+        # 入库时已写入小写名称；旧版本入库的数据没有该字段时现算
+        names_lower = [
+            metadata.get("bank_name_lower") or metadata["bank_name"].lower()
+            for metadata in metadatas
         ]
         
-        for area in commercial_areas:
-            if area in question:
-                if not entities['branch_name']:
-                    entities['branch_name'] = area
-                entities['keywords'].append(area)
-                # 如果是知名商业区，也可能是地理位置
-                if not entities['location'] and area in ['西单', '王府井', '中关村', '国贸', '金融街', '陆家嘴', '外滩']:
-                    entities['location'] = area
+        # 字符重叠度：每个名称去重后的字符数，以及字符id -> 包含该字符的条目下标（升序）
+        char_ids: Dict[str, int] = {}
+        name_chars = [
+            [char_ids.setdefault(char, len(char_ids)) for char in set(name)]
+            for name in names_lower
+        ]
+        char_counts = np.array([len(chars) for chars in name_chars], dtype=np.int64)
+        char_flat = np.fromiter(itertools.chain.from_iterable(name_chars), dtype=np.int64)
+        char_rows = np.repeat(np.arange(len(name_chars), dtype=np.int64), char_counts)
+        # 倒排表由_find_names_containing直接返回给调用方：设为只读，原地修改会破坏共享的索引
+        sorted_rows = char_rows[np.argsort(char_flat, kind="stable")]
+        sorted_rows.setflags(write=False)
+        char_postings = np.split(
+            sorted_rows,
+            np.cumsum(np.bincount(char_flat, minlength=len(char_ids)))[:-1]
+        )
         
-        return entities
+        # 名称n-gram倒排索引：n-gram -> 包含它的条目下标（升序）
+        gram_index: Dict[str, List[int]] = {}
+        for index, name in enumerate(names_lower):
+            for gram in {
+                name[start:start + size]
+                for size in _NAME_INDEX_GRAM_SIZES
+                for start in range(len(name) - size + 1)
+            }:
+                gram_index.setdefault(gram, []).append(index)
+        
+        cache = {
+            "count": count,
+            "metadatas": metadatas,
+            "names_lower": names_lower,
+            "names_array": np.array(names_lower, dtype=str),
+            "name_lengths": np.array([len(name) for name in names_lower], dtype=np.int64),
+            "char_ids": char_ids,
+            "char_counts": char_counts,
+            "char_postings": char_postings,
+            "gram_index": gram_index,
+            # 全部条目的小写关键词（元数据keywords字段）
+            "keyword_vocabulary": frozenset(
+                keyword.lower()
+                for metadata in metadatas
+                for keyword in metadata.get("keywords", "").split(",")
+            ),
+            "vector_index_config": vector_index_config,
+        }
+        if backend == "flat":
+            cache["documents"] = all_results["documents"]
+            cache["flat_index"] = _FlatL2Index(
+                np.asarray(all_results["embeddings"], dtype=np.float32),
+                fp16=self.config["flat_index_fp16"],
+                int8=self.config["flat_index_int8"]
+            )
+        return cache
+    
+    def _query_vectors(
+        self,
+        query_embedding: np.ndarray,
+        n_results: int,
+        include: List[str]
+    ) -> Dict[str, Any]:
+        """
+        向量检索，返回与collection.query相同结构的结果
+        
+        向量检索后端为flat时在内存索引中精确检索（加载或检索失败时退回ChromaDB），否则交给ChromaDB。
+        """
+        if self.config["vector_search_backend"] == "flat":
+            try:
+                cache = self._get_metadata_cache()
+                if cache is None:
+                    return {"documents": [[]], "metadatas": [[]], "distances": [[]]}
+                distances, indices = cache["flat_index"].search(query_embedding, n_results)
+                return {
+                    "documents": [[cache["documents"][index] for index in indices]],
+                    "metadatas": [[cache["metadatas"][index] for index in indices]],
+                    "distances": [distances.tolist()],
+                }
+            except Exception as e:
+                logger.warning(f"Flat vector search failed, falling back to ChromaDB: {e}")
+        
+        return self.collection.query(
+            query_embeddings=query_embedding.tolist(),
+            n_results=n_results,
+            include=include
+        )
+    
+    @staticmethod
+    def _char_overlap(cache: Dict[str, Any], text: str):
+        """
+        计算文本与每个缓存名称的字符集合交集大小和交并比
+        
+        Returns:
+            (交集大小数组, 交并比数组)；并集为空时交并比为0
+        """
+        text_chars = set(text)
+        char_ids = cache["char_ids"]
+        postings = [cache["char_postings"][char_ids[char]] for char in text_chars if char in char_ids]
+        
+        # 交集大小 = 各名称在问题字符的倒排表中出现的次数（只访问含有问题字符的条目）
+        name_count = len(cache["char_counts"])
+        if postings:
+            intersections = np.bincount(np.concatenate(postings), minlength=name_count)
+        else:
+            intersections = np.zeros(name_count, dtype=np.int64)
+        unions = cache["char_counts"] + len(text_chars) - intersections
+        ratios = np.divide(
+            intersections, unions,
+            out=np.zeros(len(unions), dtype=np.float64), where=unions > 0
+        )
+        return intersections, ratios
+    
+    @staticmethod
+    def _find_names_containing(cache: Dict[str, Any], text: str) -> np.ndarray:
+        """
+        用n-gram倒排索引查找小写名称中包含text的条目
+        
+        单个字符取字符倒排表，text长度在索引范围内时直接取n-gram倒排表；更长时求各n-gram倒排表的交集，再逐个确认子串。
+        
+        Returns:
+            条目下标数组（升序；单个字符时为共享的只读倒排表，调用方不得修改）
+        """
+        if not text:
+            return np.arange(len(cache["names_lower"]), dtype=np.int64)
+        if len(text) == 1:
+            # 单个字符：直接取字符倒排表（字符重叠度用的同一份索引）
+            char_id = cache["char_ids"].get(text)
+            if char_id is None:
+                return np.zeros(0, dtype=np.int64)
+            return cache["char_postings"][char_id]
+        
+        gram_index = cache["gram_index"]
+        if len(text) <= _NAME_INDEX_GRAM_SIZES[-1]:
+            return np.array(gram_index.get(text, []), dtype=np.int64)
+        
+        size = _NAME_INDEX_GRAM_SIZES[-1]
+        postings = sorted(
+            (gram_index.get(text[start:start + size], []) for start in range(len(text) - size + 1)),
+            key=len
+        )
+        candidates = np.array(postings[0], dtype=np.int64)
+        for posting in postings[1:]:
+            # 候选已经很少时直接逐个确认，不再与更长的倒排表求交集
+            if len(candidates) <= _NAME_INDEX_CONFIRM_LIMIT:
+                break
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+        
+        names_lower = cache["names_lower"]
+        return np.array([index for index in candidates if text in names_lower[index]], dtype=np.int64)
+    
+    @classmethod
+    def _names_containing(cls, cache: Dict[str, Any], text: str) -> np.ndarray:
+        """小写名称中包含text的布尔掩码"""
+        mask = np.zeros(len(cache["names_lower"]), dtype=bool)
+        mask[cls._find_names_containing(cache, text)] = True
+        return mask
+    
+    @staticmethod
+    def _count_shared_chars(names: List[str], chars: set) -> np.ndarray:
+        """
+        每个名称中属于chars的不同字符数（等价于逐个计算len(chars & set(name))）
+        
+        名称按Unicode码位排成矩阵（短名称以0补齐），不属于chars的码位置0后逐行排序，
+        统计每行不同的非零码位个数。
+        """
+        if not names or not chars:
+            return np.zeros(len(names), dtype=np.int64)
+        codes = np.array(names, dtype=str)
+        codes = codes.view(np.uint32).reshape(len(names), -1)
+        char_codes = np.fromiter((ord(char) for char in chars), dtype=np.uint32, count=len(chars))
+        shared = np.where(np.isin(codes, char_codes), codes, 0)
+        shared.sort(axis=1)
+        distinct = (shared[:, 1:] != shared[:, :-1]) & (shared[:, 1:] != 0)
+        return distinct.sum(axis=1) + (shared[:, 0] != 0)
+    
+    @staticmethod
+    def _sorted_contains(sorted_ids: np.ndarray, index: int) -> bool:
+        """升序下标数组中是否包含index"""
+        position = np.searchsorted(sorted_ids, index)
+        return bool(position < len(sorted_ids) and sorted_ids[position] == index)
+    
+    @staticmethod
+    def _top_by_score(indices: np.ndarray, scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        按分数从高到低取前k个下标，分数相同时保持indices中的先后顺序
+        
+        先用np.partition找出第k大的分数，只对入选的少量条目排序，而不是对全部匹配结果排序。
+        """
+        if k <= 0:
+            return indices[:0]
+        if len(scores) > k:
+            kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+            selected = scores > kth_score
+            # 与第k大分数相同的条目按原顺序补足k个
+            ties = np.flatnonzero(scores == kth_score)[:k - np.count_nonzero(selected)]
+            selected[ties] = True
+            indices, scores = indices[selected], scores[selected]
+        return indices[np.argsort(-scores, kind="stable")]
     
     async def _full_name_exact_retrieve(
         self,
@@ -742,61 +1702,66 @@ class RAGService:
         try:
             logger.info(f"RAG: Full name exact retrieval for: {full_name}")
             
-            # 获取所有数据进行精确匹配
-            all_results = self.collection.get(include=["metadatas"])
-            
-            if not all_results["metadatas"]:
+            cache = self._get_metadata_cache()
+            if cache is None:
                 logger.warning("No data found in vector database")
                 return []
             
-            matches = []
+            full_name_lower = full_name.lower()
             
-            for metadata in all_results["metadatas"]:
-                bank_name_meta = metadata["bank_name"]
-                
-                # 计算完整名称匹配分数
-                exact_score = 0
-                matched_keywords = []
+            # 完全匹配 > 包含匹配 > 被包含匹配 > 字符重叠（70%以上），按优先级从低到高赋分
+            contains = self._names_containing(cache, full_name_lower)
+            # 包含完整名称且长度相同即完全相同
+            exact = contains & (cache["name_lengths"] == len(full_name_lower))
+            
+            contained = np.zeros(len(exact), dtype=bool)
+            overlap_ratios = np.zeros(len(exact), dtype=np.float64)
+            # 包含匹配（>=8分）已够top_k个时，被包含匹配（6分）和字符重叠（<=5分）不可能入选，不必计算
+            if np.count_nonzero(contains) < top_k:
+                intersections, overlap_ratios = self._char_overlap(cache, full_name_lower)
                 
-                # 完全匹配检查
-                if full_name.lower() == bank_name_meta.lower():
-                    exact_score = 10.0  # 完全匹配最高分
-                    matched_keywords.append("完全匹配")
-                elif full_name.lower() in bank_name_meta.lower():
-                    exact_score = 8.0   # 包含匹配高分
-                    matched_keywords.append("包含匹配")
-                elif bank_name_meta.lower() in full_name.lower():
-                    exact_score = 6.0   # 被包含匹配中等分
-                    matched_keywords.append("被包含匹配")
+                # 被包含匹配：名称的字符都在完整名称中且不更长时才需要逐个确认
+                names_lower = cache["names_lower"]
+                for index in np.flatnonzero(
+                    (intersections == cache["char_counts"])
+                    & (cache["name_lengths"] <= len(full_name_lower))
+                    & ~contains
+                ):
+                    contained[index] = names_lower[index] in full_name_lower
+            
+            overlapping = overlap_ratios > 0.7
+            scores = np.zeros(len(exact), dtype=np.float64)
+            scores[overlapping] = overlap_ratios[overlapping] * 5.0
+            scores[contained] = 6.0
+            scores[contains] = 8.0
+            scores[exact] = 10.0
+            
+            # 只保留有匹配的结果，按分数排序（分数相同保持向量库中的顺序）
+            matched = np.flatnonzero(scores > 0)
+            top_indices = self._top_by_score(matched, scores[matched], top_k)
+            
+            result = []
+            for index in top_indices:
+                metadata = cache["metadatas"][index]
+                if exact[index]:
+                    matched_keywords = ["完全匹配"]
+                elif contains[index]:
+                    matched_keywords = ["包含匹配"]
+                elif contained[index]:
+                    matched_keywords = ["被包含匹配"]
                 else:
-                    # 计算字符重叠度
-                    full_name_chars = set(full_name.lower())
-                    bank_name_chars = set(bank_name_meta.lower())
-                    overlap = len(full_name_chars & bank_name_chars)
-                    total = len(full_name_chars | bank_name_chars)
-                    
-                    if total > 0:
-                        overlap_ratio = overlap / total
-                        if overlap_ratio > 0.7:  # 70%以上字符重叠
-                            exact_score = overlap_ratio * 5.0
-                            matched_keywords.append(f"字符重叠{overlap_ratio:.2f}")
-                
-                # 只保留有匹配的结果
-                if exact_score > 0:
-                    matches.append({
-                        "bank_name": metadata["bank_name"],
-                        "bank_code": metadata["bank_code"],
-                        "clearing_code": metadata.get("clearing_code", ""),
-                        "similarity_score": 1.0,
-                        "keyword_score": exact_score,
-                        "final_score": exact_score,
-                        "matched_keywords": matched_keywords,
-                        "bank_id": metadata["bank_id"]
-                    })
-            
-            # 按分数排序
-            matches.sort(key=lambda x: x["final_score"], reverse=True)
-            result = matches[:top_k]
+                    matched_keywords = [f"字符重叠{overlap_ratios[index]:.2f}"]
+                exact_score = float(scores[index])
+                result.append({
+                    "bank_name": metadata["bank_name"],
+                    "bank_code": metadata["bank_code"],
+                    "clearing_code": metadata.get("clearing_code", ""),
+                    "similarity_score": 1.0,
+                    "keyword_score": exact_score,
+                    "final_score": exact_score,
+                    "matched_keywords": matched_keywords,
+                    "bank_id": metadata["bank_id"]
+                })
             
             logger.info(f"RAG: Full name exact retrieval found {len(result)} matches")
             for i, match in enumerate(result):
@@ -830,138 +1795,71 @@ class RAGService:
         try:
             logger.info(f"RAG: Exact bank retrieval for: {bank_name}, location: {location}, branch: {branch_name}")
             
-            # 获取所有数据进行精确匹配（这是最可靠的方法）
-            all_results = self.collection.get(include=["metadatas"])
-            
-            if not all_results["metadatas"]:
-                logger.warning("No data found in vector database")
+            # 银行名称和支行名称都为空时不可能有匹配，直接返回（也不必加载元数据缓存）
+            if not bank_name and not branch_name:
+                logger.debug("RAG: Exact bank retrieval skipped: no bank or branch name")
                 return []
             
-            matches = []
-            
-            for metadata in all_results["metadatas"]:
-                bank_name_meta = metadata["bank_name"]
-                
-                # 精确匹配评分
-                exact_score = 0
-                matched_keywords = []
-                
-                # 银行名称匹配（必须匹配）
-                bank_match = False
-                if bank_name:
-                    # 检查多种匹配方式
-                    if (bank_name.lower() in bank_name_meta.lower() or 
-                        any(alias.lower() in bank_name_meta.lower() for alias in [
-                            "工商银行", "中国工商银行", "ICBC"
-                        ] if bank_name in ["工商银行", "中国工商银行"])):
-                        exact_score += 3.0
-                        matched_keywords.append(bank_name)
-                        bank_match = True
-                
-                # 支行名称匹配（关键！）
-                branch_match = False
-                if branch_name:
-                    if branch_name.lower() in bank_name_meta.lower():
-                        exact_score += 5.0  # 支行匹配给予最高分
-                        matched_keywords.append(branch_name)
-                        branch_match = True
-                    else:
-                        # 如果指定了支行但不匹配，大幅降分
-                        exact_score -= 2.0
-                
-                # 地理位置匹配
-                if location and location.lower() in bank_name_meta.lower():
-                    exact_score += 1.0
-                    matched_keywords.append(location)
-                
-                # 只有在有实际匹配时才加入结果
-                if (bank_match or branch_match) and exact_score > 0:
-                    matches.append({
-                        "bank_name": metadata["bank_name"],
-                        "bank_code": metadata["bank_code"],
-                        "clearing_code": metadata.get("clearing_code", ""),
-                        "similarity_score": 1.0,  # 精确匹配给满分
-                        "keyword_score": exact_score,
-                        "final_score": exact_score,
-                        "matched_keywords": matched_keywords,
-                        "bank_id": metadata["bank_id"]
-                    })
-            
-            # 按分数排序
-            matches.sort(key=lambda x: x["final_score"], reverse=True)
-            result = matches[:top_k]
-            
-            logger.info(f"RAG: Exact bank retrieval found {len(result)} matches")
-            for i, match in enumerate(result):
-                logger.info(f"RAG: Exact Match {i+1}: {match['bank_name']} (Score: {match['final_score']:.3f})")
-            
-            return result
-            
-        except Exception as e:
-            logger.error(f"Exact bank retrieval failed: {e}")
-            return []
-            logger.info(f"RAG: Exact bank retrieval for: {bank_name}, location: {location}, branch: {branch_name}")
-            
-            # 获取所有数据进行精确匹配（这是最可靠的方法）
-            all_results = self.collection.get(include=["metadatas"])
-            
-            if not all_results["metadatas"]:
+            cache = self._get_metadata_cache()
+            if cache is None:
                 logger.warning("No data found in vector database")
                 return []
             
-            matches = []
-            
-            for metadata in all_results["metadatas"]:
-                bank_name_meta = metadata["bank_name"]
-                
-                # 精确匹配评分
-                exact_score = 0
+            # 候选集：包含银行名称或支行名称的条目（只有这些才可能入选），由倒排索引直接查出
+            bank_ids = np.zeros(0, dtype=np.int64)
+            if bank_name:
+                # 检查多种匹配方式
+                needles = [bank_name.lower()]
+                if bank_name in ["工商银行", "中国工商银行"]:
+                    needles.extend(alias.lower() for alias in ["工商银行", "中国工商银行", "ICBC"])
+                for needle in dict.fromkeys(needles):
+                    bank_ids = np.union1d(bank_ids, self._find_names_containing(cache, needle))
+            branch_ids = np.zeros(0, dtype=np.int64)
+            if branch_name:
+                branch_ids = self._find_names_containing(cache, branch_name.lower())
+            candidates = np.union1d(bank_ids, branch_ids)
+            
+            # 银行名称匹配（必须匹配）
+            bank_match = np.isin(candidates, bank_ids, assume_unique=True)
+            scores = np.where(bank_match, 3.0, 0.0)
+            
+            # 支行名称匹配（关键！）
+            branch_match = np.isin(candidates, branch_ids, assume_unique=True)
+            if branch_name:
+                # 支行匹配给予最高分；如果指定了支行但不匹配，大幅降分
+                scores += np.where(branch_match, 5.0, -2.0)
+            
+            # 地理位置匹配：只需判断候选条目（城市名可能出现在大部分条目中，不查全量倒排索引）
+            location_match = np.zeros(len(candidates), dtype=bool)
+            if location and len(candidates):
+                location_match = np.char.find(cache["names_array"][candidates], location.lower()) >= 0
+                scores[location_match] += 1.0
+            
+            # 只有在有实际匹配时才加入结果，按分数排序（分数相同保持向量库中的顺序）
+            matched = np.flatnonzero(scores > 0)
+            top_positions = self._top_by_score(matched, scores[matched], top_k)
+            
+            result = []
+            for position in top_positions:
+                metadata = cache["metadatas"][candidates[position]]
                 matched_keywords = []
-                
-                # 银行名称匹配（必须匹配）
-                bank_match = False
-                if bank_name:
-                    # 检查多种匹配方式
-                    if (bank_name.lower() in bank_name_meta.lower() or 
-                        any(alias.lower() in bank_name_meta.lower() for alias in [
-                            "工商银行", "中国工商银行", "ICBC"
-                        ] if bank_name in ["工商银行", "中国工商银行"])):
-                        exact_score += 3.0
-                        matched_keywords.append(bank_name)
-                        bank_match = True
-                
-                # 支行名称匹配（关键！）
-                branch_match = False
-                if branch_name:
-                    if branch_name.lower() in bank_name_meta.lower():
-                        exact_score += 5.0  # 支行匹配给予最高分
-                        matched_keywords.append(branch_name)
-                        branch_match = True
-                    else:
-                        # 如果指定了支行但不匹配，大幅降分
-                        exact_score -= 2.0
-                
-                # 地理位置匹配
-                if location and location.lower() in bank_name_meta.lower():
-                    exact_score += 1.0
+                if bank_match[position]:
+                    matched_keywords.append(bank_name)
+                if branch_match[position]:
+                    matched_keywords.append(branch_name)
+                if location_match[position]:
                     matched_keywords.append(location)
-                
-                # 只有在有实际匹配时才加入结果
-                if (bank_match or branch_match) and exact_score > 0:
-                    matches.append({
-                        "bank_name": metadata["bank_name"],
-                        "bank_code": metadata["bank_code"],
-                        "clearing_code": metadata.get("clearing_code", ""),
-                        "similarity_score": 1.0,  # 精确匹配给满分
-                        "keyword_score": exact_score,
-                        "final_score": exact_score,
-                        "matched_keywords": matched_keywords,
-                        "bank_id": metadata["bank_id"]
-                    })
-            
-            # 按分数排序
-            matches.sort(key=lambda x: x["final_score"], reverse=True)
-            result = matches[:top_k]
+                exact_score = float(scores[position])
+                result.append({
+                    "bank_name": metadata["bank_name"],
+                    "bank_code": metadata["bank_code"],
+                    "clearing_code": metadata.get("clearing_code", ""),
+                    "similarity_score": 1.0,  # 精确匹配给满分
+                    "keyword_score": exact_score,
+                    "final_score": exact_score,
+                    "matched_keywords": matched_keywords,
+                    "bank_id": metadata["bank_id"]
+                })
             
             logger.info(f"RAG: Exact bank retrieval found {len(result)} matches")
             for i, match in enumerate(result):
@@ -997,13 +1895,35 @@ class RAGService:
             query_text = f"{bank_type} {location}"
             
             # 使用向量检索
-            query_embedding = self.embedding_model.encode([query_text], convert_to_tensor=False)
-            
-            vector_results = self.collection.query(
-                query_embeddings=query_embedding.tolist(),
-                n_results=min(top_k * 8, 150),  # 获取更多候选
-                include=["metadatas", "distances"]
-            )
+            query_embedding = await self._embed_query_async(query_text)
+            
+            n_results = min(top_k * 8, 150)  # 获取更多候选
+            vector_results = None
+            
+            # ChromaDB后端：把名称过滤下推到向量库，只在包含地理位置或银行类型的文档中找最近邻。
+            # $contains区分大小写，只在两者都不含大小写字母时使用（此时与下面的小写比较一致）；
+            # 过滤后不足top_k条时退回不过滤的检索
+            if (self.config["vector_search_backend"] != "flat" and location and bank_type
+                    and location.lower() == location.upper() and bank_type.lower() == bank_type.upper()):
+                try:
+                    vector_results = self.collection.query(
+                        query_embeddings=query_embedding.tolist(),
+                        n_results=n_results,
+                        include=["metadatas", "distances"],
+                        where_document={"$or": [{"$contains": location}, {"$contains": bank_type}]}
+                    )
+                    if not vector_results["metadatas"] or len(vector_results["metadatas"][0]) < top_k:
+                        vector_results = None
+                except Exception as e:
+                    logger.warning(f"Filtered location query failed, falling back to unfiltered search: {e}")
+                    vector_results = None
+            
+            if vector_results is None:
+                vector_results = self._query_vectors(
+                    query_embedding,
+                    n_results=n_results,
+                    include=["metadatas", "distances"]
+                )
             
             if not vector_results["metadatas"] or not vector_results["metadatas"][0]:
                 logger.warning("No results found in location bank retrieval")
@@ -1012,17 +1932,20 @@ class RAGService:
             matches = []
             metadatas = vector_results["metadatas"][0]
             distances = vector_results["distances"][0]
+            location_lower = location.lower()
+            bank_type_lower = bank_type.lower()
             
             for i, metadata in enumerate(metadatas):
-                bank_name_meta = metadata["bank_name"]
+                # 入库时已写入小写名称；旧版本入库的数据没有该字段时现算
+                bank_name_meta_lower = metadata.get("bank_name_lower") or metadata["bank_name"].lower()
                 distance = distances[i]
                 
                 # 基础向量相似度分数
                 base_score = max(0.0, 1.0 / (1.0 + distance))
                 
                 # 地理位置和银行类型匹配检查
-                location_match = location.lower() in bank_name_meta.lower()
-                bank_match = bank_type.lower() in bank_name_meta.lower()
+                location_match = location_lower in bank_name_meta_lower
+                bank_match = bank_type_lower in bank_name_meta_lower
                 
                 if location_match or bank_match:
                     match_score = 0
@@ -1038,22 +1961,24 @@ class RAGService:
                         match_score = 1.5  # 银行类型匹配
                         matched_keywords = [bank_type]
                     
-                    final_score = base_score + match_score
-                    
-                    matches.append({
-                        "bank_name": metadata["bank_name"],
-                        "bank_code": metadata["bank_code"],
-                        "clearing_code": metadata.get("clearing_code", ""),
-                        "similarity_score": base_score,
-                        "keyword_score": match_score,
-                        "final_score": final_score,
-                        "matched_keywords": matched_keywords,
-                        "bank_id": metadata["bank_id"]
-                    })
-            
-            # 按分数排序
-            matches.sort(key=lambda x: x["final_score"], reverse=True)
-            result = matches[:top_k]
+                    # 候选只记录轻量元组，结果字典仅为最终返回的前top_k条构建
+                    matches.append((base_score + match_score, base_score, match_score, matched_keywords, metadata))
+            
+            # 按分数取前top_k（与完整排序后截取的结果和顺序相同）
+            top_matches = heapq.nlargest(top_k, matches, key=operator.itemgetter(0))
+            result = [
+                {
+                    "bank_name": metadata["bank_name"],
+                    "bank_code": metadata["bank_code"],
+                    "clearing_code": metadata.get("clearing_code", ""),
+                    "similarity_score": base_score,
+                    "keyword_score": match_score,
+                    "final_score": final_score,
+                    "matched_keywords": matched_keywords,
+                    "bank_id": metadata["bank_id"]
+                }
+                for final_score, base_score, match_score, matched_keywords, metadata in top_matches
+            ]
             
             logger.info(f"RAG: Location bank retrieval found {len(result)} matches")
             for i, match in enumerate(result):
@@ -1069,7 +1994,8 @@ class RAGService:
         self,
         question: str,
         all_results: List[Dict[str, Any]],
-        entities: Dict[str, str]
+        entities: Dict[str, str],
+        top_k: Optional[int] = None
     ) -> List[Dict[str, Any]]:
         """
         去重并重新排序所有检索结果
@@ -1078,18 +2004,16 @@ class RAGService:
             question: 原始问题
             all_results: 所有检索结果
             entities: 提取的实体
+            top_k: 只返回分数最高的top_k个结果（可选，默认返回全部）
         
         Returns:
             去重并重排序的结果
         """
-        # 去重（基于bank_code）
-        seen_codes = set()
-        unique_results = []
-        
+        # 去重（基于bank_code，保留先出现的即优先级更高的策略的结果）
+        unique_by_code: Dict[str, Dict[str, Any]] = {}
         for result in all_results:
-            if result['bank_code'] not in seen_codes:
-                seen_codes.add(result['bank_code'])
-                unique_results.append(result)
+            unique_by_code.setdefault(result['bank_code'], result)
+        unique_results = list(unique_by_code.values())
         
         # 重新计算综合分数
         for result in unique_results:
@@ -1119,49 +2043,29 @@ class RAGService:
             result['final_score'] = base_score
         
         # 按最终分数排序
+        if top_k is not None:
+            return heapq.nlargest(top_k, unique_results, key=operator.itemgetter('final_score'))
         unique_results.sort(key=lambda x: x['final_score'], reverse=True)
         
         return unique_results
     
-    def _extract_question_keywords(self, question: str) -> List[str]:
+    def _extract_question_keywords(self, question: str, cache: Optional[Dict[str, Any]] = None) -> List[str]:
         """
         从用户问题中提取关键词
         
         Args:
             question: 用户问题
+            cache: 元数据缓存（可选，见_get_metadata_cache）。提供时分词得到的词组只保留
+                   出现在某个名称中（查n-gram倒排索引）或等于某个条目关键词的，其余词组不可能匹配任何条目
         
         Returns:
             关键词列表
         """
-        import re
-        
         keywords = []
         
         # 1. 提取银行名称相关关键词
-        bank_patterns = [
-            r'(中国工商银行|工商银行|工行)',
-            r'(中国农业银行|农业银行|农行)',
-            r'(中国银行|中行)',
-            r'(中国建设银行|建设银行|建行)',
-            r'(交通银行|交行)',
-            r'(招商银行|招行)',
-            r'(浦发银行|上海浦东发展银行)',
-            r'(中信银行|中信)',
-            r'(光大银行|中国光大银行)',
-            r'(华夏银行|华夏)',
-            r'(民生银行|中国民生银行)',
-            r'(广发银行|广发)',
-            r'(平安银行|平安)',
-            r'(兴业银行|兴业)',
-            r'(浙商银行|浙商)',
-            r'(渤海银行|渤海)',
-            r'(恒丰银行|恒丰)',
-            r'(邮储银行|邮政储蓄银行|邮政银行)',
-            r'([^，。！？\s]{2,8}银行)'  # 通用银行名称模式
-        ]
-        
-        for pattern in bank_patterns:
-            matches = re.findall(pattern, question)
+        for pattern in _KEYWORD_BANK_PATTERNS:
+            matches = pattern.findall(question)
             for match in matches:
                 if isinstance(match, tuple):
                     keywords.extend([m for m in match if m])
@@ -1169,47 +2073,38 @@ class RAGService:
                     keywords.append(match)
         
         # 2. 提取地理位置关键词
-        location_patterns = [
-            r'(北京|上海|天津|重庆)',
-            r'(广州|深圳|厦门|青岛|大连|宁波|苏州|杭州|南京|武汉|成都|西安)',
-            r'([^，。！？\s]{2,6}[市县区镇])',
-            r'([^，。！？\s]{2,8}[省])'
-        ]
-        
-        for pattern in location_patterns:
-            matches = re.findall(pattern, question)
+        for pattern in _KEYWORD_LOCATION_PATTERNS:
+            matches = pattern.findall(question)
             keywords.extend(matches)
         
         # 3. 提取支行类型关键词
-        branch_patterns = [
-            r'([^，。！？\s]{1,10}支行)',
-            r'([^，。！？\s]{1,10}分行)',
-            r'(营业部|营业厅|分理处|储蓄所)'
-        ]
-        
-        for pattern in branch_patterns:
-            matches = re.findall(pattern, question)
-            keywords.extend(matches)
+        # 问题中没有任何网点后缀时这些正则都不会命中
+        if any(suffix in question for suffix in _QUESTION_BRANCH_SUFFIXES):
+            for pattern in _KEYWORD_BRANCH_PATTERNS:
+                matches = pattern.findall(question)
+                keywords.extend(matches)
         
         # 4. 分词提取（简单版本）
-        # 提取2-4字的词组
+        # 提取2-4字的词组，过滤掉含常见停用词和标点的词组：
+        # 先逐字标出停用字符并求前缀和，每个词组只需比较两个前缀和
+        stopword_counts = [0]
+        for char in question:
+            stopword_counts.append(stopword_counts[-1] + bool(_KEYWORD_STOPWORD_RE.match(char)))
+        gram_index = cache["gram_index"] if cache is not None else None
         for length in [4, 3, 2]:
             for i in range(len(question) - length + 1):
-                word = question[i:i+length]
-                # 过滤掉常见停用词和标点
-                if not re.search(r'[，。！？\s的是在有什么多少哪里怎么样]', word):
+                if stopword_counts[i + length] == stopword_counts[i]:
+                    word = question[i:i+length]
+                    if gram_index is not None:
+                        word_lower = word.lower()
+                        # 倒排索引包含名称中全部该长度的n-gram，不在其中即不是任何名称的子串
+                        if (len(word_lower) in _NAME_INDEX_GRAM_SIZES and word_lower not in gram_index
+                                and word_lower not in cache["keyword_vocabulary"]):
+                            continue
                     keywords.append(word)
         
-        # 去重并过滤
-        unique_keywords = []
-        seen = set()
-        for kw in keywords:
-            kw = kw.strip()
-            if kw and len(kw) >= 2 and kw not in seen:
-                seen.add(kw)
-                unique_keywords.append(kw)
-        
-        return unique_keywords
+        # 去重（保持顺序）并过滤
+        return list(dict.fromkeys(kw for kw in map(str.strip, keywords) if len(kw) >= 2))
     
     async def initialize_vector_db(self, force_rebuild: bool = False) -> bool:
         """
@@ -1254,7 +2149,7 @@ class RAGService:
                 return False
             
             # 批量处理向量化
-            batch_size = 100
+            batch_size = self.config["batch_size"]
             total_batches = (len(bank_records) + batch_size - 1) // batch_size
             
             for batch_idx in range(total_batches):
@@ -1279,6 +2174,7 @@ class RAGService:
                     metadata = {
                         "bank_id": record.id,
                         "bank_name": record.bank_name,
+                        "bank_name_lower": record.bank_name.lower(),
                         "bank_code": record.bank_code,
                         "clearing_code": record.clearing_code or "",  # 确保不是None
                         "keywords": ",".join(keywords),
@@ -1290,8 +2186,7 @@ class RAGService:
                     ids.append(f"bank_{record.id}")
                 
                 # 生成嵌入向量
-                embeddings = self.embedding_model.encode(documents, convert_to_tensor=False)
-                embeddings_list = embeddings.tolist()
+                embeddings_list = self._encode_documents(documents)
                 
                 # 添加到向量数据库
                 self.collection.add(
@@ -1303,6 +2198,7 @@ class RAGService:
                 
                 logger.info(f"Added batch {batch_idx + 1}/{total_batches} to vector database")
             
+            self._refresh_metadata_cache()
             final_count = self.collection.count()
             logger.info(f"Vector database initialized successfully with {final_count} documents")
             return True
@@ -1401,7 +2297,7 @@ class RAGService:
                     result['strategy_score'] = result.get('final_score', 0) * 3.0
                     all_results.append(result)
             
-            # 如果仍然结果不足，使用向量检索
+            # 如果仍然结果不足，使用向量检索（只有这时才计算问题向量，精确/关键词匹配足够的查询不做编码）
             if len(all_results) < top_k:
                 vector_results = await self._vector_retrieve(question, top_k - len(all_results), similarity_threshold)
                 for result in vector_results:
@@ -1410,7 +2306,7 @@ class RAGService:
                     all_results.append(result)
             
             # 去重和重排序
-            final_results = self._deduplicate_and_rerank(question, all_results, entities)[:top_k]
+            final_results = self._deduplicate_and_rerank(question, all_results, entities, top_k)
             
             logger.info(f"RAG: Returning {len(final_results)} results from optimized retrieval")
             
@@ -1420,6 +2316,39 @@ class RAGService:
             logger.error(f"Failed to retrieve relevant banks: {e}")
             return []
     
+    async def retrieve_relevant_banks_batch(
+        self,
+        questions: List[str],
+        top_k: Optional[int] = None,
+        similarity_threshold: Optional[float] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        批量检索（回填、评测等离线任务使用）
+        
+        先把所有问题的嵌入向量一次批量计算并写入缓存，再逐个执行retrieve_relevant_banks，
+        各问题的向量检索直接复用缓存中的向量。
+        
+        Args:
+            questions: 用户问题列表
+            top_k: 每个问题返回结果数量（可选，使用配置默认值）
+            similarity_threshold: 相似度阈值（可选，使用配置默认值）
+        
+        Returns:
+            与questions一一对应的相关银行记录列表
+        """
+        if self.config["cache_enabled"] and questions:
+            try:
+                await asyncio.wrap_future(
+                    self._embedding_executor.submit(self._embed_queries, list(dict.fromkeys(questions)))
+                )
+            except Exception as e:
+                logger.warning(f"Batch query embedding failed, falling back to per-query embedding: {e}")
+        
+        return [
+            await self.retrieve_relevant_banks(question, top_k, similarity_threshold)
+            for question in questions
+        ]
+    
     async def _vector_retrieve(
         self,
         question: str,
@@ -1428,11 +2357,11 @@ class RAGService:
     ) -> List[Dict[str, Any]]:
         """向量检索 - 修复版本，降低阈值并改进匹配逻辑"""
         # 生成问题的嵌入向量
-        question_embedding = self.embedding_model.encode([question], convert_to_tensor=False)
+        question_embedding = await self._embed_query_async(question)
         
         # 在向量数据库中搜索，获取更多候选结果
-        results = self.collection.query(
-            query_embeddings=question_embedding.tolist(),
+        results = self._query_vectors(
+            question_embedding,
             n_results=min(top_k * 10, 500),  # 获取更多候选结果
             include=["documents", "metadatas", "distances"]
         )
@@ -1441,8 +2370,7 @@ class RAGService:
             logger.warning("No results found in vector database")
             return []
         
-        # 处理结果 - 增加智能重排序
-        retrieved_banks = []
+        # 处理结果 - 增加智能重排序（分数按候选向量化计算，只为返回的结果构造字典）
         documents = results["documents"][0]
         metadatas = results["metadatas"][0]
         distances = results["distances"][0]
@@ -1450,77 +2378,99 @@ class RAGService:
         logger.info(f"RAG: Found {len(documents)} potential matches from vector search")
         
         # 第一步：基于向量相似度的初步筛选（降低阈值）
-        candidates = []
-        for i, (doc, metadata, distance) in enumerate(zip(documents, metadatas, distances)):
-            # 计算相似度分数 (距离越小，相似度越高)
-            similarity_score = max(0.0, 1.0 / (1.0 + distance))
-            
-            logger.info(f"RAG: Vector Candidate {i+1}: {metadata['bank_name']} | Distance: {distance:.3f} | Similarity: {similarity_score:.3f}")
-            
-            # 大幅降低相似度阈值，让更多结果通过
-            effective_threshold = min(similarity_threshold, 0.05)  # 最低阈值0.05
-            if similarity_score >= effective_threshold:
-                candidates.append({
-                    "bank_name": metadata["bank_name"],
-                    "bank_code": metadata["bank_code"],
-                    "clearing_code": metadata["clearing_code"],
-                    "similarity_score": similarity_score,
-                    "keywords": metadata.get("keywords", "").split(","),
-                    "bank_id": metadata["bank_id"],
-                    "distance": distance
-                })
+        # 计算相似度分数 (距离越小，相似度越高)
+        similarity_scores = np.maximum(0.0, 1.0 / (1.0 + np.asarray(distances, dtype=np.float64)))
+        # 大幅降低相似度阈值，让更多结果通过
+        effective_threshold = min(similarity_threshold, 0.05)  # 最低阈值0.05
+        kept = np.flatnonzero(similarity_scores >= effective_threshold)
+        # 每个候选一条（最多500条），用DEBUG级别延迟生成，未开启DEBUG时不会格式化
+        logger.opt(lazy=True).debug("RAG: Vector candidates: {}", lambda: " | ".join(
+            f"{i+1}: {metadata['bank_name']} (Distance: {distance:.3f}, Similarity: {similarity:.3f})"
+            for i, (metadata, distance, similarity) in enumerate(zip(metadatas, distances, similarity_scores))
+        ))
+        
+        kept_metadatas = [metadatas[i] for i in kept]
+        # 小写名称（入库时已写入元数据）和小写关键词集合
+        names_lower = [metadata.get("bank_name_lower") or metadata["bank_name"].lower() for metadata in kept_metadatas]
+        bank_keyword_sets = [
+            {keyword.lower() for keyword in metadata.get("keywords", "").split(",")}
+            for metadata in kept_metadatas
+        ]
         
         # 第二步：基于关键词匹配的重排序
         question_lower = question.lower()
-        question_keywords = self._extract_question_keywords(question)
+        # 元数据缓存只用于去掉不可能命中的关键词：ChromaDB后端不为此加载全部元数据（只复用已加载的缓存），
+        # 缓存加载失败时退回不过滤的n-gram提取（与_query_vectors的降级方式一致），不影响已得到的向量结果
+        keyword_cache = None
+        if self.config["vector_search_backend"] == "flat" or self._metadata_cache_slot.cache is not None:
+            try:
+                keyword_cache = self._get_metadata_cache()
+            except Exception as e:
+                logger.warning(f"Metadata cache unavailable, extracting keywords without vocabulary filter: {e}")
+        question_keywords = self._extract_question_keywords(question, keyword_cache)
         
         logger.info(f"RAG: Extracted question keywords: {question_keywords}")
         
-        for candidate in candidates:
-            bank_name = candidate["bank_name"]
-            bank_name_lower = bank_name.lower()
-            
-            # 计算关键词匹配分数
-            keyword_score = 0
-            matched_keywords = []
-            
-            # 1. 直接字符串匹配检查（最重要）
-            for kw in question_keywords:
-                if len(kw) >= 2 and kw.lower() in bank_name_lower:
-                    if len(kw) >= 4:
-                        keyword_score += 3.0  # 长关键词高分
-                    elif len(kw) == 3:
-                        keyword_score += 2.0  # 中等关键词
-                    else:
-                        keyword_score += 1.0  # 短关键词
-                    matched_keywords.append(kw)
-            
-            # 2. 银行别名匹配
-            bank_keywords = candidate.get("keywords", [])
-            for q_kw in question_keywords:
-                if q_kw.lower() in [bk.lower() for bk in bank_keywords]:
-                    keyword_score += 1.5
-                    matched_keywords.append(q_kw)
-            
-            # 3. 字符重叠度
-            common_chars = set(question_lower) & set(bank_name_lower)
-            char_overlap_ratio = len(common_chars) / max(len(set(question_lower)), 1)
-            keyword_score += char_overlap_ratio * 0.5
-            
-            # 综合分数：向量相似度 + 关键词匹配分数
-            candidate["keyword_score"] = keyword_score
-            candidate["matched_keywords"] = matched_keywords
-            candidate["final_score"] = candidate["similarity_score"] * 0.3 + keyword_score * 0.7  # 更重视关键词匹配
-            
-            logger.info(f"RAG: Enhanced scoring for {bank_name[:30]}... | "
-                      f"Vector: {candidate['similarity_score']:.3f} | "
-                      f"Keyword: {keyword_score:.3f} | "
-                      f"Final: {candidate['final_score']:.3f} | "
-                      f"Matched: {matched_keywords}")
-        
-        # 按综合分数排序
-        candidates.sort(key=lambda x: x["final_score"], reverse=True)
-        retrieved_banks = candidates[:top_k]
+        keyword_scores = np.zeros(len(kept), dtype=np.float64)
+        
+        # 1. 直接字符串匹配检查（最重要）
+        substring_matches = []
+        for kw in question_keywords:
+            if len(kw) >= 2:
+                kw_lower = kw.lower()
+                match = np.fromiter((kw_lower in name for name in names_lower), dtype=bool, count=len(names_lower))
+                if len(kw) >= 4:
+                    keyword_scores[match] += 3.0  # 长关键词高分
+                elif len(kw) == 3:
+                    keyword_scores[match] += 2.0  # 中等关键词
+                else:
+                    keyword_scores[match] += 1.0  # 短关键词
+                substring_matches.append((kw, match))
+        
+        # 2. 银行别名匹配
+        alias_matches = []
+        for q_kw in question_keywords:
+            q_kw_lower = q_kw.lower()
+            match = np.fromiter(
+                (q_kw_lower in keyword_set for keyword_set in bank_keyword_sets), dtype=bool, count=len(bank_keyword_sets)
+            )
+            keyword_scores[match] += 1.5
+            alias_matches.append((q_kw, match))
+        
+        # 3. 字符重叠度（问题的字符集合只构造一次）
+        question_chars = set(question_lower)
+        char_overlap_ratios = self._count_shared_chars(names_lower, question_chars) / max(len(question_chars), 1)
+        keyword_scores += char_overlap_ratios * 0.5
+        
+        # 综合分数：向量相似度 + 关键词匹配分数
+        final_scores = similarity_scores[kept] * 0.3 + keyword_scores * 0.7  # 更重视关键词匹配
+        
+        # 按综合分数取前top_k（候选数通常远多于top_k，不做完整排序）
+        retrieved_banks = []
+        for position in self._top_by_score(np.arange(len(kept)), final_scores, top_k):
+            metadata = kept_metadatas[position]
+            retrieved_banks.append({
+                "bank_name": metadata["bank_name"],
+                "bank_code": metadata["bank_code"],
+                "clearing_code": metadata["clearing_code"],
+                "similarity_score": float(similarity_scores[kept[position]]),
+                "keywords": metadata.get("keywords", "").split(","),
+                "bank_id": metadata["bank_id"],
+                "distance": distances[kept[position]],
+                "keyword_score": float(keyword_scores[position]),
+                "matched_keywords": (
+                    [kw for kw, match in substring_matches if match[position]]
+                    + [q_kw for q_kw, match in alias_matches if match[position]]
+                ),
+                "final_score": float(final_scores[position]),
+            })
+            logger.debug(
+                "RAG: Enhanced scoring for {}... | Vector: {:.3f} | Keyword: {:.3f} | Final: {:.3f} | Matched: {}",
+                metadata["bank_name"][:30], retrieved_banks[-1]['similarity_score'],
+                retrieved_banks[-1]['keyword_score'], retrieved_banks[-1]['final_score'],
+                retrieved_banks[-1]['matched_keywords']
+            )
+        logger.info(f"RAG: Vector retrieval scored {len(kept)} candidates, returning {len(retrieved_banks)}")
         
         return retrieved_banks
     
@@ -1549,55 +2499,58 @@ class RAGService:
             if not core_keywords:
                 return []
             
-            # 获取所有数据进行关键词匹配
-            all_results = self.collection.get(include=["metadatas"])
-            
-            if not all_results["metadatas"]:
+            cache = self._get_metadata_cache()
+            if cache is None:
                 logger.warning("No data found in vector database")
                 return []
             
-            matches = []
+            # 计算关键词匹配分数：每个关键词由倒排索引查出包含它的条目，只在这些条目上累加分数
+            keyword_matches = []
+            for keyword in core_keywords:
+                if len(keyword) >= 2:  # 只考虑长度>=2的关键词
+                    # 直接字符串匹配
+                    keyword_ids = self._find_names_containing(cache, keyword.lower())
+                    # 根据关键词长度和重要性给分
+                    if len(keyword) >= 4:
+                        weight = 3.0  # 长关键词高分
+                    elif len(keyword) == 3:
+                        weight = 2.0  # 中等关键词
+                    else:
+                        weight = 1.0  # 短关键词
+                    keyword_matches.append((keyword, keyword_ids, weight))
             
-            for metadata in all_results["metadatas"]:
-                bank_name = metadata["bank_name"]
-                bank_name_lower = bank_name.lower()
-                
-                # 计算关键词匹配分数
-                keyword_score = 0
-                matched_keywords = []
-                
-                for keyword in core_keywords:
-                    if len(keyword) >= 2:  # 只考虑长度>=2的关键词
-                        keyword_lower = keyword.lower()
-                        
-                        # 直接字符串匹配
-                        if keyword_lower in bank_name_lower:
-                            # 根据关键词长度和重要性给分
-                            if len(keyword) >= 4:
-                                keyword_score += 3.0  # 长关键词高分
-                            elif len(keyword) == 3:
-                                keyword_score += 2.0  # 中等关键词
-                            else:
-                                keyword_score += 1.0  # 短关键词
-                            
-                            matched_keywords.append(keyword)
-                
-                # 只保留有匹配的结果
-                if keyword_score > 0:
-                    matches.append({
-                        "bank_name": metadata["bank_name"],
-                        "bank_code": metadata["bank_code"],
-                        "clearing_code": metadata.get("clearing_code", ""),
-                        "similarity_score": 0.8,  # 关键词匹配给固定相似度
-                        "keyword_score": keyword_score,
-                        "final_score": keyword_score,
-                        "matched_keywords": matched_keywords,
-                        "bank_id": metadata["bank_id"]
-                    })
-            
-            # 按分数排序
-            matches.sort(key=lambda x: x["final_score"], reverse=True)
-            result = matches[:top_k * 2]  # 返回更多结果用于合并
+            if not keyword_matches:
+                return []
+            
+            # 只保留有匹配的结果，按分数排序（分数相同保持向量库中的顺序）
+            matched, inverse = np.unique(
+                np.concatenate([keyword_ids for _, keyword_ids, _ in keyword_matches]), return_inverse=True
+            )
+            matched_scores = np.bincount(
+                inverse,
+                weights=np.concatenate([np.full(len(keyword_ids), weight) for _, keyword_ids, weight in keyword_matches]),
+                minlength=len(matched)
+            )
+            top_positions = self._top_by_score(np.arange(len(matched)), matched_scores, top_k * 2)  # 返回更多结果用于合并
+            
+            result = []
+            for position in top_positions:
+                index = matched[position]
+                metadata = cache["metadatas"][index]
+                keyword_score = float(matched_scores[position])
+                result.append({
+                    "bank_name": metadata["bank_name"],
+                    "bank_code": metadata["bank_code"],
+                    "clearing_code": metadata.get("clearing_code", ""),
+                    "similarity_score": 0.8,  # 关键词匹配给固定相似度
+                    "keyword_score": keyword_score,
+                    "final_score": keyword_score,
+                    "matched_keywords": [
+                        keyword for keyword, keyword_ids, _ in keyword_matches
+                        if self._sorted_contains(keyword_ids, index)
+                    ],
+                    "bank_id": metadata["bank_id"]
+                })
             
             logger.info(f"RAG: Optimized keyword search found {len(result)} matches")
             
@@ -1617,31 +2570,11 @@ class RAGService:
         Returns:
             核心关键词列表
         """
-        import re
-        
         keywords = []
         
         # 1. 提取银行名称（完整匹配优先）
-        bank_patterns = [
-            r'(中国工商银行|工商银行)',
-            r'(中国农业银行|农业银行)',
-            r'(中国银行)',
-            r'(中国建设银行|建设银行)',
-            r'(交通银行)',
-            r'(招商银行)',
-            r'(浦发银行|上海浦东发展银行)',
-            r'(中信银行)',
-            r'(光大银行|中国光大银行)',
-            r'(华夏银行)',
-            r'(民生银行|中国民生银行)',
-            r'(广发银行)',
-            r'(平安银行)',
-            r'(兴业银行)',
-            r'(邮储银行|邮政储蓄银行)',
-        ]
-        
-        for pattern in bank_patterns:
-            matches = re.findall(pattern, question)
+        for pattern in _CORE_KEYWORD_BANK_PATTERNS:
+            matches = pattern.findall(question)
             for match in matches:
                 if isinstance(match, tuple):
                     keywords.extend([m for m in match if m and len(m) >= 3])
@@ -1650,42 +2583,25 @@ class RAGService:
                         keywords.append(match)
         
         # 2. 提取地理位置（主要城市）
-        location_patterns = [
-            r'(北京|上海|天津|重庆)',
-            r'(广州|深圳|厦门|青岛|大连|宁波|苏州|杭州|南京|武汉|成都|西安)',
-        ]
-        
-        for pattern in location_patterns:
-            matches = re.findall(pattern, question)
+        for pattern in _CORE_KEYWORD_LOCATION_PATTERNS:
+            matches = pattern.findall(question)
             keywords.extend(matches)
         
         # 3. 提取支行类型（重要关键词）
-        branch_patterns = [
-            r'([^，。！？\s]{2,8}支行)',
-            r'([^，。！？\s]{2,8}分行)',
-            r'(营业部|营业厅|分理处)'
-        ]
-        
-        for pattern in branch_patterns:
-            matches = re.findall(pattern, question)
-            keywords.extend(matches)
+        # 问题中没有任何网点后缀时这些正则都不会命中
+        if any(suffix in question for suffix in _QUESTION_BRANCH_SUFFIXES):
+            for pattern in _CORE_KEYWORD_BRANCH_PATTERNS:
+                matches = pattern.findall(question)
+                keywords.extend(matches)
         
         # 4. 提取重要的4字以上词组
-        long_words = re.findall(r'[^，。！？\s]{4,8}', question)
+        long_words = _CORE_KEYWORD_LONG_WORD_RE.findall(question)
         for word in long_words:
-            if not re.search(r'[的是在有什么多少哪里怎么样]', word):
+            if not _CORE_KEYWORD_STOPWORD_RE.search(word):
                 keywords.append(word)
         
-        # 去重并过滤，限制关键词数量
-        unique_keywords = []
-        seen = set()
-        for kw in keywords:
-            kw = kw.strip()
-            if kw and len(kw) >= 2 and kw not in seen and len(unique_keywords) < 10:  # 限制最多10个关键词
-                seen.add(kw)
-                unique_keywords.append(kw)
-        
-        return unique_keywords
+        # 去重（保持顺序）并过滤，限制最多10个关键词
+        return list(dict.fromkeys(kw for kw in map(str.strip, keywords) if len(kw) >= 2))[:10]
     
     def _rerank_combined_results(
         self,
@@ -1781,7 +2697,7 @@ class RAGService:
                 return False
             
             # 批量处理向量化
-            batch_size = 100
+            batch_size = self.config["batch_size"]
             total_batches = (len(bank_records) + batch_size - 1) // batch_size
             
             for batch_idx in range(total_batches):
@@ -1806,6 +2722,7 @@ class RAGService:
                     metadata = {
                         "bank_id": record['id'],
                         "bank_name": record['bank_name'],
+                        "bank_name_lower": record['bank_name'].lower(),
                         "bank_code": record['bank_code'],
                         "clearing_code": record['clearing_code'],
                         "keywords": ",".join(keywords),
@@ -1817,8 +2734,7 @@ class RAGService:
                     ids.append(f"file_bank_{record['id']}")
                 
                 # 生成嵌入向量
-                embeddings = self.embedding_model.encode(documents, convert_to_tensor=False)
-                embeddings_list = embeddings.tolist()
+                embeddings_list = self._encode_documents(documents)
                 
                 # 添加到向量数据库
                 self.collection.add(
@@ -1830,6 +2746,7 @@ class RAGService:
                 
                 logger.info(f"已添加批次 {batch_idx + 1}/{total_batches} 到向量数据库")
             
+            self._refresh_metadata_cache()
             final_count = self.collection.count()
             logger.info(f"从文件加载完成，向量数据库现有 {final_count} 条记录")
             return True
@@ -1848,14 +2765,14 @@ class RAGService:
         try:
             logger.info("Checking for vector database updates...")
             
-            # 获取向量数据库中的所有银行ID
-            all_results = self.collection.get(include=["metadatas"])
+            # 获取向量数据库中的所有银行ID（复用检索用的元数据缓存，不再单独拉取一遍）
+            cache = self._get_metadata_cache()
             existing_bank_ids = set()
             
-            if all_results["metadatas"]:
+            if cache is not None:
                 existing_bank_ids = {
                     int(metadata["bank_id"]) 
-                    for metadata in all_results["metadatas"]
+                    for metadata in cache["metadatas"]
                 }
             
             # 获取数据库中的所有有效银行记录
@@ -1895,6 +2812,7 @@ class RAGService:
                     metadata = {
                         "bank_id": record.id,
                         "bank_name": record.bank_name,
+                        "bank_name_lower": record.bank_name.lower(),
                         "bank_code": record.bank_code,
                         "clearing_code": record.clearing_code or "",
                         "keywords": ",".join(keywords),
@@ -1904,8 +2822,7 @@ class RAGService:
                     ids.append(f"bank_{record.id}")
                 
                 # 生成嵌入向量
-                embeddings = self.embedding_model.encode(documents, convert_to_tensor=False)
-                embeddings_list = embeddings.tolist()
+                embeddings_list = self._encode_documents(documents)
                 
                 # 添加到向量数据库
                 self.collection.add(
@@ -1919,6 +2836,8 @@ class RAGService:
             
             if not new_bank_ids and not deleted_bank_ids:
                 logger.info("Vector database is already up to date")
+            else:
+                self._refresh_metadata_cache()
             
             return True
             
@@ -1975,9 +2894,8 @@ class RAGService:
                     final_results.append(result)
                     seen_banks.add(result["bank_code"])
             
-            # 按混合分数排序
-            final_results.sort(key=lambda x: x["hybrid_score"], reverse=True)
-            final_results = final_results[:top_k]
+            # 按混合分数取前top_k
+            final_results = heapq.nlargest(top_k, final_results, key=operator.itemgetter("hybrid_score"))
             
             logger.info(f"RAG: Hybrid retrieval returning {len(final_results)} results")
             
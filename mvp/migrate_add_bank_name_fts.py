@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：添加银行名称全文索引
+
+创建bank_name_fts（FTS5外部内容表，trigram分词）及同步触发器，
+用于QueryService.retrieve_relevant_banks的关键词检索，替代逐个关键词的LIKE全表扫描。
+"""
+import sys
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, str(Path(__file__).parent))
+
+from loguru import logger
+from sqlalchemy import text
+
+from app.core.database import engine
+
+
+def migrate():
+    """执行数据库迁移"""
+    logger.info("开始数据库迁移：添加银行名称全文索引")
+
+    with engine.connect() as conn:
+        # 创建FTS5虚拟表（trigram分词支持中文子串匹配，需要SQLite 3.34+）
+        logger.info("创建bank_name_fts虚拟表...")
+        conn.execute(text("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS bank_name_fts USING fts5(
+                bank_name,
+                content='bank_codes',
+                content_rowid='id',
+                tokenize='trigram'
+            )
+        """))
+
+        # 创建同步触发器，保持索引与bank_codes一致
+        logger.info("创建同步触发器...")
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS bank_codes_fts_insert AFTER INSERT ON bank_codes BEGIN
+                INSERT INTO bank_name_fts(rowid, bank_name) VALUES (new.id, new.bank_name);
+            END
+        """))
+
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS bank_codes_fts_delete AFTER DELETE ON bank_codes BEGIN
+                INSERT INTO bank_name_fts(bank_name_fts, rowid, bank_name)
+                VALUES ('delete', old.id, old.bank_name);
+            END
+        """))
+
+        conn.execute(text("""
+            CREATE TRIGGER IF NOT EXISTS bank_codes_fts_update AFTER UPDATE OF bank_name ON bank_codes BEGIN
+                INSERT INTO bank_name_fts(bank_name_fts, rowid, bank_name)
+                VALUES ('delete', old.id, old.bank_name);
+                INSERT INTO bank_name_fts(rowid, bank_name) VALUES (new.id, new.bank_name);
+            END
+        """))
+
+        # 为已有数据建立索引
+        logger.info("重建全文索引...")
+        conn.execute(text("INSERT INTO bank_name_fts(bank_name_fts) VALUES ('rebuild')"))
+
+        conn.commit()
+
+        logger.info("✅ 数据库迁移完成！")
+
+    # 验证迁移结果
+    logger.info("验证迁移结果...")
+    with engine.connect() as conn:
+        # 检查虚拟表是否存在
+        result = conn.execute(text("""
+            SELECT name FROM sqlite_master
+            WHERE type='table' AND name='bank_name_fts'
+        """))
+
+        if result.fetchone():
+            logger.info("✓ bank_name_fts表创建成功")
+        else:
+            logger.error("✗ bank_name_fts表创建失败")
+            return False
+
+    logger.info("\n迁移完成！关键词检索将使用全文索引。")
+    return True
+
+
+if __name__ == "__main__":
+    try:
+        success = migrate()
+        sys.exit(0 if success else 1)
+    except Exception as e:
+        logger.error(f"迁移失败: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
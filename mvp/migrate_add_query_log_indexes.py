@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+数据库迁移脚本：添加查询日志索引
+
+为query_logs创建(user_id, created_at DESC, id DESC)复合索引，
+查询历史按用户过滤并按(时间, id)倒序键集分页时直接走索引，无需排序。
+（旧版本创建的(user_id, created_at DESC)索引被新索引覆盖，迁移时删除。）
+
+该索引已在QueryLog.__table_args__中声明，Base.metadata.create_all新建的数据库会直接创建；
+本脚本只用于升级已有数据库。
+"""
+import sys
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, str(Path(__file__).parent))
+
+from loguru import logger
+from sqlalchemy import text
+
+from app.core.database import engine
+
+
+def migrate():
+    """执行数据库迁移"""
+    logger.info("开始数据库迁移：添加查询日志索引")
+
+    with engine.connect() as conn:
+        logger.info("创建idx_query_logs_user_created_id索引...")
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_query_logs_user_created_id
+            ON query_logs(user_id, created_at DESC, id DESC)
+        """))
+
+        logger.info("删除旧的idx_query_logs_user_created索引...")
+        conn.execute(text("DROP INDEX IF EXISTS idx_query_logs_user_created"))
+
+        conn.commit()
+
+        logger.info("✅ 数据库迁移完成！")
+
+    # 验证迁移结果
+    logger.info("验证迁移结果...")
+    with engine.connect() as conn:
+        result = conn.execute(text("""
+            SELECT name FROM sqlite_master
+            WHERE type='index' AND name='idx_query_logs_user_created_id'
+        """))
+
+        if result.fetchone():
+            logger.info("✓ idx_query_logs_user_created_id索引创建成功")
+        else:
+            logger.error("✗ idx_query_logs_user_created_id索引创建失败")
+            return False
+
+    logger.info("\n迁移完成！查询历史分页将使用复合索引。")
+    return True
+
+
+if __name__ == "__main__":
+    try:
+        success = migrate()
+        sys.exit(0 if success else 1)
+    except Exception as e:
+        logger.error(f"迁移失败: {e}")
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
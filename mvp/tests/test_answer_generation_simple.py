@@ -150,6 +150,27 @@ class TestAnswerGenerationSimple:
                 break
         assert contains_bank_info, "答案应包含至少一个银行的信息"
     
+    def test_exact_bank_name_skips_scoring(self):
+        """
+        问题包含完整银行名称时直接返回该结果，不再提取实体和综合评分
+        """
+        query_service = QueryService(MockDBSession())
+        rag_results = [
+            {"bank_name": "中国农业银行股份有限公司上海分行", "bank_code": "103290000013", "final_score": 9.0},
+            {"bank_name": "中国工商银行股份有限公司北京西单支行", "bank_code": "102100024506", "final_score": 8.5},
+        ]
+        query_service._extract_enhanced_entities = lambda question: pytest.fail("不应进行实体提取")
+        
+        answer = query_service.generate_answer_with_small_model(
+            "中国工商银行股份有限公司北京西单支行的联行号是什么？", rag_results
+        )
+        assert answer == "中国工商银行股份有限公司北京西单支行: 102100024506"
+        
+        # 问题比结果名称更具体（多出支行限定）时不算精确命中
+        assert QueryService._find_exact_name_match("中国工商银行股份有限公司朝阳支行联行号", [
+            {"bank_name": "中国工商银行股份有限公司", "bank_code": "102100099996"}
+        ]) is None
+    
     def test_no_results_answer_generation(self):
         """
         **Feature: bank-code-intelligent-retrieval, Property 5: RAG查询处理准确性**
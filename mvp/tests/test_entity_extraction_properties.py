@@ -13,11 +13,21 @@ import hypothesis
 from hypothesis import strategies as st, HealthCheck
 import sys
 import os
+import asyncio
+import tempfile
+import threading
+import numpy as np
+import time
+from collections import OrderedDict
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 # 添加项目根目录到路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from app.services.rag_service import RAGService
+from app.services.rag_service import (
+    RAGService, _EmbeddingBatcher, _FlatL2Index, _MetadataCacheSlot, _QueryEmbeddingDiskCache
+)
 from sqlalchemy.orm import Session
 
 
@@ -327,7 +337,327 @@ class TestEntityExtractionProperties:
         if entities['location']:
             # 如果识别了位置，关键词中应包含位置信息
             assert entities['location'] in keywords, f"关键词应包含位置信息: {entities['location']}"
-
+    
+    @hypothesis.given(
+        bank_name=bank_names,
+        location=locations,
+        area=commercial_areas
+    )
+    @hypothesis.settings(
+        max_examples=25,
+        suppress_health_check=[HealthCheck.function_scoped_fixture]
+    )
+    def test_word_matcher_matches_substring_scan_property(self, bank_name, location, area):
+        """
+        属性：多模式匹配器找到的词与逐词子串判断一致，且按词表顺序（而不是在文本中出现的位置）返回
+        """
+        from app.services.rag_service import _QUESTION_ENTITY_MATCHER, _QUESTION_LOCATIONS
+        
+        query = f"{area}{location}{bank_name}营业部"
+        found = _QUESTION_ENTITY_MATCHER.find(query)
+        
+        assert found == {word for word in _QUESTION_ENTITY_MATCHER.words if word in query}
+        assert _QUESTION_ENTITY_MATCHER.in_order(found, "locations") == [
+            word for word in _QUESTION_LOCATIONS if word in query
+        ]
+    
+    @hypothesis.given(
+        names=st.lists(st.text(alphabet="工商银行北京西单支行ab", max_size=12), min_size=1, max_size=30),
+        text=st.text(alphabet="工商银行北京西单支行ab", max_size=8)
+    )
+    @hypothesis.settings(
+        max_examples=50,
+        suppress_health_check=[HealthCheck.function_scoped_fixture]
+    )
+    def test_name_index_matches_substring_scan_property(self, names, text):
+        """
+        属性：n-gram倒排索引查出的条目与逐个名称做子串判断的结果一致
+        """
+        class MockCollection:
+            def count(self):
+                return len(names)
+            
+            def get(self, include=None):
+                return {"metadatas": [{"bank_name": name} for name in names]}
+        
+        rag_service = RAGService.__new__(RAGService)
+        rag_service.collection = MockCollection()
+        rag_service.config = rag_service._get_default_config()
+        rag_service._metadata_cache_slot = _MetadataCacheSlot()
+        cache = rag_service._get_metadata_cache()
+        
+        assert list(RAGService._find_names_containing(cache, text)) == [
+            index for index, name in enumerate(names) if text in name
+        ]
+        # 字符倒排表直接返回给调用方，必须是只读的
+        assert not any(posting.flags.writeable for posting in cache["char_postings"])
+    
+    def test_metadata_cache_load_failure_backs_off(self):
+        """元数据加载失败后，退避间隔内不再重复读取向量库；间隔过后重新加载"""
+        class FailingCollection:
+            size = 3
+            gets = 0
+            
+            def count(self):
+                return self.size
+            
+            def get(self, include=None):
+                self.gets += 1
+                if self.gets == 1:
+                    raise ConnectionError("chroma unavailable")
+                return {"metadatas": [{"bank_name": "工商银行"}] * self.size}
+        
+        rag_service = RAGService.__new__(RAGService)
+        rag_service.collection = FailingCollection()
+        rag_service.config = rag_service._get_default_config()
+        rag_service._metadata_cache_slot = _MetadataCacheSlot()
+        
+        with pytest.raises(ConnectionError):
+            rag_service._get_metadata_cache()
+        with pytest.raises(RuntimeError):
+            rag_service._get_metadata_cache()
+        assert rag_service.collection.gets == 1
+        
+        rag_service._metadata_cache_slot.load_failure = (
+            rag_service._metadata_cache_slot.load_failure[0], float("-inf"), ConnectionError()
+        )
+        assert rag_service._get_metadata_cache()["count"] == 3
+        assert rag_service.collection.gets == 2
+    
+    def test_vector_retrieval_survives_metadata_cache_failure(self):
+        """元数据缓存加载失败（含退避期内）时，向量检索退回不过滤的关键词提取，仍返回向量结果"""
+        class FailingCollection:
+            def count(self):
+                return 1
+            
+            def get(self, include=None):
+                raise ConnectionError("chroma unavailable")
+        
+        rag_service = RAGService.__new__(RAGService)
+        rag_service.collection = FailingCollection()
+        rag_service.config = rag_service._get_default_config()
+        rag_service.config["vector_search_backend"] = "flat"
+        rag_service._metadata_cache_slot = _MetadataCacheSlot()
+        metadata = {"bank_name": "中国工商银行北京西单支行", "bank_code": "102100000001",
+                    "clearing_code": "", "bank_id": 1, "keywords": "工商银行,北京"}
+        
+        async def embed(question):
+            return np.zeros((1, 2), dtype=np.float32)
+        
+        rag_service._embed_query_async = embed
+        rag_service._query_vectors = lambda *args, **kwargs: {
+            "documents": [["doc"]], "metadatas": [[metadata]], "distances": [[0.5]]
+        }
+        
+        for _ in range(2):
+            results = asyncio.run(rag_service._vector_retrieve("工商银行北京西单支行", 5, 0.3))
+            assert [bank["bank_code"] for bank in results] == ["102100000001"]
+        assert rag_service._metadata_cache_slot.load_failure is not None
+    
+    @hypothesis.given(
+        names=st.lists(st.text(alphabet="工商银行北京西单支行ab ", max_size=12), max_size=20),
+        question=st.text(alphabet="工商银行北京西单支行ab ", max_size=10)
+    )
+    @hypothesis.settings(
+        max_examples=50,
+        suppress_health_check=[HealthCheck.function_scoped_fixture]
+    )
+    def test_shared_char_count_matches_set_intersection_property(self, names, question):
+        """
+        属性：码位矩阵统计的共同字符数与逐个名称求字符集合交集的结果一致
+        """
+        question_chars = set(question)
+        assert list(RAGService._count_shared_chars(names, question_chars)) == [
+            len(question_chars & set(name)) for name in names
+        ]
+    
+    def test_flat_index_batch_search_matches_brute_force(self):
+        """
+        多个查询一次矩阵乘法检索的结果与逐个计算L2距离排序一致
+        """
+        rng = np.random.default_rng(0)
+        embeddings = rng.normal(size=(200, 16)).astype(np.float32)
+        queries = rng.normal(size=(_FlatL2Index.QUERY_BLOCK_SIZE + 5, 16)).astype(np.float32)
+        index = _FlatL2Index(embeddings)
+        
+        distances, indices = index.search_many(queries, 5)
+        expected = ((queries[:, None, :] - embeddings[None, :, :]) ** 2).sum(axis=2)
+        assert indices.shape == (len(queries), 5)
+        assert (indices == np.argsort(expected, axis=1)[:, :5]).all()
+        assert np.allclose(distances, np.sort(expected, axis=1)[:, :5], rtol=1e-3, atol=1e-3)
+        
+        single_distances, single_indices = index.search(queries[3], 5)
+        assert (single_indices == indices[3]).all()
+    
+    @staticmethod
+    def _embedding_rag_service(delay=0.0):
+        """构造只包含查询向量缓存和批量计算器的RAG服务；模型按文本长度返回一维向量并统计调用次数"""
+        class CountingModel:
+            def __init__(self):
+                self.calls = 0
+            
+            def encode(self, texts, convert_to_tensor=False):
+                self.calls += 1
+                time.sleep(delay)
+                return [[float(len(text))] for text in texts]
+        
+        model = CountingModel()
+        rag_service = RAGService.__new__(RAGService)
+        rag_service._embedding_batcher = _EmbeddingBatcher(model)
+        rag_service.config = rag_service._get_default_config()
+        rag_service._query_embedding_cache = OrderedDict()
+        rag_service._query_embedding_cache_lock = threading.Lock()
+        rag_service._query_embedding_disk_cache = None
+        return rag_service, model
+    
+    def test_query_embedding_is_cached(self):
+        """相同检索文本只计算一次嵌入向量"""
+        rag_service, model = self._embedding_rag_service()
+        
+        assert rag_service._embed_query("工商银行 北京") == [[7.0]]
+        assert rag_service._embed_query("工商银行 北京") == [[7.0]]
+        assert model.calls == 1
+    
+    def test_query_embedding_recomputed_when_cache_disabled(self):
+        """关闭缓存时每次重新计算嵌入向量"""
+        rag_service, model = self._embedding_rag_service()
+        rag_service.config["cache_enabled"] = False
+        
+        rag_service._embed_query("工商银行 北京")
+        rag_service._embed_query("工商银行 北京")
+        assert model.calls == 2
+    
+    def test_concurrent_query_embeddings_are_merged(self):
+        """并发提交的文本合并为更少的模型调用，结果对应各自的文本"""
+        rag_service, model = self._embedding_rag_service(delay=0.01)
+        rag_service.config["cache_enabled"] = False
+        texts = ["工行" * length for length in range(1, 33)]
+        
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            embeddings = list(executor.map(rag_service._embed_query, texts))
+        
+        assert embeddings == [[[float(len(text))]] for text in texts]
+        assert model.calls < len(texts)
+    
+    @pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+    def test_embedding_batcher_survives_worker_death(self):
+        """后台线程因BaseException退出时，正在计算的请求以异常结束而不是永远阻塞，之后的请求正常计算"""
+        class DyingOnceModel:
+            died = False
+            
+            def encode(self, texts, convert_to_tensor=False):
+                if not DyingOnceModel.died:
+                    DyingOnceModel.died = True
+                    raise SystemExit
+                return [[float(len(text))] for text in texts]
+        
+        batcher = _EmbeddingBatcher(DyingOnceModel())
+        
+        future = batcher.submit(["工行"])[0]
+        dead_worker = batcher._worker
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+        dead_worker.join(timeout=5)
+        assert batcher.submit(["农业银行"])[0].result(timeout=5) == [[4.0]]
+    
+    def test_cancelled_awaiter_does_not_break_batch(self):
+        """排队中的等待方被取消时跳过其请求，同批其他请求正常返回，后台线程继续运行"""
+        started = threading.Event()
+        release = threading.Event()
+        
+        class BlockingModel:
+            def __init__(self):
+                self.batches = []
+            
+            def encode(self, texts, convert_to_tensor=False):
+                self.batches.append(list(texts))
+                started.set()
+                release.wait(timeout=5)
+                return [[float(len(text))] for text in texts]
+        
+        model = BlockingModel()
+        batcher = _EmbeddingBatcher(model)
+        
+        async def run():
+            # 第一批计算期间提交三个请求，取消其中一个等待方后放行
+            blocker = asyncio.wrap_future(batcher.submit(["工行"])[0])
+            await asyncio.to_thread(started.wait, 5)
+            futures = batcher.submit(["农业银行", "建设银行北京", "中国银行"])
+            awaiters = [asyncio.wrap_future(future) for future in futures]
+            awaiters[1].cancel()
+            # 取消经事件循环回调传递到concurrent.futures.Future
+            while not futures[1].cancelled():
+                await asyncio.sleep(0)
+            release.set()
+            await blocker
+            return await asyncio.gather(*awaiters, return_exceptions=True)
+        
+        results = asyncio.run(run())
+        
+        assert results[0] == [[4.0]] and results[2] == [[4.0]]
+        assert isinstance(results[1], asyncio.CancelledError)
+        assert model.batches[1] == ["农业银行", "中国银行"], "Cancelled request should be dropped from the batch"
+        assert batcher._worker.is_alive()
+        assert batcher.submit(["工商银行"])[0].result(timeout=5) == [[4.0]]
+    
+    def test_async_query_embedding_shares_cache(self):
+        """协程版本与同步版本共用同一缓存"""
+        rag_service, model = self._embedding_rag_service()
+        
+        assert rag_service._embed_query("工商银行 北京") == [[7.0]]
+        assert asyncio.run(rag_service._embed_query_async("工商银行 北京")) == [[7.0]]
+        assert asyncio.run(rag_service._embed_query_async("农行")) == [[2.0]]
+        assert rag_service._embed_query("农行") == [[2.0]]
+        assert model.calls == 2
+    
+    def test_batch_retrieval_prefetches_query_embeddings(self):
+        """批量检索先一次提交全部未缓存的问题，逐个检索时直接命中缓存"""
+        rag_service, model = self._embedding_rag_service()
+        
+        async def retrieve_relevant_banks(question, top_k=None, similarity_threshold=None):
+            assert question in rag_service._query_embedding_cache
+            return [{"bank_name": question}]
+        
+        rag_service.retrieve_relevant_banks = retrieve_relevant_banks
+        questions = ["农行 上海", "工商银行 北京", "建行 深圳", "农行 上海"]
+        results = asyncio.run(rag_service.retrieve_relevant_banks_batch(questions))
+        
+        assert results == [[{"bank_name": question}] for question in questions]
+        assert rag_service._embed_queries(questions) == [[[5.0]], [[7.0]], [[5.0]], [[5.0]]]
+        assert model.calls == 1
+    
+    def test_query_embedding_disk_cache_survives_restart(self):
+        """持久化缓存在进程内缓存清空（模拟重启）后命中；协程版本在线程池中读写磁盘；写入时清理过期条目"""
+        rag_service, model = self._embedding_rag_service()
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            disk_cache = _QueryEmbeddingDiskCache(Path(temp_dir) / "query_embedding_cache.sqlite3", "counting-model")
+            rag_service._query_embedding_disk_cache = disk_cache
+            
+            rag_service._embed_query("招行 杭州")
+            rag_service._query_embedding_cache.clear()
+            assert rag_service._embed_query("招行 杭州").tolist() == [[5.0]]
+            assert model.calls == 1
+            
+            # 协程版本：磁盘读写不在事件循环所在的线程中进行
+            disk_threads = []
+            get_many, put_many = disk_cache.get_many, disk_cache.put_many
+            disk_cache.get_many = lambda *args: disk_threads.append(threading.current_thread()) or get_many(*args)
+            disk_cache.put_many = lambda *args: disk_threads.append(threading.current_thread()) or put_many(*args)
+            rag_service._query_embedding_cache.clear()
+            assert asyncio.run(rag_service._embed_query_async("招行 杭州")).tolist() == [[5.0]]
+            assert asyncio.run(rag_service._embed_query_async("农行")) == [[2.0]]
+            assert model.calls == 2
+            assert len(disk_threads) == 3
+            assert threading.main_thread() not in disk_threads
+            
+            # 过期条目在下一次写入时清理（距上次清理超过PRUNE_INTERVAL）
+            with disk_cache._connection:
+                disk_cache._connection.execute("UPDATE query_embeddings SET created_at = 0")
+            disk_cache._last_prune -= _QueryEmbeddingDiskCache.PRUNE_INTERVAL
+            rag_service._embed_query("建行 深圳")
+            count = disk_cache._connection.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            assert count == 1
 
 if __name__ == "__main__":
     # 运行属性测试
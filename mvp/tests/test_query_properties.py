@@ -11,7 +11,10 @@ import pytest
 from hypothesis import given, strategies as st, settings, assume
 from unittest.mock import Mock, patch, MagicMock
 from datetime import datetime
+import gc
+import threading
 import time
+import weakref
 
 from app.services.query_service import QueryService, QueryServiceError
 from app.models.bank_code import BankCode
@@ -154,6 +157,7 @@ class TestQueryServiceProperties:
         mock_record.bank_code = bank_code
         mock_record.clearing_code = "102100000000"
         mock_db.query.return_value.filter.return_value.first.return_value = mock_record
+        mock_db.query.return_value.filter.return_value.all.return_value = [mock_record]
         
         # Execute query
         response = service.query(question=question, user_id=1, log_query=False)
@@ -243,8 +247,10 @@ class TestQueryServiceProperties:
                 mock_record.bank_code = bank_codes[0] if bank_codes else "102100000000"
                 mock_record.clearing_code = "102100000000"
                 mock_result.first.return_value = mock_record
+                mock_result.all.return_value = [mock_record]
             else:
                 mock_result.first.return_value = None
+                mock_result.all.return_value = []
             return mock_result
         
         mock_db.query.return_value.filter.side_effect = mock_filter_side_effect
@@ -321,6 +327,7 @@ class TestQueryServiceProperties:
         mock_record.bank_code = "102100000026"
         mock_record.clearing_code = "102100000000"
         mock_db.query.return_value.filter.return_value.first.return_value = mock_record
+        mock_db.query.return_value.filter.return_value.all.return_value = [mock_record]
         
         # Execute query and measure time
         start_time = time.time()
@@ -382,6 +389,7 @@ class TestQueryServiceProperties:
         
         # Mock bank code lookup
         mock_db.query.return_value.filter.return_value.first.return_value = None
+        mock_db.query.return_value.filter.return_value.all.return_value = []
         
         # Execute batch query
         responses = service.batch_query(questions=questions, user_id=1, log_queries=False)
@@ -396,3 +404,466 @@ class TestQueryServiceProperties:
             assert "answer" in response, f"Response {i} must contain 'answer'"
             assert response["question"] == questions[i], \
                 f"Response {i} question should match input question"
+
+
+class TestBatchedGeneration:
+    """
+    批量生成测试
+    """
+    
+    @staticmethod
+    def _char_level_service():
+        """构造使用字符级模拟分词器的服务：每个字符一个token，模型生成一个等于提示词长度的token"""
+        import numpy as np
+        
+        service = QueryService(db=Mock())
+        service.device = "cpu"
+        service.model = Mock()
+        service.tokenizer = Mock()
+        service.tokenizer.side_effect = lambda texts, **kwargs: {
+            "input_ids": [ord(c) for c in texts] if isinstance(texts, str)
+            else [[ord(c) for c in text] for text in texts]
+        }
+        service.tokenizer.build_inputs_with_special_tokens = lambda ids: ids
+        
+        def pad(features, **kwargs):
+            ids = features["input_ids"]
+            width = max(len(i) for i in ids)
+            return {"input_ids": np.array([[0] * (width - len(i)) + i for i in ids])}
+        
+        service.tokenizer.pad = Mock(side_effect=pad)
+        service.model.generate = Mock(side_effect=lambda **kw: np.concatenate(
+            [kw["input_ids"], (kw["input_ids"] != 0).sum(axis=1, keepdims=True)], axis=1
+        ))
+        service.tokenizer.batch_decode = lambda outputs, **kwargs: [f" {row[0]}" for row in outputs]
+        return service
+    
+    def test_generate_answers_batch_single_generate_call(self):
+        """多个问题应合并为一次model.generate调用，提示词与完整模板一致，答案按输入顺序返回"""
+        service = self._char_level_service()
+        
+        answers = service.generate_answers_batch(["问题一", "问题二"], contexts=["上下文", None])
+        
+        assert service.model.generate.call_count == 1
+        encoded = service.tokenizer.pad.call_args.args[0]["input_ids"]
+        assert "".join(map(chr, encoded[0])) == service._build_prompt("问题一", "上下文")
+        assert "".join(map(chr, encoded[1])) == service._build_prompt("问题二")
+        # 只解码提示词之后新生成的token
+        assert answers == [str(len(encoded[0])), str(len(encoded[1]))]
+    
+    def test_cpu_generation_does_not_take_input_buffer_lock(self):
+        """不使用CUDA预分配缓冲区时，生成不应获取缓冲区锁（并发生成互不等待）"""
+        service = self._char_level_service()
+        service._input_buffer_lock = MagicMock()
+        
+        service.generate_answers_batch(["问题一", "问题二"])
+        
+        assert service.model.generate.call_count == 1
+        assert not service._input_buffer_lock.__enter__.called
+    
+    def test_deferred_model_loads_once_and_retries_after_failure(self):
+        """延迟加载：加载期间并发调用应等待同一次加载；加载失败后下次调用应重试"""
+        service = QueryService(db=Mock())
+        service.device = "cpu"
+        service.load_model("models/job_1/final_model", lazy=True)
+        attempts = []
+        
+        def load_weights(*args, **kwargs):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise RuntimeError("weights unavailable")
+            time.sleep(0.05)
+            return Mock()
+        
+        with patch("app.services.query_service.AutoTokenizer"), \
+                patch.object(service, "_get_prompt_template_ids"), \
+                patch.object(service, "_load_model_weights", side_effect=load_weights):
+            with pytest.raises(QueryServiceError):
+                service._ensure_model_loaded()
+            assert service._deferred_model is not None, "Failed load should keep the deferred model"
+            
+            errors = []
+            
+            def generate():
+                try:
+                    service._ensure_model_loaded()
+                    assert service.model is not None
+                except Exception as e:
+                    errors.append(e)
+            
+            threads = [threading.Thread(target=generate) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        
+        assert not errors, f"Concurrent callers should wait for the load: {errors}"
+        assert len(attempts) == 2, "Concurrent callers should share one retry"
+        assert service._deferred_model is None
+    
+    def test_latest_model_cache_shared_and_invalidated_on_load(self):
+        """最新模型查询结果由API和各服务实例共用一份缓存，加载模型时失效"""
+        db = Mock()
+        job = Mock(id=7, model_name="Qwen/Qwen2.5-0.5B", model_path=__file__)
+        db.query.return_value.filter.return_value.order_by.return_value.first.return_value = job
+        service = QueryService(db=Mock())
+        QueryService.clear_latest_model_cache()
+        try:
+            assert QueryService.get_latest_model(db) == (7, "Qwen/Qwen2.5-0.5B", __file__)
+            assert service.get_latest_model_path() == __file__
+            assert db.query.call_count == 1
+            assert not service.db.query.called
+            
+            service.load_model("models/job_7/final_model", lazy=True)
+            QueryService.get_latest_model(db)
+            assert db.query.call_count == 2
+        finally:
+            QueryService.clear_latest_model_cache()
+    
+    def test_generate_answers_batch_buckets_by_length(self):
+        """超出批大小时按长度分桶生成，结果仍按输入顺序返回"""
+        service = self._char_level_service()
+        service.generation_batch_size = 2
+        questions = ["长长长长长问题", "短", "中等问题", "短二"]
+        
+        answers = service.generate_answers_batch(questions)
+        
+        assert answers == [str(len(service._build_prompt(q))) for q in questions]
+        assert service.model.generate.call_count == 2
+        bucket_sizes = [len(c.args[0]["input_ids"]) for c in service.tokenizer.pad.call_args_list]
+        assert bucket_sizes == [2, 2]
+    
+    def test_context_truncated_to_prompt_budget(self):
+        """上下文过长时应截断上下文，保留问题和Answer:"""
+        service = self._char_level_service()
+        service.max_prompt_tokens = 60
+        
+        service.generate_answers_batch(["问题"], contexts=["上下文" * 100])
+        
+        prompt = "".join(map(chr, service.tokenizer.pad.call_args.args[0]["input_ids"][0]))
+        assert len(prompt) == 60
+        assert prompt.endswith("Question: 问题\nAnswer:")
+    
+    def test_stops_once_enough_bank_codes_generated(self):
+        """所有序列都生成出完整的联行号后应停止生成"""
+        import numpy as np
+        from app.services.query_service import BankCodeStoppingCriteria
+        
+        tokenizer = Mock()
+        tokenizer.batch_decode = lambda rows, **kwargs: ["".join(map(chr, row)) for row in rows]
+        criteria = BankCodeStoppingCriteria(tokenizer, prompt_length=2, codes_needed=1)
+        
+        def ids(first, second):
+            # 两个序列等长：第一个序列用句号补齐
+            first = first.ljust(len(second), "。")
+            return np.array([[ord("P")] * 2 + [ord(c) for c in text] for text in (first, second)])
+        
+        # 数字串后尚未出现其他字符：可能继续延长，不停止
+        assert not criteria(ids("号：102100000026", "号：102100000027"), None)
+        # 第一条已完整，第二条尚未完整
+        assert not criteria(ids("号：102100000026。", "号：1021000000271"), None)
+        assert criteria(ids("号：102100000026。", "号：1021000000271 102100000028。"), None)
+    
+    def test_stop_after_codes_passes_stopping_criteria(self):
+        """指定stop_after_codes时应向generate传入停止条件"""
+        service = self._char_level_service()
+        
+        service.generate_answers_batch(["问题"])
+        assert "stopping_criteria" not in service.model.generate.call_args.kwargs
+        
+        service.generate_answers_batch(["问题"], stop_after_codes=1)
+        assert "stopping_criteria" in service.model.generate.call_args.kwargs
+
+
+class TestQueryLogWriter:
+    """
+    查询日志异步批量写入测试
+    """
+    
+    def test_query_logs_written_in_background_batch(self):
+        """查询日志应由后台线程批量提交，而不是在请求线程中逐条提交"""
+        mock_db = Mock()
+        log_session = Mock()
+        log_session.is_active = True
+        
+        with patch("app.services.query_service.Session", return_value=log_session):
+            service = QueryService(db=mock_db)
+            for i in range(3):
+                service._log_query(1, {
+                    "question": f"问题{i}",
+                    "answer": "答案",
+                    "confidence": 0.5,
+                    "response_time": 1.0
+                })
+            service.flush_query_logs()
+        
+        saved = sum(len(call.args[1]) for call in log_session.bulk_insert_mappings.call_args_list)
+        assert saved == 3, f"All 3 query logs should be saved, got {saved}"
+        assert log_session.commit.called, "Log session should be committed"
+        assert not mock_db.commit.called, "Request session should not be committed by logging"
+    
+    def test_services_share_one_log_writer_thread(self):
+        """多个服务实例应共用一个后台日志写入线程"""
+        log_session = Mock()
+        log_session.is_active = True
+        
+        with patch("app.services.query_service.Session", return_value=log_session):
+            services = [QueryService(db=Mock()) for _ in range(3)]
+            for i, service in enumerate(services):
+                service._log_query(1, {
+                    "question": f"问题{i}",
+                    "answer": "答案",
+                    "confidence": 0.5,
+                    "response_time": 1.0
+                })
+            services[0].flush_query_logs()
+        
+        writers = [t for t in threading.enumerate() if t.name == "query-log-writer"]
+        assert len(writers) == 1, f"Expected one shared log writer thread, got {len(writers)}"
+        saved = sum(len(call.args[1]) for call in log_session.bulk_insert_mappings.call_args_list)
+        assert saved == 3
+        
+        # 写入线程和退出时的刷新回调都不应持有服务实例
+        service_ref = weakref.ref(services[0])
+        del services, service
+        gc.collect()
+        assert service_ref() is None, "QueryService should be released after logging"
+    
+    def test_failed_batch_retries_rows_individually(self):
+        """整批写入失败时应逐条重试，只丢弃写入失败的日志"""
+        service = QueryService(db=Mock())
+        session = Mock()
+        session.is_active = True
+        
+        def insert(model, rows):
+            if len(rows) > 1 or rows[0]["question"] == "坏数据":
+                raise ValueError("insert failed")
+        session.bulk_insert_mappings.side_effect = insert
+        
+        entries = [{"question": q} for q in ("问题1", "坏数据", "问题2")]
+        service._write_query_logs(entries, session)
+        
+        assert session.commit.call_count == 2, "Valid rows should be committed individually"
+        assert session.rollback.call_count == 2
+
+
+class TestQueryCache:
+    """
+    查询结果缓存测试
+    """
+    
+    def test_normalized_questions_share_cache_entry(self):
+        """仅空白、全半角、大小写或句末标点不同的问题应命中同一缓存条目"""
+        service = QueryService(db=Mock())
+        response = {"question": "ICBC北京分行联行号？", "answer": "答案", "confidence": 0.9}
+        service._cache_result("ICBC北京分行联行号？", response)
+        
+        cached = service._get_cached_result("  ｉｃｂｃ北京分行联行号? ")
+        assert cached is not None, "Normalized question should hit the cache"
+        assert cached["answer"] == "答案"
+    
+    def test_cache_evicts_least_frequently_used(self):
+        """缓存满时应淘汰命中次数最少的条目，而不是最久未使用的"""
+        service = QueryService(db=Mock())
+        service.max_cache_size = 2
+        service._cache_result("问题A", {"answer": "A"})
+        service._cache_result("问题B", {"answer": "B"})
+        
+        # A命中三次，B随后命中一次：B最近使用过，但命中次数更少
+        for _ in range(3):
+            assert service._get_cached_result("问题A") is not None
+        assert service._get_cached_result("问题B") is not None
+        service._cache_result("问题C", {"answer": "C"})
+        
+        assert service._get_cached_result("问题B") is None
+        assert service._get_cached_result("问题A") is not None
+        assert service._get_cached_result("问题C") is not None
+        
+        stats = service.get_cache_stats()
+        assert stats["cache_hits"] == 6
+        assert stats["cache_misses"] == 1
+    
+    def test_batch_query_retrieves_cache_misses_in_one_batch(self):
+        """批量查询应跳过精确缓存命中的问题，其余问题一次批量检索，不再逐个检索"""
+        import numpy as np
+        from unittest.mock import AsyncMock
+        
+        service = QueryService(db=Mock())
+        service._create_session = Mock(return_value=None)
+        service.extract_bank_codes = Mock(return_value=[])
+        service._cache_result("问题A", {"question": "问题A", "answer": "A", "confidence": 0.9})
+        bank = {"bank_name": "中国工商银行北京西单支行", "bank_code": "102100000026",
+                "clearing_code": "102100099996", "final_score": 9.0}
+        service.rag_service = Mock()
+        service.rag_service._embed_queries.side_effect = (
+            lambda questions: [np.ones((1, 2), dtype=np.float32) for _ in questions]
+        )
+        service.rag_service.retrieve_relevant_banks_batch = AsyncMock(return_value=[[bank], [bank]])
+        service.rag_service.retrieve_relevant_banks = AsyncMock(return_value=[])
+        
+        responses = service.batch_query(["问题A", "问题B", "问题C"], log_queries=False)
+        
+        assert [r["question"] for r in responses] == ["问题A", "问题B", "问题C"]
+        assert responses[0]["answer"] == "A"
+        service.rag_service._embed_queries.assert_called_once_with(["问题B", "问题C"])
+        service.rag_service.retrieve_relevant_banks_batch.assert_awaited_once_with(["问题B", "问题C"], top_k=5)
+        service.rag_service.retrieve_relevant_banks.assert_not_awaited()
+        assert all(r["matched_records"] == [bank] for r in responses[1:])
+    
+    def test_run_coroutine_inline_or_off_running_loop(self):
+        """没有运行中的事件循环时在当前线程运行协程；在事件循环中（异步接口）调用时交给线程池运行"""
+        import asyncio
+        
+        async def current_thread():
+            return threading.current_thread()
+        
+        async def caller():
+            return QueryService._run_coroutine(current_thread())
+        
+        assert QueryService._run_coroutine(current_thread()) is threading.current_thread()
+        assert asyncio.run(caller()) is not threading.current_thread()
+    
+    def test_repeated_context_is_tokenized_once(self):
+        """相同的RAG上下文只分词一次，结果与首次分词一致"""
+        service = QueryService(db=Mock())
+        tokenized = []
+        
+        def tokenizer(texts, **kwargs):
+            tokenized.extend(texts)
+            return {"input_ids": [[len(text)] for text in texts]}
+        service.tokenizer = tokenizer
+        
+        context = "中国工商银行北京西单支行: 102100000026"
+        first = service._encode_contexts([context, None, context], {})
+        second = service._encode_contexts([None, context], {})
+        
+        assert tokenized == [f"{context}\n\n"], "Identical contexts should be tokenized once"
+        assert first == {0: [len(context) + 2], 2: [len(context) + 2]}
+        assert second == {1: first[0]}
+    
+    @staticmethod
+    def _service_with_embeddings(vectors):
+        """构造按问题返回固定向量的服务（向量经RAG服务的查询向量缓存获取）"""
+        import numpy as np
+        from app.services.query_service import QueryParse
+        
+        service = QueryService(db=Mock())
+        service.rag_service = Mock()
+        service.rag_service._embed_queries.side_effect = (
+            lambda questions: [np.array([vectors[q]], dtype=np.float32) for q in questions]
+        )
+        return service, QueryParse
+    
+    def test_semantic_cache_hits_paraphrase_with_same_entities(self):
+        """实体一致且向量足够相似的问题应命中语义缓存"""
+        service, QueryParse = self._service_with_embeddings({
+            "工商银行西单支行联行号": [1.0, 0.0],
+            "请问工商银行西单支行的联行号": [0.96, 0.28],
+        })
+        original = QueryParse(service, "工商银行西单支行联行号")
+        _, embedding = service._get_semantic_cached_result(original)
+        service._cache_semantic_result(original, embedding, {"answer": "答案"})
+        
+        cached, _ = service._get_semantic_cached_result(QueryParse(service, "请问工商银行西单支行的联行号"))
+        assert cached is not None and cached["answer"] == "答案"
+    
+    def test_semantic_cache_misses_different_branch(self):
+        """向量相似但支行不同的问题不应命中语义缓存"""
+        service, QueryParse = self._service_with_embeddings({
+            "工商银行西单支行联行号": [1.0, 0.0],
+            "工商银行东单支行联行号": [0.99, 0.14],
+        })
+        original = QueryParse(service, "工商银行西单支行联行号")
+        _, embedding = service._get_semantic_cached_result(original)
+        service._cache_semantic_result(original, embedding, {"answer": "答案"})
+        
+        cached, _ = service._get_semantic_cached_result(QueryParse(service, "工商银行东单支行联行号"))
+        assert cached is None
+    
+    def test_formatted_answer_cache_shared_and_does_not_hold_service(self):
+        """格式化答案缓存应在实例间共享，且不持有QueryService实例"""
+        from app.services import query_service
+        
+        query_service._format_match_answer_cached.cache_clear()
+        records = [{"bank_name": "中国工商银行北京西单支行", "bank_code": "102100000001", "clearing_code": ""}]
+        first = QueryService(db=Mock())
+        second = QueryService(db=Mock())
+        
+        answer = first.format_structured_answer("问题", records, 0.95, 1.0)
+        assert second.format_structured_answer("问题", records, 0.95, 1.0) == answer
+        assert query_service._format_match_answer_cached.cache_info().hits == 1
+        
+        service_ref = weakref.ref(first)
+        del first
+        gc.collect()
+        assert service_ref() is None, "Answer cache should not keep QueryService alive"
+
+
+class TestSmallModelEntityExtraction:
+    """
+    规则实体提取测试
+    """
+    
+    def test_extracts_bank_location_and_branch(self):
+        """应识别银行全称、地区和支行，并生成检索关键词"""
+        service = QueryService(db=Mock())
+        
+        entities = service.extract_bank_entities_with_small_model("工行北京西单支行的联行号")
+        
+        assert entities["bank_name"] == "中国工商银行"
+        assert entities["location"] == "北京"
+        assert entities["keywords"][:2] == ["中国工商银行", "工行"]
+        assert "支行" in entities["keywords"]
+    
+    def test_location_prefers_higher_priority_city(self):
+        """多个城市同时出现时，应按城市优先级而非出现位置选取"""
+        service = QueryService(db=Mock())
+        
+        entities = service.extract_bank_entities_with_small_model("建设银行杭州分行还是北京分行")
+        
+        assert entities["location"] == "北京"
+    
+    def test_query_parse_extracts_each_part_once(self):
+        """问题解析结果的各部分应在首次使用时提取，且只提取一次"""
+        from app.services.query_service import QueryParse
+        
+        service = QueryService(db=Mock())
+        parse = QueryParse(service, "工行北京西单支行的联行号")
+        
+        with patch.object(service, "extract_bank_entities_with_small_model",
+                          wraps=service.extract_bank_entities_with_small_model) as extract:
+            first = parse.entities
+            second = parse.entities
+        
+        assert extract.call_count == 1
+        assert first is second
+        assert first["bank_name"] == "中国工商银行"
+
+
+class TestCandidateScoring:
+    """
+    候选评分测试
+    """
+    
+    @settings(max_examples=50, deadline=None)
+    @given(
+        keywords=st.lists(st.sampled_from(["工商银行", "工行", "北京", "西单支行", "ICBC", "Icbc", "上海"]),
+                          max_size=6),
+        bank_name=st.sampled_from(["中国工商银行北京西单支行", "ICBC北京分行", "中国银行上海分行"])
+    )
+    def test_keyword_scoring_same_with_and_without_automaton(self, keywords, bank_name):
+        """关键词自动机与逐个子串查找的评分结果应一致"""
+        from app.services import query_service
+        
+        args = (bank_name, "问题", False, tuple(keywords), (), (), ())
+        query_service._score_candidate.cache_clear()
+        with_automaton = query_service._score_candidate(*args)
+        
+        with patch.object(query_service, "ahocorasick", None):
+            query_service._score_candidate.cache_clear()
+            query_service._keyword_automaton.cache_clear()
+            with_substring_scan = query_service._score_candidate(*args)
+        query_service._score_candidate.cache_clear()
+        query_service._keyword_automaton.cache_clear()
+        
+        assert with_automaton == with_substring_scan